@@ -0,0 +1,60 @@
+import threading
+
+ADMISSION_RESOURCES = ('images', 'pixels', 'chips')
+
+class AdmissionRejected(Exception):
+    '''
+    Raised by InFlightBudget.acquire() when a request's work does not fit in the remaining budget. retry_after is the number of seconds
+    the client should wait before trying again, or None when the request is larger than the whole budget and will never be admitted.
+    '''
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class InFlightBudget:
+    '''
+    A global budget of work that may be in flight (accepted but not yet finished) at once, counted in images, pixels and image chips.
+    Requests acquire their share of the budget before their job is queued and release it when the job's pipeline has finished, so a burst
+    of large uploads is turned away up front instead of being queued until the node runs out of memory.
+
+    -  INPUTS:
+      -  max_images, max_pixels, max_chips: the most of each resource that may be in flight at once (None for no limit).
+      -  retry_after: the number of seconds rejected clients are asked to wait before retrying.
+    '''
+    def __init__(self, max_images=None, max_pixels=None, max_chips=None, retry_after=10):
+        self.limits = {'images': max_images, 'pixels': max_pixels, 'chips': max_chips}
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.in_flight = dict.fromkeys(ADMISSION_RESOURCES, 0)
+
+    def acquire(self, images, pixels, chips) -> dict:
+        '''
+        Reserves a request's work and returns the reservation, to be passed to release() once the work is done. Raises AdmissionRejected
+        if any resource would go over its limit.
+        '''
+        request = {'images': images, 'pixels': pixels, 'chips': chips}
+        with self.lock:
+            for resource, limit in self.limits.items():
+                if limit is None:
+                    continue
+                if request[resource] > limit:
+                    raise AdmissionRejected(f"The request has {request[resource]} {resource}, more than the API's limit of {limit} in flight.")
+                if self.in_flight[resource] + request[resource] > limit:
+                    raise AdmissionRejected(f"{self.in_flight[resource]} of {limit} {resource} are already in flight.", self.retry_after)
+
+            for resource in ADMISSION_RESOURCES:
+                self.in_flight[resource] += request[resource]
+
+        return request
+
+    def release(self, reservation) -> None:
+        with self.lock:
+            for resource in ADMISSION_RESOURCES:
+                self.in_flight[resource] -= reservation[resource]
+
+    def current(self, resource):
+        '''
+        Returns the amount of a resource ('images', 'pixels' or 'chips') currently in flight.
+        '''
+        with self.lock:
+            return self.in_flight[resource]
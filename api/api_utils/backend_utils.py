@@ -0,0 +1,126 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+# The model outputs used by format_detections(). Other (large) outputs such as raw_detection_boxes are never copied out of the model.
+DETECTION_OUTPUTS = ('detection_boxes', 'detection_scores', 'detection_classes', 'num_detections')
+
+TFLITE_QUANTIZATIONS = (None, 'float16', 'int8')
+
+class InferenceBackend(ABC):
+    '''
+    The interface shared by every inference backend. A backend is called like a loaded saved_model: backend(batch_tensor) takes a
+    (n, HEIGHT, WIDTH, 3) uint8 array and returns a dictionary of numpy arrays keyed by the TFODAPI output names (detection_boxes,
+    detection_scores, detection_classes, and num_detections when the model provides it), each with a leading batch dimension of n.
+
+    supported_batch_size is the largest batch the backend accepts in one call, or None when any batch size is accepted. Callers such as
+    batch_inference() and DynamicBatcher read it to size their batches, so each backend sets it when its model is loaded. Backends must
+    implement __call__().
+    '''
+    name = None
+    supported_batch_size = None
+
+    @abstractmethod
+    def __call__(self, batch_tensor) -> dict:
+        pass
+
+class SavedModelBackend(InferenceBackend):
+    '''
+    Runs a TensorFlow saved_model (as exported by the TFODAPI exporter or export_batched_model()) with tf.saved_model.load.
+
+    -  INPUTS:
+      -  path_to_pb: the saved_model folder.
+    '''
+    name = 'saved_model'
+
+    def __init__(self, path_to_pb):
+        import tensorflow as tf
+
+        self.model = tf.saved_model.load(path_to_pb)
+        self.signatures = self.model.signatures
+        try:
+            _, input_specs = self.signatures['serving_default'].structured_input_signature
+            self.supported_batch_size = list(input_specs.values())[0].shape[0]
+        except (AttributeError, KeyError, IndexError, TypeError):
+            self.supported_batch_size = 1
+
+    def __call__(self, batch_tensor) -> dict:
+        detections = self.model(batch_tensor)
+        return {k: np.asarray(detections[k]) for k in DETECTION_OUTPUTS if k in detections}
+
+class TFLiteBackend(InferenceBackend):
+    '''
+    Runs a TFLite model converted with convert_to_tflite() on CPU, with the interpreter bundled with TensorFlow. The converted model keeps
+    the detection post-processing as TensorFlow "select" ops, which need the Flex delegate that is only linked into TensorFlow's interpreter
+    (the standalone tflite_runtime wheel can't run them). The converted model has a batch size of 1, so each chip in a batch is run through
+    the interpreter in turn.
+
+    -  INPUTS:
+      -  model_path: the .tflite file.
+      -  num_threads: the number of CPU threads the interpreter may use. None lets TFLite decide.
+    '''
+    name = 'tflite'
+    supported_batch_size = 1
+
+    def __init__(self, model_path, num_threads=None):
+        import tensorflow as tf
+
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.runner = self.interpreter.get_signature_runner('serving_default')
+        self.input_name = list(self.interpreter.get_signature_list()['serving_default']['inputs'])[0]
+
+    def __call__(self, batch_tensor) -> dict:
+        chip_outputs = [self.runner(**{self.input_name: np.ascontiguousarray(chip_array)[np.newaxis, ...]}) for chip_array in batch_tensor]
+        return {k: np.concatenate([o[k] for o in chip_outputs]) for k in DETECTION_OUTPUTS if k in chip_outputs[0]}
+
+BACKENDS = {SavedModelBackend.name: SavedModelBackend, TFLiteBackend.name: TFLiteBackend}
+
+def load_backend(path, backend='saved_model', **options) -> InferenceBackend:
+    '''
+    Loads the model at path with the named backend ('saved_model' or 'tflite'). Any options (e.g. num_threads for 'tflite') are passed to
+    the backend's constructor.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Expected one of {sorted(BACKENDS)}.")
+    return BACKENDS[backend](path, **options)
+
+def convert_to_tflite(saved_model_dir, output_path, quantization=None, representative_chips=None) -> None:
+    '''
+    Converts a TFODAPI saved_model to a TFLite model for TFLiteBackend. The detection post-processing (non-max suppression, etc.) in the
+    exported graph has no TFLite builtin equivalent, so those ops are kept as TensorFlow "select" ops, and the model must be run with
+    TensorFlow's interpreter (see TFLiteBackend).
+
+    -  INPUTS:
+      -  saved_model_dir: the saved_model folder, e.g. models/efficientdet-d0/saved_model.
+      -  output_path: the .tflite file to write.
+      -  quantization: None for a float32 model, 'float16' to store weights as float16, or 'int8' to quantize weights and activations to
+           int8 where the builtin ops support it (falling back to float elsewhere).
+      -  representative_chips: an iterable of (HEIGHT, WIDTH, 3) uint8 chips used to calibrate 'int8' activation ranges. Real chips give the
+           best accuracy; random chips are used when None.
+    '''
+    import tensorflow as tf
+
+    if quantization not in TFLITE_QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}'. Expected one of {TFLITE_QUANTIZATIONS}.")
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if representative_chips is None:
+            rng = np.random.default_rng(0)
+            representative_chips = [rng.integers(0, 256, (512, 512, 3), dtype=np.uint8) for _ in range(32)]
+
+        def representative_dataset():
+            for chip_array in representative_chips:
+                yield [np.asarray(chip_array, dtype=np.uint8)[np.newaxis, ...]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+
+    with open(output_path, 'wb') as outfile:
+        outfile.write(converter.convert())
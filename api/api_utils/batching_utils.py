@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
+
+import numpy as np
+
+
+# Upper bounds (in milliseconds) of the buckets used for the batcher's queue wait-time histogram.
+WAIT_MS_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+class DynamicBatcher:
+    '''
+    Sits in front of a loaded model and merges image chips from every in-flight request into shared batches. Callers use the batcher
+    exactly like the model (batcher(batch_tensor) returns the same dictionary of detection arrays), but each chip is queued and a single
+    background thread runs the model on batches of up to max_batch_size chips, waiting at most max_wait_ms for a batch to fill up. The
+    detections for each chip are then handed back to the request that submitted it.
+
+    -  INPUTS:
+      -  model: a model loaded by load_model(). If its signature only accepts a batch size of 1, batches are capped at 1.
+      -  max_batch_size: the largest number of chips sent to the model per call.
+      -  max_wait_ms: the longest a chip waits for other chips to join its batch before the batch is run anyway.
+      -  runners: the number of batches run on the model at once. More than 1 only helps when the model can run calls in parallel, such as
+           an InferenceWorkerPool (one runner per worker).
+    '''
+    # Tells batch_inference() that any number of chips can be passed per call (they are split up and re-batched here).
+    supported_batch_size = None
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=10, runners=1):
+        self.model = model
+        self.max_batch_size = max_batch_size if model.supported_batch_size is None else min(max_batch_size, model.supported_batch_size)
+        self.max_wait_ms = max_wait_ms
+
+        self.pending = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.n_batches = 0
+        self.n_chips = 0
+        self.batch_size_counts = {}
+        self.wait_ms_counts = [0] * (len(WAIT_MS_BUCKETS) + 1)
+
+        self.threads = [threading.Thread(target=self._run, name=f'dynamic-batcher-{i}', daemon=True) for i in range(runners)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chip_array) -> Future:
+        '''
+        Queues one (HEIGHT, WIDTH, 3) image chip and returns a Future that resolves to that chip's detection arrays.
+        '''
+        future = Future()
+        self.pending.put((chip_array, future, time.perf_counter()))
+        return future
+
+    def __call__(self, batch_tensor) -> dict:
+        futures = [self.submit(chip_array) for chip_array in batch_tensor]
+        chip_detections = [f.result() for f in futures]
+        return {k: np.stack([d[k] for d in chip_detections]) for k in chip_detections[0]}
+
+    def _collect_batch(self) -> list:
+        batch = [self.pending.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            self._record(len(batch), [(started - enqueued) * 1000 for _, _, enqueued in batch])
+
+            try:
+                detections = self.model(np.stack([chip_array for chip_array, _, _ in batch]))
+                detections = {k: np.asarray(v) for k, v in detections.items()}
+                chip_detections = [{k: v[i] for k, v in detections.items()} for i in range(len(batch))]
+            except Exception as e:
+                # Fail every request in the batch rather than letting the batcher thread die and leave callers waiting forever.
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, chip_detections):
+                future.set_result(result)
+
+    def _record(self, batch_size, wait_times_ms) -> None:
+        with self.stats_lock:
+            self.n_batches += 1
+            self.n_chips += batch_size
+            self.batch_size_counts[batch_size] = self.batch_size_counts.get(batch_size, 0) + 1
+            for wait_ms in wait_times_ms:
+                self.wait_ms_counts[bisect_left(WAIT_MS_BUCKETS, wait_ms)] += 1
+
+    def stats(self) -> dict:
+        '''
+        Returns the batcher's configuration, the current queue depth, and histograms of batch sizes and chip queue wait times.
+        '''
+        with self.stats_lock:
+            wait_labels = [f"<={b}ms" for b in WAIT_MS_BUCKETS] + [f">{WAIT_MS_BUCKETS[-1]}ms"]
+            return {'max_batch_size': self.max_batch_size,
+                    'max_wait_ms': self.max_wait_ms,
+                    'queue_depth': self.pending.qsize(),
+                    'batches': self.n_batches,
+                    'chips': self.n_chips,
+                    'mean_batch_size': self.n_chips / self.n_batches if self.n_batches else 0.0,
+                    'batch_size_histogram': dict(sorted(self.batch_size_counts.items())),
+                    'wait_ms_histogram': dict(zip(wait_labels, self.wait_ms_counts))}
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+from api.api_utils.output_utils import read_npz, write_npz
+
+DETECTIONS_FILE = 'detections.npz'
+# Bump whenever the layout or meaning of cached entries changes (e.g. the coordinate space of the cached bboxes).
+CACHE_FORMAT_VERSION = 3
+
+def detection_cache_key(image_path, sub, target_gsd_cm, model_version, chip_size=None, chip_overlap=None, nms_iou_threshold=None,
+                        prefilter_config=None) -> str:
+    '''
+    Builds a content-addressed cache key from the uploaded image file's bytes, the resampling and chipping parameters that change what the
+    model sees, and the model version. The confidence threshold is deliberately left out: the cache stores unfiltered detections, so a repeat
+    submission with a new threshold hits the same entry.
+    '''
+    params = {'skip_optional_resampling': sub.skip_optional_resampling,
+              'flight_AGL': sub.flight_AGL,
+              'sensor_platform': sub.sensor_platform,
+              'target_gsd_cm': target_gsd_cm,
+              'model_version': model_version,
+              'chip_size': chip_size,
+              'chip_overlap': chip_overlap,
+              'nms_iou_threshold': nms_iou_threshold,
+              'prefilter_config': prefilter_config,
+              'cache_format_version': CACHE_FORMAT_VERSION}
+
+    h = hashlib.sha256()
+    with open(image_path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024 * 1024), b''):
+            h.update(block)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+class DetectionCache:
+    '''
+    A size-bounded, least-recently-used cache of raw (unfiltered) detections on local disk. Each entry is a folder named after its
+    detection_cache_key() holding the image's detections as a columnar .npz file (see output_utils.write_npz()) plus a copy of the image
+    they are plotted on, so a cache hit can be re-thresholded and re-plotted without decoding, resampling, chipping or running inference again.
+
+    -  INPUTS:
+      -  cache_dir: the folder in which cache entries are stored. Existing entries are picked up on start, oldest first, and staging folders
+           left behind by an interrupted put() are removed.
+      -  max_bytes: the total size the cache is allowed to grow to before least-recently-used entries are evicted.
+    '''
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for entry in os.scandir(cache_dir):
+            if entry.is_dir() and entry.name.startswith('.tmp-'):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        existing = [e for e in os.scandir(cache_dir) if e.is_dir() and not e.name.startswith('.')]
+        for entry in sorted(existing, key=lambda e: e.stat().st_mtime):
+            self.entries[entry.name] = self._entry_size(entry.path)
+
+    @staticmethod
+    def _entry_size(path) -> int:
+        return sum(f.stat().st_size for f in os.scandir(path) if f.is_file())
+
+    def get(self, key):
+        '''
+        Returns (detections, processed image path) for a cached key, or None on a cache miss.
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+
+        try:
+            detections = read_npz(os.path.join(entry_dir, DETECTIONS_FILE))['image']
+            image_path = [os.path.join(entry_dir, f) for f in os.listdir(entry_dir) if f != DETECTIONS_FILE][0]
+            os.utime(entry_dir)
+        except (OSError, ValueError, IndexError):
+            # The entry was evicted (or is unreadable) between the index lookup and the read.
+            return None
+
+        return detections, image_path
+
+    def put(self, key, detections, image_path) -> None:
+        '''
+        Stores an image's unfiltered detections and a copy of the processed image at image_path, then evicts least-recently-used entries
+        until the cache fits in max_bytes.
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+
+        write_npz(os.path.join(tmp_dir, DETECTIONS_FILE), {'image': detections})
+        shutil.copyfile(image_path, os.path.join(tmp_dir, 'image' + os.path.splitext(image_path)[1]))
+        size = self._entry_size(tmp_dir)
+
+        with self.lock:
+            if key in self.entries or size > self.max_bytes:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            os.rename(tmp_dir, entry_dir)
+            self.entries[key] = size
+
+            evicted = []
+            while sum(self.entries.values()) > self.max_bytes:
+                evicted.append(self.entries.popitem(last=False)[0])
+
+        for old_key in evicted:
+            shutil.rmtree(os.path.join(self.cache_dir, old_key), ignore_errors=True)
+
+    def stats(self) -> dict:
+        '''
+        Returns the number of cached entries and their total size.
+        '''
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': sum(self.entries.values()), 'max_bytes': self.max_bytes}
@@ -1,72 +1,252 @@
-from PIL import Image
 import os
+import re
+from functools import lru_cache
+
 import cv2
 import numpy as np
-import sys
 
-# TODO: All attempts to add TFODAPI utils to the PYTHONPATH during docker build are failing. This is the only place in the API that
-# those are currently used, so inserting a shim until we get PYTHONPATH issues sorted in Docker.
+from api.api_utils.pyramid_utils import write_tile_pyramid
+
+# BGR colors assigned to class IDs (class_id % len(BOX_COLORS)). Bright colors that read well on sand, water and vegetation.
+BOX_COLORS = [(0, 255, 255), (255, 255, 0), (255, 0, 255), (0, 165, 255), (0, 255, 0),
+              (255, 144, 30), (147, 20, 255), (0, 0, 255), (180, 105, 255), (255, 255, 255)]
+
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_FONT_SCALE = 0.4
+LABEL_PADDING = 2
 
-sys.path.insert(0, '/tensorflow/models/research')
-from object_detection.utils import visualization_utils as viz_utils
-from object_detection.utils import label_map_util
+_ITEM_PATTERN = re.compile(r'item\s*\{(.*?)\}', re.DOTALL)
+_FIELD_PATTERN = re.compile(r'(\w+)\s*:\s*(?:"([^"]*)"|\'([^\']*)\'|(\S+))')
 
+@lru_cache(maxsize=None)
 def category_index(label_map_path) -> dict:
     '''
-    Translates a Tensorflow .pbtxt label map file into a Python dictionary that can be used to associate class IDs with class names.
+    Translates a Tensorflow .pbtxt label map file into a Python dictionary that can be used to associate class IDs with class names. The label
+    map is parsed directly (no TFODAPI import needed) and the result is cached, so repeated calls with the same path are free.
     
     INPUTS:
       -  label_map_path: the path to a Tensorflow .pbtxt label map file.
     OUTPUTS:
       -  category_index: a python dictionary containing a map between class integers and class names 
     '''
-    label_map  = label_map_util.load_labelmap(label_map_path)
-    categories = label_map_util.convert_label_map_to_categories(label_map, max_num_classes=100, use_display_name=True)
-    
+    with open(label_map_path) as infile:
+        label_map = infile.read()
+
     category_index = {}
-    for i, item in enumerate(categories):
-        category_index[i+1] = item
-    
+    for item in _ITEM_PATTERN.findall(label_map):
+        fields = {m[0]: m[1] or m[2] or m[3] for m in _FIELD_PATTERN.findall(item)}
+        class_id = int(fields['id'])
+        category_index[class_id] = {'id': class_id, 'name': fields.get('display_name', fields.get('name', str(class_id)))}
+
     return category_index
 
-def plot_bboxes(output_image_name, output_image_dir, chip_path, label_map_path, detection_dict, CONFIDENCE_THRESHOLD=0.2) -> None:
+def box_color(class_id) -> tuple:
     '''
-    A function that wraps the TFODAPI viz_utils. This can be used to translate our python dictionary of detections into
-    a an image chip plot with the model's predictions drawn as bounding boxes with class name and prediction confidence.
+    Returns the BGR color used to draw boxes of a given class ID.
+    '''
+    return BOX_COLORS[int(class_id) % len(BOX_COLORS)]
+
+@lru_cache(maxsize=4096)
+def _label_size(label) -> tuple:
+    (text_width, text_height), baseline = cv2.getTextSize(label, LABEL_FONT, LABEL_FONT_SCALE, 1)
+    return text_width, text_height + baseline
+
+def draw_detections(image, bboxes, classes, scores, cat_index, CONFIDENCE_THRESHOLD=0.2, line_thickness=1, rgb=False, top=0) -> np.ndarray:
+    '''
+    Draws bounding boxes and "class name: score%" labels onto a BGR (or RGB, if rgb=True) image array in place. Boxes are grouped by class and each group's boxes
+    and label backgrounds are drawn with a single cv2.polylines()/cv2.fillPoly() call, so drawing cost stays low even with thousands of detections.
+
+    INPUTS:
+      -  image: a (HEIGHT, WIDTH, 3) uint8 BGR numpy array to draw on.
+      -  bboxes: an (N, 4) array of [ymin, xmin, ymax, xmax] pixel coordinates.
+      -  classes, scores: length N arrays of class IDs and confidence scores.
+      -  cat_index: the category index returned by category_index().
+      -  CONFIDENCE_THRESHOLD: detections with scores below this value are not drawn.
+      -  rgb: set to True when image is in RGB rather than OpenCV's BGR band order.
+      -  top: when image is a band of rows of a larger image, the row of the larger image it starts at. bboxes are then in the larger
+           image's coordinates, so labels are placed the same way whichever band they are drawn on.
+
+    OUTPUTS:
+      -  The image array, with detections drawn on it.
+    '''
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    classes = np.asarray(classes, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+
+    keep = scores >= CONFIDENCE_THRESHOLD
+    bboxes, classes, scores = bboxes[keep].astype(np.int32), classes[keep], scores[keep]
+    if len(scores) == 0:
+        return image
+
+    ymin, xmin, ymax, xmax = bboxes.T
+    labels = [f"{cat_index.get(c, {'name': str(c)})['name']}: {int(100 * s)}%" for c, s in zip(classes.tolist(), scores.tolist())]
+    label_sizes = np.array([_label_size(label) for label in labels], dtype=np.int32).reshape(-1, 2) + 2 * LABEL_PADDING
+
+    # Labels sit on top of their box, or just inside it when the box touches the top of the image.
+    label_bottom = np.where(ymin - label_sizes[:, 1] >= 0, ymin, ymin + label_sizes[:, 1])
+    label_top = label_bottom - label_sizes[:, 1]
+
+    if top:
+        ymin, ymax, label_top, label_bottom = ymin - top, ymax - top, label_top - top, label_bottom - top
+
+    label_right = xmin + label_sizes[:, 0]
+    corners = np.stack([np.stack([xmin, ymin], axis=1), np.stack([xmax, ymin], axis=1),
+                        np.stack([xmax, ymax], axis=1), np.stack([xmin, ymax], axis=1)], axis=1)
+    label_corners = np.stack([np.stack([xmin, label_top], axis=1), np.stack([label_right, label_top], axis=1),
+                              np.stack([label_right, label_bottom], axis=1), np.stack([xmin, label_bottom], axis=1)], axis=1)
+
+    for class_id in np.unique(classes):
+        in_class = classes == class_id
+        color = box_color(class_id)[::-1] if rgb else box_color(class_id)
+        cv2.polylines(image, list(corners[in_class]), True, color, line_thickness)
+        cv2.fillPoly(image, list(label_corners[in_class]), color)
+
+    for label, x, y in zip(labels, xmin.tolist(), (label_bottom - LABEL_PADDING).tolist()):
+        cv2.putText(image, label, (x + LABEL_PADDING, y), LABEL_FONT, LABEL_FONT_SCALE, (0, 0, 0), 1, cv2.LINE_AA)
+
+    return image
+
+def _draw_band(band, top, bottom, bboxes, classes, scores, cat_index, CONFIDENCE_THRESHOLD=0.2, rgb=False) -> None:
+    '''
+    Draws the detections that overlap rows top:bottom of an image onto band, an array holding just those rows. Boxes that start just below
+    the band are included too, since their labels sit above them.
+    '''
+    label_height = _label_size('Ag')[1] + 2 * LABEL_PADDING
+    overlaps = (bboxes[:, 2] >= top) & (bboxes[:, 0] - label_height < bottom)
+    draw_detections(band, bboxes[overlaps], classes[overlaps], scores[overlaps], cat_index, CONFIDENCE_THRESHOLD, rgb=rgb, top=top)
+
+def plot_bboxes(output_image_name, output_image_dir, chip_path, label_map_path, detection_dict, CONFIDENCE_THRESHOLD=0.2, image=None) -> None:
+    '''
+    This can be used to translate our python dictionary of detections into an image plot with the model's predictions drawn as bounding boxes
+    with class name and prediction confidence.
     INPUTS:
       -  output_image_name: the desired file name of the output image.
       -  output_image_dir: the desired location of the output image
-      -  chip_path: the path to the input image chip to be displayed. Should be an image file.
+      -  chip_path: the path to the input image chip to be displayed. Should be an image file. Only read when image is None.
       -  label_map_path: the path to a Tensorflow .pbtxt label map
       -  detection_dict: A python dictionary that stores the bboxes, classes, and scores for each image chip.
       -  CONFIDENCE_THRESHOLD: A value between 0 and 1.0 that specifies the score threshold at which detections are filtered from our
            plots. This is used to filter low confidence predictions from the data set. Recommended values are between 0.2 and 0.5
            (equivalent to 20% and 50% confidence thresholds).
+      -  image: optional in-memory (HEIGHT, WIDTH, 3) RGB numpy array of the image (e.g. the array already held by the pipeline). Saves
+           re-reading and decoding chip_path from disk.
     
     OUTPUTS:
       -  JPG format images plots are written to the user specified output_image_dir
     '''
-
     cat_index = category_index(label_map_path)
 
-    bboxes = np.array(detection_dict['bboxes'])
-    classes = detection_dict['classes']
-    scores = detection_dict['scores']
-
-    image = np.array(cv2.imread(chip_path))
-    image_copy = image.copy()
-    viz_utils.visualize_boxes_and_labels_on_image_array(
-            image_copy,
-            bboxes,
-            classes,
-            scores,
-            cat_index,
-            use_normalized_coordinates=False,
-            max_boxes_to_draw=5000,
-            min_score_thresh=CONFIDENCE_THRESHOLD,
-            agnostic_mode=False,
-            line_thickness=1)
-    
+    if image is None:
+        # PIL (which decoded the image for inference) ignores EXIF orientation, so cv2 must too or boxes land on a rotated image.
+        canvas = cv2.imread(chip_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+        canvas = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+
+    draw_detections(canvas, detection_dict['bboxes'], detection_dict['classes'], detection_dict['scores'], cat_index, CONFIDENCE_THRESHOLD)
+
     output_image_dir = os.path.join(output_image_dir, output_image_name)
-    cv2.imwrite(output_image_dir, image_copy)
+    cv2.imwrite(output_image_dir, canvas)
+
+@lru_cache(maxsize=None)
+def tiff_plot_compression() -> str:
+    '''
+    Returns the compression plot_bboxes_windowed() writes its tiled TIFFs with: 'jpeg' when tifffile can encode JPEG (which needs the
+    imagecodecs package), otherwise lossless 'zlib', which tifffile can always write.
+    '''
+    import tifffile
+
+    try:
+        tifffile.TIFF.COMPRESSORS[tifffile.COMPRESSION.JPEG]
+        return 'jpeg'
+    except KeyError:
+        print("The imagecodecs package is not installed, windowed image plots will be written as zlib-compressed TIFFs instead of JPEG-compressed TIFFs.")
+        return 'zlib'
+
+def plot_bboxes_windowed(output_image_name, output_image_dir, windowed_image, label_map_path, detection_dict, CONFIDENCE_THRESHOLD=0.2, tile_size=512) -> None:
+    '''
+    The windowed counterpart of plot_bboxes() for images too large to hold in memory. The image is read from a WindowedImage one
+    tile_size-tall band at a time, the detections overlapping each band are drawn on it, and the band is written out as tiles of a
+    JPEG-compressed (or, without imagecodecs, zlib-compressed, see tiff_plot_compression()) tiled TIFF. Peak memory stays at roughly one band regardless of the image's size.
+
+    INPUTS:
+      -  output_image_name: the desired file name of the output image (a TIFF is written regardless of the extension).
+      -  output_image_dir: the desired location of the output image
+      -  windowed_image: the WindowedImage the detections were made on.
+      -  label_map_path: the path to a Tensorflow .pbtxt label map
+      -  detection_dict: A python dictionary that stores the bboxes, classes, and scores for the image.
+      -  CONFIDENCE_THRESHOLD: detections with scores below this value are not drawn.
+      -  tile_size: the height/width of the output TIFF's tiles (must be a multiple of 16).
+
+    OUTPUTS:
+      -  A tiled TIFF image plot written to the user specified output_image_dir
+    '''
+    import tifffile
+
+    cat_index = category_index(label_map_path)
+
+    bboxes = np.asarray(detection_dict['bboxes'], dtype=np.float64).reshape(-1, 4)
+    classes = np.asarray(detection_dict['classes'], dtype=np.int64)
+    scores = np.asarray(detection_dict['scores'], dtype=np.float64)
+
+    height, width = windowed_image.height, windowed_image.width
+
+    def iter_tiles():
+        for top in range(0, height, tile_size):
+            bottom = min(top + tile_size, height)
+            band = np.zeros((tile_size, -(-width // tile_size) * tile_size, 3), dtype=np.uint8)
+            band[:bottom - top, :width] = windowed_image.read_window(top, bottom, 0, width)
+
+            _draw_band(band, top, bottom, bboxes, classes, scores, cat_index, CONFIDENCE_THRESHOLD, rgb=True)
+
+            for left in range(0, width, tile_size):
+                yield band[:, left:left + tile_size]
+
+    output_path = os.path.join(output_image_dir, output_image_name)
+    with tifffile.TiffWriter(output_path, bigtiff=height * width * 3 > 2**32 - 2**25) as tif:
+        tif.write(iter_tiles(), shape=(height, width, 3), dtype=np.uint8, tile=(tile_size, tile_size),
+                  photometric='rgb', compression=tiff_plot_compression())
+
+def plot_bboxes_pyramid(base_name, output_image_dir, image_source, label_map_path, detection_dict, CONFIDENCE_THRESHOLD=0.2, tile_size=256,
+                        quality=85, workers=4) -> list:
+    '''
+    The tiled counterpart of plot_bboxes(): instead of one full-size JPEG, the image plot is written as a Deep Zoom tile pyramid (see
+    pyramid_utils.write_tile_pyramid()) that a web viewer can pan and zoom, fetching only the tiles on screen. WindowedImages are read and
+    drawn on one band at a time, so large images never have to be held in memory at full size.
+
+    INPUTS:
+      -  base_name: the name of the pyramid; base_name.dzi and the base_name_files/ tile folder are written.
+      -  output_image_dir: the desired location of the pyramid
+      -  image_source: the image to draw on. A path to an image file, an in-memory (HEIGHT, WIDTH, 3) RGB numpy array, or a WindowedImage.
+      -  label_map_path: the path to a Tensorflow .pbtxt label map
+      -  detection_dict: A python dictionary that stores the bboxes, classes, and scores for the image.
+      -  CONFIDENCE_THRESHOLD: detections with scores below this value are not drawn.
+      -  tile_size, quality, workers: the pyramid's tile size, the tiles' JPEG quality and the number of threads encoding tiles.
+
+    OUTPUTS:
+      -  A list of the written files' paths, relative to output_image_dir.
+    '''
+    cat_index = category_index(label_map_path)
+
+    if hasattr(image_source, 'read_window'):
+        bboxes = np.asarray(detection_dict['bboxes'], dtype=np.float64).reshape(-1, 4)
+        classes = np.asarray(detection_dict['classes'], dtype=np.int64)
+        scores = np.asarray(detection_dict['scores'], dtype=np.float64)
+        height, width = image_source.height, image_source.width
+
+        def read_band(top, bottom):
+            band = cv2.cvtColor(image_source.read_window(top, bottom, 0, width), cv2.COLOR_RGB2BGR)
+            _draw_band(band, top, bottom, bboxes, classes, scores, cat_index, CONFIDENCE_THRESHOLD)
+            return band
+    else:
+        if isinstance(image_source, np.ndarray):
+            canvas = cv2.cvtColor(image_source, cv2.COLOR_RGB2BGR)
+        else:
+            # See plot_bboxes(): boxes were found on the image without its EXIF orientation applied.
+            canvas = cv2.imread(image_source, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        draw_detections(canvas, detection_dict['bboxes'], detection_dict['classes'], detection_dict['scores'], cat_index, CONFIDENCE_THRESHOLD)
+        height, width = canvas.shape[:2]
+
+        def read_band(top, bottom):
+            return canvas[top:bottom]
 
+    return write_tile_pyramid(output_image_dir, base_name, width, height, read_band, tile_size, quality, workers)
@@ -1,67 +1,141 @@
-import tensorflow as tf
+from itertools import islice
 
-def load_model(path_to_pb):
+import numpy as np
+
+from api.api_utils.backend_utils import load_backend
+from api.api_utils.output_utils import DETECTION_KEYS
+
+def load_model(path_to_pb, backend='saved_model', **backend_options):
     '''
-    A simple function that loads a Tensorflow model from a saved_model.pb file.
+    Loads a model for inference with the named backend (see backend_utils.py): 'saved_model' loads a Tensorflow saved_model folder, and
+    'tflite' loads a .tflite file converted with convert_to_tflite() (backend_options such as num_threads are passed to the backend).
     '''
-    model = tf.saved_model.load(path_to_pb)
+    model = load_backend(path_to_pb, backend, **backend_options)
     return model
 
-def denormalize_coordinates(list_of_bboxes, im_width=512, im_height=512):
+def export_batched_model(pipeline_config_path, checkpoint_dir, output_dir) -> None:
+    '''
+    Re-exports a TFODAPI checkpoint as a saved_model whose serving signature accepts a dynamic batch dimension. The stock TFODAPI exporter
+    hardcodes a batch size of 1 into the input signature (shape (1, None, None, 3)), which forces batch_inference() to run the model once per
+    image chip. The model exported here takes input arrays of shape (n, HEIGHT, WIDTH, 3) and can be loaded with load_model().
+
+    -  INPUTS:
+      -  pipeline_config_path: the path to the TFODAPI pipeline.config file the checkpoint was trained with.
+      -  checkpoint_dir: the folder containing the TFODAPI checkpoint (ckpt-0.index, ckpt-0.data-*, etc.)
+      -  output_dir: the folder in which to write the new saved_model.
+
+    -  OUTPUTS:
+      -  A saved_model with a dynamic batch dimension written to output_dir.
+    '''
+    # Tensorflow and TFODAPI are only needed at export time, so they are imported here rather than at the top of the module.
+    import tensorflow as tf
+    from object_detection.builders import model_builder
+    from object_detection.utils import config_util
+
+    configs = config_util.get_configs_from_pipeline_file(pipeline_config_path)
+    detection_model = model_builder.build(model_config=configs['model'], is_training=False)
+
+    ckpt = tf.train.Checkpoint(model=detection_model)
+    ckpt.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+
+    class BatchedDetectionModule(tf.Module):
+        def __init__(self, detection_model):
+            super().__init__()
+            self.detection_model = detection_model
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.uint8, name='input_tensor')])
+        def __call__(self, input_tensor):
+            images = tf.cast(input_tensor, tf.float32)
+            preprocessed_images, true_image_shapes = self.detection_model.preprocess(images)
+            prediction_dict = self.detection_model.predict(preprocessed_images, true_image_shapes)
+            detections = self.detection_model.postprocess(prediction_dict, true_image_shapes)
+            # TFODAPI class IDs are zero-indexed, while the label map (and the stock exporter's output) are one-indexed.
+            detections['detection_classes'] = detections['detection_classes'] + 1
+            return detections
+
+    module = BatchedDetectionModule(detection_model)
+    concrete_fn = module.__call__.get_concrete_function()
+    tf.saved_model.save(module, output_dir, signatures={'serving_default': concrete_fn})
+
+def denormalize_coordinates(list_of_bboxes, im_width=512, im_height=512) -> np.ndarray:
+    '''
+    A simple funtion that takes normalized [ymin, xmin, ymax, xmax] bounding box image coordinates (0-1.0) and converts them to absolute image
+    pixel coordinates, as an (N, 4) int32 array. All boxes are converted in one array operation.
+    '''
+    bboxes = np.asarray(list_of_bboxes, dtype=np.float32).reshape(-1, 4)
+    return (bboxes * np.array([im_height, im_width, im_height, im_width], dtype=np.float32)).astype(np.int32)
+
+def format_detections(detections, index, CONFIDENCE_THRESHOLD, im_height=512, im_width=512) -> dict:
+    '''
+    Pulls the detections for a single image chip out of a (batched) model output and filters them by CONFIDENCE_THRESHOLD.
+
+    -  INPUTS:
+      -  detections: the dictionary of output tensors (or numpy arrays) returned by model().
+      -  index: the position of the image chip within the batch.
+      -  CONFIDENCE_THRESHOLD: detections with scores below this value are dropped.
+      -  im_height, im_width: the image chip dimensions, used to convert the normalized boxes to pixel coordinates.
+
+    -  OUTPUTS:
+      -  A Python dictionary with the chip's 'scores' (float32), 'bboxes' ((N, 4) int32 pixel coordinates) and 'classes' (uint8) arrays.
+    '''
+    detection_scores = np.asarray(detections['detection_scores'][index], dtype=np.float32)
+    keep = detection_scores >= CONFIDENCE_THRESHOLD
+
+    return {'scores': detection_scores[keep],
+            'bboxes': denormalize_coordinates(np.asarray(detections['detection_boxes'][index])[keep], im_width, im_height),
+            'classes': np.asarray(detections['detection_classes'][index])[keep].astype(np.uint8)}
+
+def threshold_detections(detection_dict, CONFIDENCE_THRESHOLD) -> dict:
     '''
-    A simple funtion that takes normalized bounding box image coordinates (0-1.0) and converts to absolute image pixel coordinates.
+    Drops detections with scores below CONFIDENCE_THRESHOLD from a dictionary of 'bboxes', 'scores' and 'classes' arrays (as produced by
+    batch_inference() or reassemble_chips()). Used to re-threshold unfiltered detections, e.g. those stored in the detection cache. Any
+    other keys (such as 'skipped_chips') are passed through unchanged.
     '''
-    # TODO HOW DO I GET THE HEIGHT/WIDTH W/O PROMPTING USER OR HARDCODING??
-    px_bboxes = []
-    for bbox in list_of_bboxes:
-        xmin = bbox[0]
-        ymin = bbox[1]
-        ymax = bbox[3]
-        xmax = bbox[2]
-
-        left   = int(xmin * im_width)
-        right  = int(xmax * im_width)
-        top    = int(ymin * im_height)
-        bottom = int(ymax * im_height)
-
-        px_coords = [left, top, right, bottom]
-        px_bboxes.append(px_coords)
-
-        #print(px_bboxes)
-    return px_bboxes
-
-def batch_inference(dict_of_tensors, model, CONFIDENCE_THRESHOLD) -> dict:
+    keep = np.asarray(detection_dict['scores']) >= CONFIDENCE_THRESHOLD
+    return {k: np.asarray(v)[keep] if k in DETECTION_KEYS else v for k, v in detection_dict.items()}
+
+def batch_inference(dict_of_tensors, model, CONFIDENCE_THRESHOLD, batch_size=1, on_batch=None) -> dict:
     '''
     The main inference function of the ML-of-MD backend API. This function ingests a Python dictionary that contains the image chip names as keys, and
-    each image chip converted to a 3-D numpy array as values. Each image chip array is padded to TF's desired dimension and inference is performed. The
-    resulting model detections are reformatted back into a Python dictionary that contains detections.
+    each image chip converted to a 3-D numpy array as values (or any iterable of (chip name, array) pairs, such as the iter_chips() generator, which is
+    consumed lazily one batch at a time). The image chip arrays are stacked into batches of up to batch_size chips and inference is
+    performed on each batch. The resulting model detections are reformatted back into a Python dictionary that contains detections.
     INPUTS: 
       -  dict_of_tensors: a Python dictionary containing each chipped image array and the associated image chip name.
            -  KEYS: image chip names
            -  VALUES: 3-D numpy arrays of the image chip
+         or an iterable of (image chip name, 3-D numpy array) tuples.
       -  model: A pre-trained Tensorflow model initialized from a saved_model.pb folder (this is expected to have been generated by the backend API's 
-                load_model() function).
-    TODO: TF's model() routine naturally takes input arrays of dim [n_images, HEIGHT, WIDTH, BANDS] with expected shape (n, 512, 512, 3). For some reason my
-            exported model only allows input arrays of shape (1, 512, 512, 3). For this reason I need to loop over each image chip array and pad the first dimension.
-            I should be able to just concatenate all the image chip arrays along the first axis and feed into model() as a single batch.
+                load_model() function), or a DynamicBatcher wrapping one.
+      -  CONFIDENCE_THRESHOLD: detections with scores below this value are dropped.
+      -  batch_size: the number of image chips to send through the model per call. Models exported with the stock TFODAPI exporter only accept
+           a batch of 1 (see export_batched_model()), in which case each image chip is run through the model individually.
+      -  on_batch: an optional function called with the {image chip name: detections} of each batch as soon as it is done (e.g. to report
+           progress). Exceptions it raises stop inference.
     '''
-    
+    if model.supported_batch_size is not None:
+        batch_size = min(batch_size, model.supported_batch_size)
+    batch_size = max(batch_size, 1)
+
+    chips = iter(dict_of_tensors.items() if isinstance(dict_of_tensors, dict) else dict_of_tensors)
+
     results = {}
-    for k, v in dict_of_tensors.items():
-        individual_results = {}
-        
-        padded_tensor = v[tf.newaxis, ...]
-
-        detections = model(padded_tensor) # Run model inference
-
-        detection_scores = detections['detection_scores'][0].numpy() 
-        individual_results['scores'] = detection_scores[detection_scores >= CONFIDENCE_THRESHOLD].tolist()
-
-        detection_bboxes = detections['detection_boxes'][0].numpy()[detection_scores >= CONFIDENCE_THRESHOLD].tolist()
-        individual_results['bboxes'] = denormalize_coordinates(detection_bboxes)
-        
-        individual_results['classes'] = detections['detection_classes'][0].numpy()[detection_scores >= CONFIDENCE_THRESHOLD].astype('uint8').tolist()
-       
-        results[k] = individual_results
-        
-    return results
\ No newline at end of file
+    while True:
+        batch = list(islice(chips, batch_size))
+        if not batch:
+            break
+
+        if len(batch) == 1:
+            batch_tensor = np.ascontiguousarray(batch[0][1])[np.newaxis, ...]
+        else:
+            batch_tensor = np.stack([v for _, v in batch])
+
+        detections = model(batch_tensor) # Run model inference
+        detections = {k: np.asarray(detections[k]) for k in ('detection_scores', 'detection_boxes', 'detection_classes')}
+
+        batch_results = {k: format_detections(detections, i, CONFIDENCE_THRESHOLD, *batch_tensor.shape[1:3]) for i, (k, _) in enumerate(batch)}
+        results.update(batch_results)
+        if on_batch is not None:
+            on_batch(batch_results)
+
+    return results
@@ -0,0 +1,256 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETE = 'complete'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_FINISHED = (JOB_COMPLETE, JOB_FAILED, JOB_CANCELLED)
+
+class JobQueueFull(Exception):
+    '''
+    Raised by JobManager.submit() when the number of queued and running jobs has reached the manager's limit.
+    '''
+    pass
+
+class JobCancelled(Exception):
+    '''
+    Raised by JobManager.raise_if_cancelled() inside a job whose cancellation has been requested, to stop it at the next checkpoint.
+    '''
+    pass
+
+class JobManager:
+    '''
+    A small in-process job queue. Each submitted job gets its own workspace folder (chips, final outputs and result zip) under
+    jobs_root, so concurrent jobs never share or clean up each other's files. Work is handed to a bounded pool of background
+    worker threads, and the number of queued + running jobs is capped by max_pending_jobs.
+
+    -  INPUTS:
+      -  jobs_root: the folder under which per-job workspaces are created.
+      -  max_workers: the number of jobs processed concurrently.
+      -  max_pending_jobs: the maximum number of jobs that can be queued or running at once.
+      -  max_retained_jobs: the number of finished jobs (and their workspaces) kept on disk before the oldest are removed.
+      -  max_events_per_job: the number of progress events kept per job. Once a job has recorded more, its oldest events are dropped.
+      -  transient_events: names of events (e.g. bulky per-chip detections) that are only kept while a job runs. Whenever a job finishes,
+           they are dropped from jobs that finished over transient_event_seconds ago, so late subscribers still get those jobs' other events.
+    '''
+    def __init__(self, jobs_root, max_workers=2, max_pending_jobs=16, max_retained_jobs=50, max_events_per_job=10_000, transient_events=(),
+                 transient_event_seconds=60):
+        self.jobs_root = jobs_root
+        self.max_pending_jobs = max_pending_jobs
+        self.max_retained_jobs = max_retained_jobs
+        self.max_events_per_job = max_events_per_job
+        self.transient_events = set(transient_events)
+        self.transient_event_seconds = transient_event_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='detection-job')
+        self.jobs = {}
+        self.events = {}
+        self.next_event_id = {}
+        self.cancel_requested = set()
+        self.lock = threading.Lock()
+
+    def workspace(self, job_id) -> dict:
+        '''
+        Returns the paths that make up a job's workspace.
+        '''
+        job_dir = os.path.join(self.jobs_root, job_id)
+        return {'job_id': job_id,
+                'job_dir': job_dir,
+                'chip_dir': os.path.join(job_dir, 'chips'),
+                'output_dir': os.path.join(job_dir, 'final_outputs'),
+                'zip_base': os.path.join(job_dir, 'api_outputs')}
+
+    def submit(self, fn, *args, **kwargs) -> str:
+        '''
+        Creates a job workspace and queues fn(workspace, *args, **kwargs) on the worker pool. Returns the new job's id.
+        '''
+        with self.lock:
+            pending = [j for j in self.jobs.values() if j['status'] in (JOB_QUEUED, JOB_RUNNING)]
+            if len(pending) >= self.max_pending_jobs:
+                raise JobQueueFull(f"{len(pending)} jobs are already queued or running.")
+
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'job_id': job_id, 'status': JOB_QUEUED, 'created': time.time(),
+                                 'started': None, 'finished': None, 'error': None, 'outputs': [], 'timings': {}}
+            self.events[job_id] = deque(maxlen=self.max_events_per_job)
+            self.next_event_id[job_id] = 0
+
+        workspace = self.workspace(job_id)
+        os.makedirs(workspace['chip_dir'], exist_ok=True)
+        os.makedirs(workspace['output_dir'], exist_ok=True)
+
+        self.executor.submit(self._run, job_id, workspace, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, workspace, fn, args, kwargs) -> None:
+        self._update(job_id, status=JOB_RUNNING, started=time.time())
+        try:
+            fn(workspace, *args, **kwargs)
+        except JobCancelled:
+            print(f"Job {job_id} was cancelled.")
+            self._update(job_id, status=JOB_CANCELLED, finished=time.time())
+        except Exception as e:
+            print(f"Job {job_id} failed: {e!r}")
+            self._update(job_id, status=JOB_FAILED, finished=time.time(), error=str(e))
+        else:
+            self._update(job_id, status=JOB_COMPLETE, finished=time.time())
+        finally:
+            shutil.rmtree(workspace['chip_dir'], ignore_errors=True)
+            with self.lock:
+                self.cancel_requested.discard(job_id)
+            self._evict_finished_jobs()
+
+    def _update(self, job_id, **fields) -> None:
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def _evict_finished_jobs(self) -> None:
+        with self.lock:
+            finished = sorted((j for j in self.jobs.values() if j['status'] in JOB_FINISHED), key=lambda j: j['finished'])
+            evicted = finished[:max(len(finished) - self.max_retained_jobs, 0)]
+            for job in evicted:
+                del self.jobs[job['job_id']]
+                del self.events[job['job_id']]
+                del self.next_event_id[job['job_id']]
+
+            if self.transient_events:
+                cutoff = time.time() - self.transient_event_seconds
+                for job in finished[len(evicted):]:
+                    events = self.events[job['job_id']]
+                    if job['finished'] < cutoff and any(e[1] in self.transient_events for e in events):
+                        self.events[job['job_id']] = deque((e for e in events if e[1] not in self.transient_events), maxlen=events.maxlen)
+
+        for job in evicted:
+            shutil.rmtree(self.workspace(job['job_id'])['job_dir'], ignore_errors=True)
+
+    def add_outputs(self, job_id, filenames) -> None:
+        '''
+        Records output files (names relative to the job's output_dir) as finished, making them available to results streams.
+        '''
+        with self.lock:
+            self.jobs[job_id]['outputs'].extend(filenames)
+
+    def add_timings(self, job_id, timings) -> None:
+        '''
+        Adds a dictionary of stage name -> seconds to the job's running per-stage totals.
+        '''
+        with self.lock:
+            job_timings = self.jobs[job_id]['timings']
+            for stage, seconds in timings.items():
+                job_timings[stage] = job_timings.get(stage, 0.0) + seconds
+
+    def add_event(self, job_id, event, data) -> None:
+        '''
+        Records a progress event (an event name and a JSON-serializable dictionary) on the job, making it available to event streams.
+        Events are numbered in the order they are recorded.
+        '''
+        with self.lock:
+            self.events[job_id].append((self.next_event_id[job_id], event, data))
+            self.next_event_id[job_id] += 1
+
+    def iter_events(self, job_id, start=0, poll_interval=0.2, heartbeat_interval=15):
+        '''
+        A generator that yields a job's events as (event id, event name, data) tuples as they are recorded, starting from event id `start`,
+        and returns once the job is finished and every event has been yielded. None is yielded whenever no event has been recorded for
+        heartbeat_interval seconds, so callers can keep idle connections alive. Events already dropped from the job's buffer (see
+        max_events_per_job and transient_events) are skipped.
+        '''
+        sent = start
+        last_yield = time.monotonic()
+        while True:
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return
+                # Read together with the status, so every event recorded before the job finished is seen before returning.
+                status = job['status']
+                events = [e for e in self.events[job_id] if e[0] >= sent]
+
+            for event_id, event, data in events:
+                yield event_id, event, data
+                sent = event_id + 1
+
+            if status in JOB_FINISHED:
+                return
+            if events:
+                last_yield = time.monotonic()
+            elif time.monotonic() - last_yield >= heartbeat_interval:
+                yield None
+                last_yield = time.monotonic()
+            time.sleep(poll_interval)
+
+    def cancel(self, job_id) -> bool:
+        '''
+        Requests that a queued or running job stop. The job stops the next time it calls raise_if_cancelled() and is then marked cancelled.
+        Returns False if the job is unknown or already finished.
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] in JOB_FINISHED:
+                return False
+            self.cancel_requested.add(job_id)
+            return True
+
+    def raise_if_cancelled(self, job_id) -> None:
+        '''
+        Raises JobCancelled if cancel() has been called for the job. Called by jobs at points where they can stop cleanly.
+        '''
+        with self.lock:
+            if job_id in self.cancel_requested:
+                raise JobCancelled(f"Job {job_id} was cancelled.")
+
+    def count(self, status) -> int:
+        '''
+        Returns the number of known jobs with the given status (e.g. JOB_QUEUED for the current queue depth).
+        '''
+        with self.lock:
+            return sum(1 for j in self.jobs.values() if j['status'] == status)
+
+    def get(self, job_id):
+        '''
+        Returns a copy of a job's status record, or None if the job id is unknown.
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job, outputs=list(job['outputs']), timings=dict(job['timings'])) if job is not None else None
+
+    def iter_outputs(self, job_id, poll_interval=0.2):
+        '''
+        A generator that yields (file path, file name) tuples for a job's output files as they are finished, and returns once the job
+        is finished and every recorded output has been yielded.
+        '''
+        output_dir = self.workspace(job_id)['output_dir']
+        sent = 0
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+
+            for filename in job['outputs'][sent:]:
+                yield os.path.join(output_dir, filename), filename
+            sent = len(job['outputs'])
+
+            if job['status'] in JOB_FINISHED:
+                return
+            time.sleep(poll_interval)
+
+    def latest_complete(self):
+        '''
+        Returns the status record of the most recently finished successful job, or None.
+        '''
+        with self.lock:
+            complete = [j for j in self.jobs.values() if j['status'] == JOB_COMPLETE]
+            job = max(complete, key=lambda j: j['finished']) if complete else None
+            return dict(job, outputs=list(job['outputs']), timings=dict(job['timings'])) if job is not None else None
+
+    def results_path(self, job_id) -> str:
+        '''
+        Returns the path of a job's result zip file.
+        '''
+        return self.workspace(job_id)['zip_base'] + '.zip'
@@ -0,0 +1,139 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the buckets used for latency histograms.
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# Starlette appends '; charset=utf-8' to text responses.
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+class Counter:
+    '''
+    A monotonically increasing count, optionally split by label values (e.g. counter.inc(3, stage='chip')).
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self.lock:
+            return [(self.name, dict(key), value) for key, value in sorted(self.values.items())]
+
+class Gauge:
+    '''
+    A value that can go up and down, read from a callback each time the metrics are rendered (e.g. the current length of a queue).
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, fn):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def samples(self) -> list:
+        return [(self.name, {}, self.fn())]
+
+class Histogram:
+    '''
+    Counts observations (e.g. stage durations in seconds) into cumulative buckets, optionally split by label values.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self) -> list:
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ['+Inf'], counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', dict(labels, le=bound), cumulative))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+class MetricsRegistry:
+    '''
+    A minimal registry of counters, gauges and histograms that renders them in the Prometheus text exposition format for a /metrics endpoint.
+    '''
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name, documentation, fn) -> Gauge:
+        return self._register(Gauge(name, documentation, fn))
+
+    def histogram(self, name, documentation, buckets=SECONDS_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+@contextmanager
+def span(timings, name):
+    '''
+    Times the enclosed block and adds its duration (in seconds) to timings[name], so the spans of one image or request can be collected in a
+    plain dictionary (which survives being passed between pipeline processes) and observed into histograms later.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def timed_iter(iterable, timings, name):
+    '''
+    Wraps an iterable (such as a lazy chip generator) and adds the time spent producing its items to timings[name]. The time the consumer
+    spends between items is not counted.
+    '''
+    iterator = iter(iterable)
+    while True:
+        with span(timings, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,134 @@
+import json
+
+import numpy as np
+
+# The columns of a detection dictionary: an (N, 4) int32 array of [ymin, xmin, ymax, xmax] pixel bboxes, and length N float32 scores and
+# uint8 class IDs. Any other keys (such as 'skipped_chips') are per-image metadata.
+DETECTION_KEYS = ('bboxes', 'scores', 'classes')
+
+OUTPUT_FORMATS = ('json', 'npz', 'coco')
+
+def empty_detections() -> dict:
+    return {'bboxes': np.zeros((0, 4), dtype=np.int32), 'scores': np.zeros(0, dtype=np.float32), 'classes': np.zeros(0, dtype=np.uint8)}
+
+def detections_to_lists(detection_dict) -> dict:
+    '''
+    Converts a detection dictionary's columns to plain Python lists for JSON serialization. Only done at the output boundary.
+    '''
+    return {k: np.asarray(v).tolist() if k in DETECTION_KEYS else v for k, v in detection_dict.items()}
+
+def results_filename(base_img_name, output_format) -> str:
+    '''
+    Returns the name of an image's results file in the given output format.
+    '''
+    return {'json': f"{base_img_name}_inference_results.json",
+            'npz': f"{base_img_name}_inference_results.npz",
+            'coco': f"{base_img_name}_inference_results_coco.json"}[output_format]
+
+def write_json(path, results) -> None:
+    '''
+    Writes a dictionary of image name -> detection dictionary as (compact) JSON lists, the API's original results format.
+    '''
+    with open(path, 'w') as outfile:
+        json.dump({k: detections_to_lists(v) for k, v in results.items()}, outfile, separators=(',', ':'))
+
+def write_npz(path, results) -> None:
+    '''
+    Writes a dictionary of image name -> detection dictionary as a compressed NumPy .npz file of flat, columnar arrays: every image's
+    detections are concatenated into single bboxes/scores/classes arrays, with image_index pointing into image_names. Skipped chips are
+    stored the same way (skipped_chip_image_index, skipped_chip_names, skipped_chip_reasons). Load with np.load() or read_npz().
+    '''
+    names = list(results)
+    detections = [results[k] for k in names]
+    skipped = [(i, c['chip'], c['reason']) for i, d in enumerate(detections) for c in d.get('skipped_chips', [])]
+
+    np.savez_compressed(path,
+                        image_names=np.array(names, dtype=str),
+                        image_index=np.repeat(np.arange(len(names), dtype=np.int32), [len(d['scores']) for d in detections]),
+                        bboxes=np.concatenate([np.asarray(d['bboxes'], dtype=np.int32).reshape(-1, 4) for d in detections] or [np.zeros((0, 4), np.int32)]),
+                        scores=np.concatenate([np.asarray(d['scores'], dtype=np.float32) for d in detections] or [np.zeros(0, np.float32)]),
+                        classes=np.concatenate([np.asarray(d['classes'], dtype=np.uint8) for d in detections] or [np.zeros(0, np.uint8)]),
+                        skipped_chip_image_index=np.array([s[0] for s in skipped], dtype=np.int32),
+                        skipped_chip_names=np.array([s[1] for s in skipped], dtype=str),
+                        skipped_chip_reasons=np.array([s[2] for s in skipped], dtype=str))
+
+def read_npz(path) -> dict:
+    '''
+    Reads a file written by write_npz() back into a dictionary of image name -> detection dictionary (with a 'skipped_chips' list).
+    '''
+    with np.load(path) as npz:
+        columns = {k: npz[k] for k in npz.files}
+
+    results = {}
+    for i, name in enumerate(columns['image_names'].tolist()):
+        in_image = columns['image_index'] == i
+        skipped = columns['skipped_chip_image_index'] == i
+        results[name] = {'bboxes': columns['bboxes'][in_image], 'scores': columns['scores'][in_image], 'classes': columns['classes'][in_image],
+                         'skipped_chips': [{'chip': c, 'reason': r} for c, r in zip(columns['skipped_chip_names'][skipped].tolist(),
+                                                                                   columns['skipped_chip_reasons'][skipped].tolist())]}
+    return results
+
+def write_coco(path, results, image_sizes, cat_index) -> None:
+    '''
+    Writes a dictionary of image name -> detection dictionary as a COCO-style JSON file with 'images', 'annotations' (bbox as
+    [x, y, width, height], plus score) and 'categories' sections.
+
+    -  INPUTS:
+      -  image_sizes: a dictionary of image name -> (width, height).
+      -  cat_index: the category index returned by drawing_utils.category_index().
+    '''
+    images, annotations = [], []
+    for image_id, (name, detections) in enumerate(results.items(), start=1):
+        width, height = image_sizes[name]
+        images.append({'id': image_id, 'file_name': name, 'width': width, 'height': height})
+
+        ymin, xmin, ymax, xmax = np.asarray(detections['bboxes'], dtype=np.int64).reshape(-1, 4).T
+        box_width, box_height = xmax - xmin, ymax - ymin
+        start = len(annotations) + 1
+        annotations.extend({'id': start + i, 'image_id': image_id, 'category_id': c, 'bbox': [x, y, w, h], 'area': w * h, 'score': s, 'iscrowd': 0}
+                           for i, (c, x, y, w, h, s) in enumerate(zip(np.asarray(detections['classes']).tolist(), xmin.tolist(), ymin.tolist(),
+                                                                      box_width.tolist(), box_height.tolist(), np.asarray(detections['scores']).tolist())))
+
+    categories = [{'id': k, 'name': v['name']} for k, v in sorted(cat_index.items())]
+    with open(path, 'w') as outfile:
+        json.dump({'images': images, 'annotations': annotations, 'categories': categories}, outfile, separators=(',', ':'))
+
+def overlay_filename(base_img_name) -> str:
+    return f"{base_img_name}_overlay.geojson"
+
+def write_overlay(path, detection_dict, cat_index, image_size=None) -> None:
+    '''
+    Writes an image's detections as a lightweight GeoJSON FeatureCollection of box polygons, to be drawn as a toggleable vector layer over
+    the image's tile pyramid. Coordinates are [x, y] image pixels (not geographic), so viewers should use a simple pixel CRS. Each feature's
+    properties hold its class_id, class_name and score.
+
+    -  INPUTS:
+      -  cat_index: the category index returned by drawing_utils.category_index().
+      -  image_size: the image's (width, height), stored on the collection so viewers can set up their pixel extent.
+    '''
+    ymin, xmin, ymax, xmax = np.asarray(detection_dict['bboxes'], dtype=np.int64).reshape(-1, 4).T.tolist()
+    features = [{'type': 'Feature',
+                 'geometry': {'type': 'Polygon', 'coordinates': [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]},
+                 'properties': {'class_id': c, 'class_name': cat_index.get(c, {'name': str(c)})['name'], 'score': round(s, 4)}}
+                for x0, y0, x1, y1, c, s in zip(xmin, ymin, xmax, ymax, np.asarray(detection_dict['classes']).tolist(),
+                                                np.asarray(detection_dict['scores']).tolist())]
+
+    collection = {'type': 'FeatureCollection', 'features': features}
+    if image_size is not None:
+        collection['properties'] = {'width': image_size[0], 'height': image_size[1]}
+    with open(path, 'w') as outfile:
+        json.dump(collection, outfile, separators=(',', ':'))
+
+def write_results(path, results, output_format='json', image_sizes=None, cat_index=None) -> None:
+    '''
+    Writes an image's results in one of OUTPUT_FORMATS: 'json' (the original dictionary of lists), 'npz' (columnar NumPy arrays, see
+    write_npz()) or 'coco' (COCO-style JSON, which also needs image_sizes and cat_index).
+    '''
+    if output_format == 'json':
+        write_json(path, results)
+    elif output_format == 'npz':
+        write_npz(path, results)
+    elif output_format == 'coco':
+        write_coco(path, results, image_sizes, cat_index)
+    else:
+        raise ValueError(f"Unknown output format '{output_format}'. Expected one of {OUTPUT_FORMATS}.")
@@ -0,0 +1,101 @@
+import queue
+import threading
+from collections import namedtuple
+
+Stage = namedtuple('Stage', ['name', 'fn', 'workers', 'executor'], defaults=[1, None])
+Stage.__doc__ = '''
+A single step of a StagedPipeline.
+
+-  name: a short name used in log messages.
+-  fn: a function that takes one item and returns the item to hand to the next stage.
+-  workers: the number of threads pulling items for this stage.
+-  executor: an optional concurrent.futures executor (e.g. a ProcessPoolExecutor) that fn is submitted to. When None, fn runs directly
+     on the stage's worker threads. fn and its items must be picklable when a process pool is used.
+'''
+
+_STOP = object()
+
+class StagedPipeline:
+    '''
+    Runs items through a sequence of stages, where each stage has its own pool of worker threads and stages are connected by bounded
+    queues. Every stage works on a different item at the same time (e.g. image N+1 is decoded while image N is in inference), and the
+    bounded queues stop fast stages from running too far ahead of slow ones.
+
+    If any stage raises, the remaining items are drained without being processed and the first exception is re-raised by run().
+
+    -  INPUTS:
+      -  stages: a list of Stage tuples, in order.
+      -  queue_size: the maximum number of items waiting in front of each stage.
+    '''
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items) -> list:
+        '''
+        Feeds items through every stage and returns the outputs of the final stage (in completion order).
+        '''
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        outputs = []
+        errors = []
+        abort = threading.Event()
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            next_queue = queues[i + 1] if i + 1 < len(self.stages) else None
+            remaining = [stage.workers]
+            remaining_lock = threading.Lock()
+            for w in range(stage.workers):
+                t = threading.Thread(target=self._worker, name=f"pipeline-{stage.name}-{w}",
+                                     args=(stage, queues[i], next_queue, outputs, errors, abort, remaining, remaining_lock),
+                                     daemon=True)
+                t.start()
+                threads.append(t)
+
+        for item in items:
+            if abort.is_set():
+                break
+            queues[0].put(item)
+        queues[0].put(_STOP)
+
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
+        return outputs
+
+    @staticmethod
+    def _worker(stage, in_queue, out_queue, outputs, errors, abort, remaining, remaining_lock) -> None:
+        while True:
+            item = in_queue.get()
+
+            if item is _STOP:
+                # Pass the stop signal to this stage's other workers, and the last worker to exit forwards it downstream.
+                in_queue.put(_STOP)
+                with remaining_lock:
+                    remaining[0] -= 1
+                    last_worker = remaining[0] == 0
+                if last_worker and out_queue is not None:
+                    out_queue.put(_STOP)
+                return
+
+            if abort.is_set():
+                continue
+
+            try:
+                if stage.executor is not None:
+                    result = stage.executor.submit(stage.fn, item).result()
+                else:
+                    result = stage.fn(item)
+            except Exception as e:
+                print(f"Pipeline stage '{stage.name}' failed: {e!r}")
+                errors.append(e)
+                abort.set()
+                continue
+
+            if out_queue is not None:
+                out_queue.put(result)
+            else:
+                outputs.append(result)
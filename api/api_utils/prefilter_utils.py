@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+
+# Reasons reported for skipped chips in the results JSON and in ChipPrefilter.stats().
+SKIP_PADDING = 'padding'
+SKIP_UNIFORM = 'uniform'
+SKIP_HISTOGRAM = 'histogram'
+
+class ChipPrefilter:
+    '''
+    A cheap check run on every image chip before inference that drops chips which cannot contain marine debris: chips that are mostly
+    the all-black padding added at the right and bottom image edges, and chips of near-uniform open water, sand or sky. Statistics are
+    computed on a strided, downsampled view of the chip (every `stride`-th pixel), so the check costs a tiny fraction of a forward pass.
+
+    Running counters of chips seen, skipped and inferred (and the time spent on inference) are kept across all jobs so stats() can
+    report how much inference the prefilter saved.
+
+    -  INPUTS:
+      -  max_padding_fraction: chips whose fraction of all-zero pixels is at least this value are skipped. None disables the check.
+      -  min_std: chips whose largest per-band standard deviation (over non-padding pixels) is below this value are skipped as
+           uniform. None disables the check.
+      -  histogram_bins, max_histogram_peak: when both are set, chips whose grayscale histogram (with histogram_bins bins) has a
+           single bin holding at least max_histogram_peak of the pixels are skipped. Disabled by default.
+      -  stride: the step between sampled pixels in each dimension.
+    '''
+    def __init__(self, max_padding_fraction=0.95, min_std=2.0, histogram_bins=None, max_histogram_peak=None, stride=4):
+        self.max_padding_fraction = max_padding_fraction
+        self.min_std = min_std
+        self.histogram_bins = histogram_bins
+        self.max_histogram_peak = max_histogram_peak
+        self.stride = stride
+
+        self.stats_lock = threading.Lock()
+        self.n_seen = 0
+        self.skipped_counts = {SKIP_PADDING: 0, SKIP_UNIFORM: 0, SKIP_HISTOGRAM: 0}
+        self.n_inferred = 0
+        self.inference_seconds = 0.0
+
+    def config(self) -> dict:
+        '''
+        Returns the prefilter's thresholds. These change which chips reach the model, so they are part of the detection cache key.
+        '''
+        return {'max_padding_fraction': self.max_padding_fraction, 'min_std': self.min_std, 'histogram_bins': self.histogram_bins,
+                'max_histogram_peak': self.max_histogram_peak, 'stride': self.stride}
+
+    def skip_reason(self, chip_array):
+        '''
+        Returns why a (HEIGHT, WIDTH, 3) uint8 chip should be skipped (SKIP_PADDING, SKIP_UNIFORM or SKIP_HISTOGRAM), or None if it
+        should go through inference.
+        '''
+        sample = np.asarray(chip_array)[::self.stride, ::self.stride].reshape(-1, 3)
+        content = sample[sample.any(axis=1)]
+
+        if self.max_padding_fraction is not None and 1 - len(content) / len(sample) >= self.max_padding_fraction:
+            return SKIP_PADDING
+        if len(content) == 0:
+            return SKIP_PADDING
+
+        if self.min_std is not None and content.std(axis=0).max() < self.min_std:
+            return SKIP_UNIFORM
+
+        if self.histogram_bins and self.max_histogram_peak is not None:
+            gray = content.mean(axis=1)
+            hist = np.bincount(np.minimum((gray * self.histogram_bins / 256).astype(int), self.histogram_bins - 1), minlength=self.histogram_bins)
+            if hist.max() / len(content) >= self.max_histogram_peak:
+                return SKIP_HISTOGRAM
+
+        return None
+
+    def filter(self, chips, skipped):
+        '''
+        A generator that passes through the (chip name, chip array) tuples from chips (e.g. iter_chips()) that should be inferred, and
+        appends a {'chip': chip name, 'reason': skip reason} dictionary to the skipped list for every chip that is dropped.
+        '''
+        for chip_name, chip_array in chips:
+            reason = self.skip_reason(chip_array)
+            with self.stats_lock:
+                self.n_seen += 1
+                if reason is not None:
+                    self.skipped_counts[reason] += 1
+
+            if reason is None:
+                yield chip_name, chip_array
+            else:
+                skipped.append({'chip': chip_name, 'reason': reason})
+
+    def record_inference(self, n_chips, seconds) -> None:
+        '''
+        Records that n_chips chips went through inference in `seconds`, which is used to estimate the time saved by skipped chips.
+        '''
+        with self.stats_lock:
+            self.n_inferred += n_chips
+            self.inference_seconds += seconds
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            n_skipped = sum(self.skipped_counts.values())
+            seconds_per_chip = self.inference_seconds / self.n_inferred if self.n_inferred else 0.0
+            return {**self.config(),
+                    'chips_seen': self.n_seen,
+                    'chips_skipped': n_skipped,
+                    'chips_skipped_by_reason': dict(self.skipped_counts),
+                    'skipped_fraction': n_skipped / self.n_seen if self.n_seen else 0.0,
+                    'chips_inferred': self.n_inferred,
+                    'mean_inference_seconds_per_chip': seconds_per_chip,
+                    'estimated_inference_seconds_saved': n_skipped * seconds_per_chip}
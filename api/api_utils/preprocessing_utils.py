@@ -1,23 +1,30 @@
 from typing import Tuple
 from PIL import Image
 from io import BytesIO
+import cv2
 import numpy as np
 import os
 
-def ingest_image(image_encoded) -> Image.Image:
+from api.api_utils.output_utils import empty_detections
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+def ingest_image(image_encoded, convert_to_rgb=True) -> Image.Image:
     '''
     A simple function that opens a ByteEncoded image (received via POST request), opens as a PIL Image.Image, converts
     to a 3-band RGB image if neccecary, and returns 3-band PIL Image.Image.
 
     -  INPUTS: 
-      -  Encoded Image
+      -  Encoded Image (bytes), or the path to an image file spooled to disk
+      -  convert_to_rgb: when False, non-RGB images are returned unconverted (and not yet decoded), for prepare_resample_source() to
+           convert once the image has been reduced.
     
     -  OUTPUTS:
-      -  3-band RGB PIL Image.Image object
+      -  3-band RGB PIL Image.Image object (or the lazily opened image when convert_to_rgb is False)
     '''
-    img = Image.open(BytesIO(image_encoded))
+    img = Image.open(BytesIO(image_encoded) if isinstance(image_encoded, bytes) else image_encoded)
 
-    if(img.mode!='RGB'):
+    if convert_to_rgb and img.mode != 'RGB':
         print("Converting to RGB!")
         img = img.convert("RGB")
     
@@ -46,104 +53,509 @@ def calc_gsd(flight_agl_meters, sensor_focal_length_mm, image_height, image_widt
     
     return (gsd_h, gsd_w)
 
-def dont_resize_to_gsd(input_image, temp_output_path) -> Image.Image:
-  '''
-  This function is run in lieu of resize_to_gsd. It simply saves the original image to a disk.
-  -  INPUTS:
-    -  input_image: A 3-band PIL Image.Image. This is generally expected to have been generated by the ingest_image() function.
-  - OUTPUTS:
-    -  A unprocessed PIL Image.Image object saved to the /app/chips/ folder and returned to the user.
-  '''
+def resampled_size(image_width, image_height, estimated_gsd_cm, target_gsd_cm=2.0) -> Tuple:
+    '''
+    Computes the (width, height) an image with the given estimated GSD will have once resampled to target_gsd_cm, using the project's
+    upscale factor between the estimated and target GSD. The result is passed to the fused resample-and-chip path (iter_resampled_chips()).
+    '''
+    upscale_factor = (estimated_gsd_cm - target_gsd_cm) / target_gsd_cm
 
-  input_image.save(temp_output_path)
-  return input_image
+    output_width = int(image_width + (image_width * upscale_factor))
+    output_height = int(image_height + (image_height * upscale_factor))
+    return (output_width, output_height)
 
+def tile_array(image_array, desired_height=512, desired_width=512) -> Tuple:
+    '''
+    Splits a 3-D (HEIGHT, WIDTH, BANDS) image array into a grid of desired_height x desired_width tiles without copying the image. Interior
+    tiles are strided views into image_array. Only the ragged right and bottom edge strips (if any) are copied once and padded with black
+    pixels, and edge tiles are strided views into those padded strips.
 
-def resize_to_gsd(input_image, estimated_gsd_cm, temp_output_path, target_gsd_cm=2.0) -> Image.Image:
+    -  INPUTS:
+      -  image_array: a 3-D numpy array of the image.
+      -  desired_height, desired_width: the tile dimensions in pixels.
+
+    -  OUTPUTS:
+      -  A tuple of (n_rows, n_cols, get_tile), where get_tile(row, col) returns the tile at that grid position as a
+           (desired_height, desired_width, BANDS) array view.
     '''
-    A simple function that computes a scaling factor between the non-georeferenced input image's estimated GSD and the project's target GSD and
-    applies the computed scaling factor to the original image. The result is a resampled image with GSD matching this project's target of 2.0cm.
+    img_height, img_width, n_bands = image_array.shape
+    full_rows, full_cols = img_height // desired_height, img_width // desired_width
+    n_rows, n_cols = -(-img_height // desired_height), -(-img_width // desired_width)
+
+    # (full_rows, full_cols, desired_height, desired_width, bands) view over the part of the image covered by whole tiles.
+    core = image_array[:full_rows * desired_height, :full_cols * desired_width]
+    core_tiles = core.reshape(full_rows, desired_height, full_cols, desired_width, n_bands).swapaxes(1, 2)
+
+    right_tiles = None
+    if n_cols > full_cols:
+        right_strip = image_array[:, full_cols * desired_width:]
+        right_strip = np.pad(right_strip, ((0, n_rows * desired_height - img_height), (0, desired_width - right_strip.shape[1]), (0, 0)))
+        right_tiles = right_strip.reshape(n_rows, desired_height, desired_width, n_bands)
+
+    bottom_tiles = None
+    if n_rows > full_rows and full_cols > 0:
+        bottom_strip = image_array[full_rows * desired_height:, :full_cols * desired_width]
+        bottom_strip = np.pad(bottom_strip, ((0, desired_height - bottom_strip.shape[0]), (0, 0), (0, 0)))
+        bottom_tiles = bottom_strip.reshape(desired_height, full_cols, desired_width, n_bands).swapaxes(0, 1)
+
+    def get_tile(row, col):
+        if col >= full_cols:
+            return right_tiles[row]
+        if row >= full_rows:
+            return bottom_tiles[col]
+        return core_tiles[row, col]
+
+    return n_rows, n_cols, get_tile
+
+def _axis_tile_positions(length, tile_length, overlap=None) -> np.ndarray:
+    if overlap is None:
+        return np.arange(0, length, tile_length)
+    if length <= tile_length:
+        return np.array([0])
+
+    # The fewest tiles that cover the axis with at least `overlap` pixels shared between neighbours, spread evenly so the last tile ends
+    # exactly at the image edge (no padding).
+    n_tiles = int(np.ceil((length - overlap) / (tile_length - overlap)))
+    return np.round(np.linspace(0, length - tile_length, n_tiles)).astype(int)
+
+def tile_offsets(image_height, image_width, base_img_name, base_img_ext, desired_height=512, desired_width=512, overlap=None) -> dict:
+    '''
+    Plans the chip layout of an image and returns a dictionary mapping each chip's unique name ("imageBasename_topLeftPixelY_topLeftPixelX.jpg")
+    to its (top, left) pixel offset, in row-major order.
+
+    When overlap is None this is the original non-overlapping grid, where chips on the right and bottom edges are padded. When overlap is
+    an integer, chips share at least `overlap` pixels with their neighbours, so objects on a seam are seen whole by at least one chip, and
+    the grid is spread so that no chip hangs over the image edge (chips are only padded when the image is smaller than a chip).
 
     -  INPUTS:
-      -  input_image: A 3-band PIL Image.Image. This is generally expected to have been generated by the ingest_image() function.
-      -  estimated_gsd_cm: The input_image's estimated ground spacing distance (GSD) in centimeters. This value is generally expected to have been
-           computed by the calc_gsd() function.
-      -  target_gsd_cm: The project's target ground spacing distance (GSD). The output image will be reampled to this GSD. This value defaults to
-           the project's target GSD of 2.0 cm. 
-    
-    - OUTPUTS:
-      -  A resampled PIL Image.Image object saved to the /app/chips/ folder and returned to the user.
+      -  image_height, image_width: the dimensions of the image being chipped.
+      -  base_img_name, base_img_ext: the filename and extension associated with the image, used to build each unique chip name.
+      -  desired_height, desired_width: the image chip dimensions in pixels.
+      -  overlap: the minimum overlap in pixels between neighbouring chips, or None for the original non-overlapping grid.
     '''
-    upscale_factor = (estimated_gsd_cm - target_gsd_cm) / target_gsd_cm
+    tops = _axis_tile_positions(image_height, desired_height, overlap)
+    lefts = _axis_tile_positions(image_width, desired_width, overlap)
 
-    output_width = int(input_image.width + (input_image.width * upscale_factor))
-    output_height = int(input_image.height + (input_image.height * upscale_factor))
-    new_size = (output_width, output_height)
-    
-    new_im = input_image.resize(new_size)
-    
-    new_im.save(temp_output_path)
-    return new_im
+    return {f"{base_img_name}_{top}_{left}{base_img_ext}": (int(top), int(left)) for top in tops for left in lefts}
+
+def count_chips(image_height, image_width, desired_height=512, desired_width=512, overlap=None) -> int:
+    '''
+    Returns the number of chips tile_offsets() plans for an image of the given size, without building their names.
+    '''
+    return len(_axis_tile_positions(image_height, desired_height, overlap)) * len(_axis_tile_positions(image_width, desired_width, overlap))
 
-def chip(im, base_img_name, base_img_ext, chip_dir, desired_height=512, desired_width=512) -> dict:
+def iter_chips(im, base_img_name, base_img_ext, desired_height=512, desired_width=512, overlap=None):
     '''
-    This function chips the pre-processed input imagery into "image chips" of desired height/width. The "image_chip" format is suitable for performing
-    model inference upon. Currently this routine simply chips the input image using no overlap. Also, image chips smaller than 512x512 are padded with 
-    black borders. The output is a dictionary where the key values are each image chips's unique name and the values are 3-D numpy arrays which represent
-    the image chip's raw pixel values. Each image chip's unique name is of the format "imageBasename_topLeftPixelY_topLeftPixelX.jpg"
+    A generator that chips the pre-processed input imagery into "image chips" of desired height/width. The image is converted to a numpy array once
+    and each chip is yielded as a view into that array (see tile_array()), so no per-chip crops or copies are made. Chips are yielded in the same order
+    and with unique names of the format "imageBasename_topLeftPixelY_topLeftPixelX.jpg". The output is designed to be fed directly into the
+    backend API's batch_inference() function.
 
     -  INPUTS:
-      -  im: a pre-processed PIL Image.Image object. This object must be 3 bands (RGB) and is expected to have been resampled to a ground spacing 
-           distance of 2.0 cm. 
-      -  base_img_name: the filename associated with im. This is used as the basename for each unique chip name.
-      -  chip_dir: the temporary directory in which to store image chips
+      -  im: a pre-processed PIL Image.Image object (or 3-D numpy array). This must be 3 bands (RGB).
+      -  base_img_name, base_img_ext: the filename and extension associated with im. These are used to build each unique chip name.
       -  desired_height, desired_width: the image chip dimensions in pixels expected by the inference model. Defaults to project value of 512x512 pixels.
-    
+      -  overlap: the minimum overlap in pixels between neighbouring chips, or None for the original non-overlapping grid (see tile_offsets()).
+
     -  OUTPUTS:
-      - chip_dict: a Python dictionary that contains each unique chip name as the keys, and the raw chip values stored as 3-D numpy arrays. This output
-          is designed to be fed directly into the backend API's batch_inference() function.
-    '''
-    img_width, img_height = im.size
-
-    chip_dict = {}
-    for i in range(0, img_height, desired_height):
-        for j in range(0, img_width, desired_width):
-            box = (j, i, j + desired_width, i + desired_height)
-            a = im.crop(box)
-
-            out_name = f"{base_img_name}_{i}_{j}{base_img_ext}"
-
-            a.save(os.path.join(chip_dir, out_name))
-            
-            chip_array = np.array(a)
-            chip_dict[out_name] = chip_array
-
-    print(f"Num of inference images: {len(chip_dict)}")
-
-    return chip_dict
-
-def reassemble_chips(inference_results_dict) -> dict:
-  merged_results_dict = {}
-  new_bboxes = []
-  new_scores = []
-  new_classes = []
-  for k, v in inference_results_dict.items():
-    chip_name, chip_ext = os.path.splitext(k)
-    base_name = '_'.join(chip_name.split('_')[:-2])
-    x_offset = int(chip_name.split('_')[-1])
-    y_offset = int(chip_name.split('_')[-2])
-
-    for bbox in v['bboxes']:
-      new_bbox = (y_offset + bbox[0], x_offset + bbox[1], y_offset + bbox[2], x_offset + bbox[3])
-      new_bboxes.append(new_bbox)
-    for score in v['scores']:
-      new_scores.append(score)
-    for classes in v['classes']:
-      new_classes.append(classes)
-    
-  merged_results_dict[base_name+chip_ext] = {'bboxes':new_bboxes, 'scores':new_scores, 'classes':new_classes}
- 
-  return merged_results_dict
+      -  yields (chip name, 3-D numpy array view of the chip) tuples.
+    '''
+    image_array = np.asarray(im)
 
+    if overlap is None:
+        n_rows, n_cols, get_tile = tile_array(image_array, desired_height, desired_width)
 
-    
+        for row in range(n_rows):
+            for col in range(n_cols):
+                out_name = f"{base_img_name}_{row * desired_height}_{col * desired_width}{base_img_ext}"
+                yield out_name, get_tile(row, col)
+        return
+
+    img_height, img_width = image_array.shape[:2]
+    offsets = tile_offsets(img_height, img_width, base_img_name, base_img_ext, desired_height, desired_width, overlap)
+
+    # Overlapping chips never hang over the image edge, so padding is only needed (once) when the image is smaller than a chip.
+    if img_height < desired_height or img_width < desired_width:
+        image_array = np.pad(image_array, ((0, max(desired_height - img_height, 0)), (0, max(desired_width - img_width, 0)), (0, 0)))
+
+    for out_name, (top, left) in offsets.items():
+        yield out_name, image_array[top:top + desired_height, left:left + desired_width]
+
+def check_resampled_size(image_size, output_size) -> None:
+    '''
+    Raises a ValueError when an image of image_size (width, height) would be resampled to less than 1 pixel wide or tall.
+    '''
+    (width, height), (output_width, output_height) = image_size, output_size
+    if output_width < 1 or output_height < 1:
+        raise ValueError(f"The {width}x{height} image would be resampled to {output_width}x{output_height} pixels, which is too small to run "
+                         f"detection on. Check the flight_AGL and sensor_platform, or skip resampling.")
+
+def prepare_resample_source(input_image, output_size) -> np.ndarray:
+    '''
+    Decodes a (lazily opened) PIL image into the smallest numpy array that can still be resampled to output_size without upscaling it
+    again. For large reductions JPEGs are decoded at 1/2, 1/4 or 1/8 scale by the decoder itself (PIL draft()), and other formats are
+    box-reduced by an integer factor (PIL reduce()), so the full-resolution image is never expanded in memory just to be shrunk.
+
+    -  INPUTS:
+      -  input_image: a PIL Image.Image, ideally not yet loaded (as returned by ingest_image(convert_to_rgb=False)). Images of any mode are
+           converted to RGB once they have been reduced.
+      -  output_size: the (width, height) the image will be resampled to, e.g. from resampled_size(). A ValueError is raised when it is
+           less than 1 pixel wide or tall.
+
+    -  OUTPUTS:
+      -  a 3-D (HEIGHT, WIDTH, 3) RGB numpy array, at least as large as output_size, to pass to iter_resampled_chips().
+    '''
+    check_resampled_size(input_image.size, output_size)
+    output_width, output_height = output_size
+
+    # reduce() can't work on palette or bilevel images, so those are converted first.
+    if input_image.mode in ('P', 'PA', '1'):
+        input_image = input_image.convert('RGB')
+
+    if input_image.format == 'JPEG' and input_image.width >= 2 * output_width and input_image.height >= 2 * output_height:
+        input_image.draft('RGB', (output_width, output_height))
+
+    reduce_factor = min(input_image.width // output_width, input_image.height // output_height)
+    if reduce_factor >= 2:
+        input_image = input_image.reduce(reduce_factor)
+
+    if input_image.mode != 'RGB':
+        input_image = input_image.convert('RGB')
+
+    return np.asarray(input_image)
+
+def iter_resampled_chips(source_array, output_size, base_img_name, base_img_ext, desired_height=512, desired_width=512, overlap=None):
+    '''
+    A generator that fuses resampling and chipping: each desired_height x desired_width chip of the resampled image is computed on demand
+    from the matching window of source_array, so the full resampled image is never materialized or written to disk. Chip names, order
+    and black edge padding match resizing the whole image to output_size (bicubic, PIL's default) and chipping it with iter_chips().
+
+    -  INPUTS:
+      -  source_array: a 3-D RGB numpy array of the image, e.g. from prepare_resample_source(), or a WindowedImage (see
+           windowed_resample_source()), in which case only the window under each chip is read from disk.
+      -  output_size: the (width, height) of the resampled image, e.g. from resampled_size().
+      -  base_img_name, base_img_ext: the filename and extension associated with the image, used to build each unique chip name.
+      -  desired_height, desired_width: the image chip dimensions in pixels expected by the inference model.
+      -  overlap: the minimum overlap in pixels between neighbouring chips, or None for the original non-overlapping grid (see tile_offsets()).
+
+    -  OUTPUTS:
+      -  yields (chip name, 3-D numpy array of the chip) tuples.
+    '''
+    if isinstance(source_array, np.ndarray):
+        src_height, src_width = source_array.shape[:2]
+        read_window = lambda top, bottom, left, right: source_array[top:bottom, left:right]
+    else:
+        src_height, src_width = source_array.height, source_array.width
+        read_window = source_array.read_window
+    output_width, output_height = output_size
+    scale_x, scale_y = output_width / src_width, output_height / src_height
+
+    offsets = tile_offsets(output_height, output_width, base_img_name, base_img_ext, desired_height, desired_width, overlap)
+    for out_name, (top, left) in offsets.items():
+        tile_height, tile_width = min(desired_height, output_height - top), min(desired_width, output_width - left)
+
+        # The source window under this chip, with a 2 pixel margin so bicubic interpolation at the chip's edges sees its neighbours.
+        src_left = max(int(left / scale_x) - 2, 0)
+        src_right = min(int(np.ceil((left + tile_width) / scale_x)) + 2, src_width)
+        src_top = max(int(top / scale_y) - 2, 0)
+        src_bottom = min(int(np.ceil((top + tile_height) / scale_y)) + 2, src_height)
+        window = read_window(src_top, src_bottom, src_left, src_right)
+
+        # Maps window pixel centers onto the chip using the same pixel-center convention as a whole-image resize, with the bicubic
+        # interpolation PIL's resize() defaults to.
+        transform = np.float32([[scale_x, 0, src_left * scale_x - left + 0.5 * scale_x - 0.5],
+                                [0, scale_y, src_top * scale_y - top + 0.5 * scale_y - 0.5]])
+        chip_array = cv2.warpAffine(window, transform, (desired_width, desired_height), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        chip_array[tile_height:] = 0
+        chip_array[:, tile_width:] = 0
+
+        yield out_name, chip_array
+
+def scale_detections(detection_dict, scale_x, scale_y) -> dict:
+    '''
+    Returns a copy of a detection dictionary with its [ymin, xmin, ymax, xmax] pixel bboxes multiplied by scale_x/scale_y. Used to map
+    detections made on a resampled image back onto the original image.
+    '''
+    bboxes = np.asarray(detection_dict['bboxes'], dtype=np.float64).reshape(-1, 4) * np.array([scale_y, scale_x, scale_y, scale_x])
+    return dict(detection_dict, bboxes=np.round(bboxes).astype(np.int32))
+
+def image_size(image_path) -> Tuple:
+    '''
+    Returns an image file's (width, height) by reading only its header, without decoding any pixels. TIFFs are read with tifffile, which
+    also handles BigTIFF orthomosaics.
+    '''
+    if os.path.splitext(image_path)[1].lower() in TIFF_EXTENSIONS:
+        import tifffile
+
+        with tifffile.TiffFile(image_path) as tif:
+            page = tif.pages[0]
+            return page.imagewidth, page.imagelength
+
+    with Image.open(image_path) as img:
+        return img.size
+
+def tiff_pixel_count(image_path):
+    '''
+    Returns the pixel count (height * width) of a TIFF file's first image by reading only its header, or None if the file is not a TIFF.
+    '''
+    if os.path.splitext(image_path)[1].lower() not in TIFF_EXTENSIONS:
+        return None
+
+    import tifffile
+
+    with tifffile.TiffFile(image_path) as tif:
+        page = tif.pages[0]
+        return page.imagelength * page.imagewidth
+
+class WindowedImage:
+    '''
+    A read-only view of a (potentially multi-gigabyte) TIFF or GeoTIFF on disk that reads rectangular windows on demand instead of
+    decoding the whole image. Uncompressed, contiguous TIFFs are memory-mapped. Tiled or striped compressed TIFFs are read through a
+    tifffile zarr store, which decodes only the tiles/strips that overlap the requested window.
+
+    -  INPUTS:
+      -  image_path: the path to the TIFF file.
+
+    Windows are returned as (HEIGHT, WIDTH, 3) uint8 RGB arrays: grayscale is expanded to 3 bands, extra bands (e.g. alpha) are dropped,
+    and 16-bit data is scaled down to 8 bits.
+    '''
+    def __init__(self, image_path):
+        import tifffile
+
+        self.image_path = image_path
+        self.store = None
+
+        with tifffile.TiffFile(image_path) as tif:
+            page = tif.pages[0]
+            memmappable = page.is_memmappable
+            self.planar = page.planarconfig == tifffile.PLANARCONFIG.SEPARATE and page.samplesperpixel > 1
+
+        if memmappable:
+            self.data = tifffile.memmap(image_path, page=0, mode='r')
+        else:
+            import zarr
+            self.store = tifffile.imread(image_path, aszarr=True, level=0)
+            self.data = zarr.open(self.store, mode='r')
+
+        if self.planar:
+            self.height, self.width = self.data.shape[-2:]
+        else:
+            self.height, self.width = self.data.shape[:2]
+
+    @property
+    def size(self) -> Tuple:
+        return (self.width, self.height)
+
+    def read_window(self, top, bottom, left, right) -> np.ndarray:
+        '''
+        Reads the [top:bottom, left:right] window of the image as a (HEIGHT, WIDTH, 3) uint8 RGB array. For memory-mapped images this
+        is a read-only view of the file wherever no conversion is needed.
+        '''
+        if self.planar:
+            window = np.moveaxis(np.asarray(self.data[..., top:bottom, left:right]), 0, -1)
+        else:
+            window = np.asarray(self.data[top:bottom, left:right])
+
+        if window.ndim == 2:
+            window = np.repeat(window[..., np.newaxis], 3, axis=2)
+        window = window[..., :3]
+
+        if window.dtype == np.uint16:
+            window = (window >> 8).astype(np.uint8)
+        elif window.dtype != np.uint8:
+            window = np.clip(window, 0, 255).astype(np.uint8)
+
+        return np.ascontiguousarray(window)
+
+    def close(self) -> None:
+        '''
+        Closes the zarr store, or drops the memory map (which is unmapped once no window views of it remain). Safe to call more than once.
+        '''
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        self.data = None
+
+class ReducedWindowedImage:
+    '''
+    A WindowedImage box-reduced by an integer factor, read window by window. Each window is read from the full-resolution image and
+    area-averaged down, which matches PIL reduce() apart from the ragged right and bottom edge pixels.
+
+    -  INPUTS:
+      -  windowed_image: the WindowedImage to reduce.
+      -  factor: the integer reduction factor.
+    '''
+    def __init__(self, windowed_image, factor):
+        self.windowed_image = windowed_image
+        self.factor = factor
+        self.height, self.width = -(-windowed_image.height // factor), -(-windowed_image.width // factor)
+
+    @property
+    def size(self) -> Tuple:
+        return (self.width, self.height)
+
+    def read_window(self, top, bottom, left, right) -> np.ndarray:
+        '''
+        Reads the [top:bottom, left:right] window of the reduced image as a (HEIGHT, WIDTH, 3) uint8 RGB array.
+        '''
+        f = self.factor
+        window = self.windowed_image.read_window(top * f, min(bottom * f, self.windowed_image.height),
+                                                 left * f, min(right * f, self.windowed_image.width))
+        return cv2.resize(window, (right - left, bottom - top), interpolation=cv2.INTER_AREA)
+
+def windowed_resample_source(windowed_image, output_size):
+    '''
+    The windowed counterpart of prepare_resample_source(): returns the WindowedImage, or for large reductions a ReducedWindowedImage of
+    it, to pass to iter_resampled_chips(). Nothing is read from disk until chips are drawn.
+    '''
+    check_resampled_size(windowed_image.size, output_size)
+    reduce_factor = min(windowed_image.width // output_size[0], windowed_image.height // output_size[1])
+    return ReducedWindowedImage(windowed_image, reduce_factor) if reduce_factor >= 2 else windowed_image
+
+def iter_windowed_chips(windowed_image, base_img_name, base_img_ext, desired_height=512, desired_width=512, overlap=None):
+    '''
+    The windowed counterpart of iter_chips(). Reads a WindowedImage one desired_height-tall band at a time and yields each band's chips as
+    views (see tile_array()), so only one band of the image is ever held in memory regardless of the image's size. Chip names and order
+    match iter_chips().
+
+    -  INPUTS:
+      -  windowed_image: a WindowedImage.
+      -  base_img_name, base_img_ext: the filename and extension associated with the image, used to build each unique chip name.
+      -  desired_height, desired_width: the image chip dimensions in pixels expected by the inference model.
+      -  overlap: the minimum overlap in pixels between neighbouring chips, or None for the original non-overlapping grid (see tile_offsets()).
+
+    -  OUTPUTS:
+      -  yields (chip name, 3-D numpy array view of the chip) tuples.
+    '''
+    height, width = windowed_image.height, windowed_image.width
+
+    if overlap is None:
+        for top in range(0, height, desired_height):
+            band = windowed_image.read_window(top, min(top + desired_height, height), 0, width)
+            _, n_cols, get_tile = tile_array(band, desired_height, desired_width)
+
+            for col in range(n_cols):
+                yield f"{base_img_name}_{top}_{col * desired_width}{base_img_ext}", get_tile(0, col)
+        return
+
+    offsets = tile_offsets(height, width, base_img_name, base_img_ext, desired_height, desired_width, overlap)
+    band_top, band = None, None
+    for out_name, (top, left) in offsets.items():
+        if top != band_top:
+            band_top = top
+            band = windowed_image.read_window(top, min(top + desired_height, height), 0, width)
+            if band.shape[0] < desired_height or band.shape[1] < desired_width:
+                band = np.pad(band, ((0, max(desired_height - band.shape[0], 0)), (0, max(desired_width - band.shape[1], 0)), (0, 0)))
+
+        yield out_name, band[:, left:left + desired_width]
+
+def _chip_offset_from_name(chip_name) -> Tuple:
+    name = os.path.splitext(chip_name)[0]
+    return int(name.split('_')[-2]), int(name.split('_')[-1])
+
+def _seam_overlaps(positions, tile_length) -> Tuple:
+    '''
+    For sorted chip positions along one axis, returns how many pixels each chip shares with the chip before and after it.
+    '''
+    overlap_after = np.maximum(positions[:-1] + tile_length - positions[1:], 0)
+    return np.concatenate([[0], overlap_after]), np.concatenate([overlap_after, [0]])
+
+def nms_suppressed(bboxes, scores, classes, candidates, iou_threshold=0.5, chunk_size=512) -> np.ndarray:
+    '''
+    Vectorized, class-aware non-maximum suppression over the boxes flagged in `candidates`. A candidate box is suppressed when a higher
+    scoring candidate of the same class overlaps it with IoU above iou_threshold (the "Fast NMS" variant, which compares every pair at
+    once rather than iterating box by box). The IoU matrix is built in chunk_size x chunk_size blocks, so memory stays bounded however many
+    boxes a large orthomosaic produces.
+
+    -  INPUTS:
+      -  bboxes: an (N, 4) array of [ymin, xmin, ymax, xmax] boxes.
+      -  scores, classes: length N arrays of scores and class IDs.
+      -  candidates: a length N boolean mask of the boxes to consider (e.g. boxes near chip seams).
+
+    -  OUTPUTS:
+      -  a length N boolean mask of the boxes to drop.
+    '''
+    suppressed = np.zeros(len(scores), dtype=bool)
+    idx = np.flatnonzero(candidates)
+    if len(idx) < 2:
+        return suppressed
+
+    idx = idx[np.argsort(-scores[idx], kind='stable')]
+    boxes = bboxes[idx].astype(np.float32)
+    cls = classes[idx]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    for start in range(0, len(idx), chunk_size):
+        rows = slice(start, start + chunk_size)
+        row_ids = np.arange(start, min(start + chunk_size, len(idx)))
+        row_suppressed = np.zeros(len(row_ids), dtype=bool)
+
+        # Only higher-scoring boxes (earlier in the sorted order) can suppress a box, so only column blocks up to this row block are compared.
+        for col_start in range(0, row_ids[-1], chunk_size):
+            cols = slice(col_start, min(col_start + chunk_size, row_ids[-1]))
+            inter_h = np.clip(np.minimum(boxes[rows, None, 2], boxes[None, cols, 2]) - np.maximum(boxes[rows, None, 0], boxes[None, cols, 0]), 0, None)
+            inter_w = np.clip(np.minimum(boxes[rows, None, 3], boxes[None, cols, 3]) - np.maximum(boxes[rows, None, 1], boxes[None, cols, 1]), 0, None)
+            inter = inter_h * inter_w
+            iou = inter / np.maximum(areas[rows, None] + areas[None, cols] - inter, 1e-6)
+
+            is_earlier = np.arange(cols.start, cols.stop)[None, :] < row_ids[:, None]
+            same_class = cls[rows, None] == cls[None, cols]
+            row_suppressed |= np.any((iou > iou_threshold) & is_earlier & same_class, axis=1)
+
+        suppressed[idx[rows]] = row_suppressed
+
+    return suppressed
+
+def reassemble_chips(inference_results_dict, chip_offsets=None, iou_threshold=None, image_name=None, desired_height=512, desired_width=512) -> dict:
+  '''
+  Merges per-chip detections (as returned by batch_inference()) into a single set of detections in the coordinates of the chipped image. All
+  boxes are shifted by their chip's offset in one array operation. When iou_threshold is given, duplicate detections of the same object by
+  neighbouring, overlapping chips are removed with class-aware non-maximum suppression, applied only to boxes that touch a chip overlap.
+
+  -  INPUTS:
+    -  inference_results_dict: a dictionary of chip name -> {'bboxes', 'scores', 'classes'}, as returned by batch_inference().
+    -  chip_offsets: the dictionary of chip name -> (top, left) offsets from tile_offsets(). When None, offsets are parsed from the chip names.
+    -  iou_threshold: the IoU above which overlapping same-class boxes from neighbouring chips are merged, or None to skip suppression.
+    -  image_name: the key of the returned dictionary. When None, it is rebuilt from the chip names.
+    -  desired_height, desired_width: the chip dimensions used when chipping.
+
+  -  OUTPUTS:
+    -  a dictionary of image_name -> {'bboxes', 'scores', 'classes'} arrays (see output_utils.DETECTION_KEYS).
+  '''
+  chip_names = list(inference_results_dict.keys())
+  if image_name is None and chip_names:
+    chip_name, chip_ext = os.path.splitext(chip_names[0])
+    image_name = '_'.join(chip_name.split('_')[:-2]) + chip_ext
+
+  if not chip_names:
+    return {image_name: empty_detections()}
+
+  counts = np.array([len(inference_results_dict[k]['scores']) for k in chip_names])
+  offsets = np.array([chip_offsets[k] if chip_offsets is not None else _chip_offset_from_name(k) for k in chip_names]).reshape(-1, 2)
+
+  bboxes = np.concatenate([np.asarray(inference_results_dict[k]['bboxes'], dtype=np.int32).reshape(-1, 4) for k in chip_names])
+  scores = np.concatenate([np.asarray(inference_results_dict[k]['scores'], dtype=np.float32) for k in chip_names])
+  classes = np.concatenate([np.asarray(inference_results_dict[k]['classes'], dtype=np.uint8) for k in chip_names])
+
+  # The chip grid is taken from every planned chip, including any that were skipped before inference, so seams are found correctly.
+  grid = np.array(list(chip_offsets.values())).reshape(-1, 2) if chip_offsets is not None else offsets
+
+  box_offsets = np.repeat(offsets, counts, axis=0).astype(np.int32)
+  chip_bboxes = bboxes
+  bboxes = bboxes + np.tile(box_offsets, 2)
+
+  if iou_threshold is not None and len(scores):
+    # Only boxes reaching into the part of their chip shared with a neighbour can be duplicates, so only those go through NMS.
+    tops, lefts = np.unique(grid[:, 0]), np.unique(grid[:, 1])
+    overlap_top, overlap_bottom = _seam_overlaps(tops, desired_height)
+    overlap_left, overlap_right = _seam_overlaps(lefts, desired_width)
+    row = np.searchsorted(tops, box_offsets[:, 0])
+    col = np.searchsorted(lefts, box_offsets[:, 1])
+
+    candidates = ((chip_bboxes[:, 0] < overlap_top[row]) | (chip_bboxes[:, 2] > desired_height - overlap_bottom[row]) |
+                  (chip_bboxes[:, 1] < overlap_left[col]) | (chip_bboxes[:, 3] > desired_width - overlap_right[col]))
+
+    keep = ~nms_suppressed(bboxes, scores, classes, candidates, iou_threshold)
+    bboxes, scores, classes = bboxes[keep], scores[keep], classes[keep]
+
+  return {image_name: {'bboxes': bboxes, 'scores': scores, 'classes': classes}}
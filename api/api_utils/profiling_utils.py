@@ -0,0 +1,126 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Tensorflow's profiler traces the whole process and only one trace can run at a time, so concurrent profiled jobs take turns.
+_tf_trace_lock = threading.Lock()
+
+class RequestProfiler:
+    '''
+    Profiles one job's batch_inference() calls: a cProfile of the calling thread (chip generation, prefiltering, batching waits and any
+    in-thread model calls), plus a Tensorflow profiler trace of the ops run meanwhile (which includes the dynamic batcher's model calls,
+    made on its own threads). The trace is only taken when Tensorflow is loaded in this process; TFLite and worker-pool models run their
+    ops elsewhere and only get the cProfile. The trace covers every op in the process, so it can include other jobs' chips when jobs overlap.
+
+    A job without profiling never creates a RequestProfiler, so profiling costs nothing when it is off.
+
+    -  INPUTS:
+      -  output_dir: the folder the profile is written to by write(), usually the job's output folder.
+      -  tf_trace: whether to take a Tensorflow profiler trace alongside the cProfile.
+    '''
+    def __init__(self, output_dir, tf_trace=True):
+        self.output_dir = output_dir
+        self.tf_trace = tf_trace
+        self.profiles = []
+        self.calls = []
+        self.notes = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, label):
+        '''
+        Profiles the code run inside the with block, recording it under label (e.g. the image's filename).
+        '''
+        tf = self._start_tf_trace(label) if self.tf_trace else None
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows only one cProfile at a time across all threads.
+            self._note(f"{label}: no cProfile, another profiler was running: {e}")
+            profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - started
+            if tf is not None:
+                self._stop_tf_trace(tf, label)
+            with self.lock:
+                if profiler is not None:
+                    self.profiles.append(profiler)
+                self.calls.append((label, seconds))
+
+    def _start_tf_trace(self, label):
+        tf = sys.modules.get('tensorflow')
+        if tf is None:
+            self._note(f"{label}: no Tensorflow op trace, Tensorflow is not loaded in the API process.")
+            return None
+        if not _tf_trace_lock.acquire(blocking=False):
+            self._note(f"{label}: no Tensorflow op trace, another job was being traced.")
+            return None
+
+        try:
+            tf.profiler.experimental.start(os.path.join(self.output_dir, 'profile', 'tf_trace'))
+        except Exception as e:
+            _tf_trace_lock.release()
+            self._note(f"{label}: the Tensorflow op trace could not be started: {e!r}")
+            return None
+        return tf
+
+    def _stop_tf_trace(self, tf, label):
+        try:
+            tf.profiler.experimental.stop()
+        except Exception as e:
+            self._note(f"{label}: the Tensorflow op trace could not be saved: {e!r}")
+        finally:
+            _tf_trace_lock.release()
+
+    def _note(self, note):
+        with self.lock:
+            self.notes.append(note)
+
+    def write(self, top_n=40) -> list:
+        '''
+        Writes the profile to output_dir/profile/: batch_inference.pstats (load with pstats or snakeviz), a summary.txt of the calls and the
+        top_n functions by cumulative time, and any Tensorflow trace under tf_trace/ (open the folder in TensorBoard's Profile tab).
+
+        -  OUTPUTS:
+          -  A list of the written files' paths, relative to output_dir.
+        '''
+        profile_dir = os.path.join(self.output_dir, 'profile')
+        os.makedirs(profile_dir, exist_ok=True)
+
+        summary = io.StringIO()
+        summary.write(f"batch_inference calls: {len(self.calls)}, {sum(s for _, s in self.calls):.3f}s\n")
+        for label, seconds in self.calls:
+            summary.write(f"  {label}: {seconds:.3f}s\n")
+        for note in self.notes:
+            summary.write(f"{note}\n")
+
+        outputs = []
+        if self.profiles:
+            stats = pstats.Stats(self.profiles[0], stream=summary)
+            for profiler in self.profiles[1:]:
+                stats.add(profiler)
+            stats.dump_stats(os.path.join(profile_dir, 'batch_inference.pstats'))
+            outputs.append('profile/batch_inference.pstats')
+            summary.write('\n')
+            stats.sort_stats('cumulative').print_stats(top_n)
+        else:
+            summary.write("No cProfile was taken (e.g. every image was a cache hit).\n")
+
+        with open(os.path.join(profile_dir, 'summary.txt'), 'w') as outfile:
+            outfile.write(summary.getvalue())
+        outputs.insert(0, 'profile/summary.txt')
+
+        for root, _, files in os.walk(os.path.join(profile_dir, 'tf_trace')):
+            outputs.extend(os.path.relpath(os.path.join(root, f), self.output_dir) for f in sorted(files))
+        return outputs
@@ -0,0 +1,120 @@
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+
+def pyramid_max_level(width, height) -> int:
+    '''
+    Returns the Deep Zoom level of the full-resolution image. Level 0 is 1x1 pixels and each level doubles the size of the one below it.
+    '''
+    return math.ceil(math.log2(max(width, height, 1)))
+
+def write_dzi_descriptor(path, width, height, tile_size, tile_format='jpg') -> None:
+    '''
+    Writes the Deep Zoom (.dzi) XML descriptor that viewers such as OpenSeadragon load to find a pyramid's tiles.
+    '''
+    with open(path, 'w') as outfile:
+        outfile.write(f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                      f'<Image xmlns="{DZI_NAMESPACE}" Format="{tile_format}" Overlap="0" TileSize="{tile_size}">'
+                      f'<Size Width="{width}" Height="{height}"/></Image>\n')
+
+class _PyramidLevel:
+    '''
+    One level of a tile pyramid being built from the top (full-resolution) level down. Rows of the level's image are pushed in, a row of
+    tiles is written each time tile_size rows have arrived, and those rows are downsampled by half and pushed into the next level down.
+    '''
+    def __init__(self, level, width, tile_size, write_tile, next_level):
+        self.level = level
+        self.width = width
+        self.tile_size = tile_size
+        self.write_tile = write_tile
+        self.next_level = next_level
+        self.buffer = None
+        self.tile_row = 0
+
+    def push(self, rows) -> None:
+        self.buffer = rows if self.buffer is None else np.concatenate([self.buffer, rows])
+        while len(self.buffer) >= self.tile_size:
+            self._emit(self.buffer[:self.tile_size])
+            self.buffer = self.buffer[self.tile_size:]
+
+    def flush(self) -> None:
+        if self.buffer is not None and len(self.buffer):
+            self._emit(self.buffer)
+        self.buffer = None
+        if self.next_level is not None:
+            self.next_level.flush()
+
+    def _emit(self, rows) -> None:
+        for col, left in enumerate(range(0, self.width, self.tile_size)):
+            self.write_tile(self.level, col, self.tile_row, rows[:, left:left + self.tile_size])
+        self.tile_row += 1
+
+        # Only the last row of tiles can have an odd number of rows, so halving each chunk adds up to the next level's ceil(height / 2).
+        if self.next_level is not None:
+            self.next_level.push(cv2.resize(rows, (self.next_level.width, -(-len(rows) // 2)), interpolation=cv2.INTER_AREA))
+
+def write_tile_pyramid(output_dir, base_name, width, height, read_band, tile_size=256, quality=85, workers=4) -> list:
+    '''
+    Writes an image as a Deep Zoom tile pyramid: a base_name.dzi descriptor and base_name_files/<level>/<column>_<row>.jpg tiles, which
+    viewers such as OpenSeadragon can pan and zoom without loading the full image. The image is read one tile_size-tall band at a time and
+    each lower level is built by downsampling the level above it as its rows arrive, so only about one band per level is held in memory.
+    Tiles are JPEG-encoded and written on a pool of worker threads (OpenCV releases the GIL while encoding).
+
+    -  INPUTS:
+      -  output_dir: the folder to write the descriptor and tile folder to.
+      -  base_name: the name of the pyramid (usually the image's name without its extension).
+      -  width, height: the size of the full-resolution image.
+      -  read_band: a function that takes (top, bottom) and returns those rows of the full-resolution image as a (rows, width, 3) BGR array.
+      -  tile_size: the width and height of each tile, in pixels (must be even).
+      -  quality: the JPEG quality of the tiles.
+      -  workers: the number of threads encoding tiles.
+
+    -  OUTPUTS:
+      -  A list of the written files' paths, relative to output_dir (the descriptor first).
+    '''
+    descriptor_name = f"{base_name}.dzi"
+    tiles_dir = f"{base_name}_files"
+    max_level = pyramid_max_level(width, height)
+    for level in range(max_level + 1):
+        os.makedirs(os.path.join(output_dir, tiles_dir, str(level)), exist_ok=True)
+
+    outputs = [descriptor_name]
+    futures = []
+    # Bounds the tiles waiting to be encoded, so a fast reader can't queue up the whole image in memory.
+    pending = threading.BoundedSemaphore(workers * 4)
+
+    def encode_tile(path, tile):
+        try:
+            ok, encoded = cv2.imencode('.jpg', tile, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise ValueError(f"Could not encode tile {path}.")
+            encoded.tofile(path)
+        finally:
+            pending.release()
+
+    with ThreadPoolExecutor(workers, thread_name_prefix='pyramid-tiles') as executor:
+        def write_tile(level, col, row, tile):
+            name = f"{tiles_dir}/{level}/{col}_{row}.jpg"
+            outputs.append(name)
+            pending.acquire()
+            futures.append(executor.submit(encode_tile, os.path.join(output_dir, name), tile))
+
+        top_level = None
+        for level in range(max_level + 1):
+            top_level = _PyramidLevel(level, -(-width // 2**(max_level - level)), tile_size, write_tile, top_level)
+
+        for top in range(0, height, tile_size):
+            top_level.push(read_band(top, min(top + tile_size, height)))
+        top_level.flush()
+
+    for future in futures:
+        future.result()
+
+    write_dzi_descriptor(os.path.join(output_dir, descriptor_name), width, height, tile_size)
+    return outputs
@@ -1,36 +1,23 @@
+import json
 import os
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 
 
 api = FastAPI()
 
-def create_temp_folders(CHIP_IMAGE_PATH, FINAL_OUTPUT_PATH) -> None:
+def create_temp_folders(*folders) -> None:
     '''
     A simple function to create the folder structure we need for intermediate image processing.
     '''
-    if not os.path.exists(CHIP_IMAGE_PATH):
-      os.makedirs(CHIP_IMAGE_PATH)
-
-    if not os.path.exists(FINAL_OUTPUT_PATH):
-      os.makedirs(FINAL_OUTPUT_PATH)
-
-def clean_temporary_files(CHIP_IMAGE_PATH, FINAL_OUTPUT_PATH) -> None:
-    '''
-    A simple function to clean the API's temporary file storage locations. This is run both before and after each API run to 
-    ensure no wires get crossed...
-    '''
-    for root, dirs, files in os.walk(CHIP_IMAGE_PATH):
-      for file in files:
-        os.remove(os.path.join(root, file))
-
-    for root, dirs, files in os.walk(FINAL_OUTPUT_PATH):
-      for file in files:
-        os.remove(os.path.join(root, file))
+    for folder in folders:
+      if not os.path.exists(folder):
+        os.makedirs(folder)
 
 def security_check(list_of_file_uploads, list_of_approved_content_types) -> list:
     '''
     A simple function designed to screen user uploads to check if they are a supported image type.
-    This function could be modified in the future to also check other things, such as file size.
+    Upload sizes are checked as they stream in, by RequestBodyLimitMiddleware and spool_upload().
     '''
     screened_uploads = []
     for fi in list_of_file_uploads:
@@ -41,3 +28,137 @@ def security_check(list_of_file_uploads, list_of_approved_content_types) -> list
         
     return screened_uploads
 
+
+class UploadTooLarge(Exception):
+    '''
+    Raised by spool_upload() when an uploaded file is larger than the allowed number of bytes.
+    '''
+    pass
+
+async def spool_upload(upload_file, output_path, chunk_size=1024 * 1024, max_bytes=None) -> int:
+    '''
+    Copies an uploaded file to output_path in chunks, so the upload is never held in memory in full. Returns the number of bytes written.
+    If the file grows past max_bytes the partial copy is removed and UploadTooLarge is raised. By the time this runs the form has already
+    been parsed, so this is only a backstop: oversized files are cut off while they are received by RequestBodyLimitMiddleware(max_part_bytes).
+    '''
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    n_bytes = 0
+    with open(output_path, 'wb') as outfile:
+      while True:
+        chunk = await upload_file.read(chunk_size)
+        if not chunk:
+          break
+        n_bytes += len(chunk)
+        if max_bytes is not None and n_bytes > max_bytes:
+          outfile.close()
+          os.remove(output_path)
+          raise UploadTooLarge(f"{upload_file.filename} is larger than the {max_bytes} byte limit per file.")
+        outfile.write(chunk)
+
+    return n_bytes
+
+def multipart_boundary(content_type) -> bytes:
+    '''
+    Returns the boundary parameter of a multipart Content-Type header value (as bytes), or None when it has none.
+    '''
+    for param in content_type.split(b';')[1:]:
+      key, _, value = param.strip().partition(b'=')
+      if key.strip().lower() == b'boundary' and value:
+        return value.strip().strip(b'"')
+    return None
+
+class MultipartPartCounter:
+    '''
+    Tracks the size of the part currently being received in a streamed multipart body, by looking for the boundary delimiter in each chunk
+    (including delimiters split across chunks). Part headers are counted with the part, which is negligible next to a file's bytes.
+    '''
+    def __init__(self, boundary):
+      self.delimiter = b'\r\n--' + boundary
+      self.tail = b''
+      self.part_bytes = 0
+
+    def feed(self, chunk) -> int:
+      '''
+      Counts a chunk of the body and returns the size of the largest part seen in it (parts that ended in the chunk, and the part still
+      being received).
+      '''
+      data = self.tail + chunk
+      counted = len(self.tail)
+      largest = 0
+      end = data.find(self.delimiter)
+      while end != -1:
+        self.part_bytes += max(end - counted, 0)
+        largest = max(largest, self.part_bytes)
+        self.part_bytes = 0
+        counted = end + len(self.delimiter)
+        end = data.find(self.delimiter, counted)
+
+      self.part_bytes += len(data) - counted
+      self.tail = data[-(len(self.delimiter) - 1):]
+      return max(largest, self.part_bytes)
+
+class RequestBodyLimitMiddleware:
+    '''
+    ASGI middleware that caps the size of request bodies sent to paths starting with path_prefix. Requests that declare a larger
+    Content-Length are answered with 413 before any of the body is read (and a malformed Content-Length with 400), and bodies that stream in
+    past max_bytes (e.g. chunked uploads) are cut off with a 413 as soon as the limit is crossed. For multipart bodies, each part (i.e. each
+    uploaded file) is also cut off once it passes max_part_bytes, so an oversized file is never received, or spooled, in full.
+
+    -  INPUTS:
+      -  app: the ASGI app to wrap (added with api.add_middleware()).
+      -  max_bytes: the largest allowed request body, in bytes (None for no limit).
+      -  path_prefix: only requests to paths starting with this prefix are limited.
+      -  max_part_bytes: the largest allowed part of a multipart body, in bytes (None for no limit).
+    '''
+    def __init__(self, app, max_bytes=None, path_prefix='/', max_part_bytes=None):
+      self.app = app
+      self.max_bytes = max_bytes
+      self.path_prefix = path_prefix
+      self.max_part_bytes = max_part_bytes
+
+    async def __call__(self, scope, receive, send):
+      if scope['type'] != 'http' or (self.max_bytes is None and self.max_part_bytes is None) or not scope['path'].startswith(self.path_prefix):
+        return await self.app(scope, receive, send)
+
+      headers = dict(scope['headers'])
+      detail = f"The request body is larger than the {self.max_bytes} byte limit."
+      content_length = headers.get(b'content-length')
+      if content_length is not None and self.max_bytes is not None:
+        try:
+          declared_bytes = int(content_length)
+        except ValueError:
+          return await JSONResponse({'detail': "The Content-Length header is not a valid number."}, status_code=400)(scope, receive, send)
+        if declared_bytes > self.max_bytes:
+          return await JSONResponse({'detail': detail}, status_code=413)(scope, receive, send)
+
+      boundary = multipart_boundary(headers.get(b'content-type', b''))
+      part_counter = MultipartPartCounter(boundary) if boundary is not None and self.max_part_bytes is not None else None
+
+      received = 0
+      async def limited_receive():
+        nonlocal received
+        message = await receive()
+        if message['type'] == 'http.request':
+          body = message.get('body', b'')
+          received += len(body)
+          # Raised while FastAPI parses the form, which passes HTTPExceptions through as the response.
+          if self.max_bytes is not None and received > self.max_bytes:
+            raise HTTPException(status_code=413, detail=detail)
+          if part_counter is not None and part_counter.feed(body) > self.max_part_bytes:
+            raise HTTPException(status_code=413, detail=f"An uploaded file is larger than the {self.max_part_bytes} byte limit per file.")
+        return message
+
+      await self.app(scope, limited_receive, send)
+
+def sse_message(event, data, event_id=None) -> str:
+    '''
+    Formats one Server-Sent Events message, with data encoded as single-line JSON. Pass the result of sse_message(None, None) (a comment
+    line) to keep an idle event stream open.
+    '''
+    if event is None:
+      return ": keepalive\n\n"
+
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data, separators=(',', ':'))}"]
+    return '\n'.join(lines) + '\n\n'
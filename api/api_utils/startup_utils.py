@@ -0,0 +1,68 @@
+import threading
+import time
+from contextlib import contextmanager
+
+STARTUP_LOADING = 'loading'
+STARTUP_READY = 'ready'
+STARTUP_FAILED = 'failed'
+
+class StartupLifecycle:
+    '''
+    Tracks a slow startup task (loading and warming up the model) that runs on a background thread, so the server can bind its port and
+    answer health checks straight away while readiness is reported separately. Each phase of the task is timed with phase() and logged.
+    '''
+    def __init__(self):
+        self.state = STARTUP_LOADING
+        self.error = None
+        self.phases = {}
+        self.created = time.time()
+        self.ready_at = None
+        self.ready_event = threading.Event()
+        self.thread = None
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Times the enclosed block as a named startup phase.
+        '''
+        print(f"Startup: {name}...")
+        start = time.perf_counter()
+        yield
+        self.phases[name] = time.perf_counter() - start
+        print(f"Startup: {name} took {self.phases[name]:.2f}s")
+
+    def start(self, fn) -> None:
+        '''
+        Runs fn() on a background thread. The lifecycle becomes ready when fn returns, or failed if it raises.
+        '''
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                self.state, self.error = STARTUP_FAILED, repr(e)
+                print(f"Startup failed: {e!r}")
+            else:
+                self.state, self.ready_at = STARTUP_READY, time.time()
+                print(f"Startup: ready after {self.ready_at - self.created:.2f}s")
+            finally:
+                self.ready_event.set()
+
+        self.thread = threading.Thread(target=run, name='startup', daemon=True)
+        self.thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == STARTUP_READY
+
+    def wait(self, timeout=None) -> bool:
+        '''
+        Blocks until startup has finished (or failed), or until timeout seconds have passed. Returns True if startup succeeded.
+        '''
+        self.ready_event.wait(timeout)
+        return self.ready
+
+    def status(self) -> dict:
+        return {'status': self.state,
+                'error': self.error,
+                'phases_seconds': dict(self.phases),
+                'seconds_to_ready': self.ready_at - self.created if self.ready_at else None}
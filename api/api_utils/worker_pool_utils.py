@@ -0,0 +1,252 @@
+import atexit
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from api.api_utils.backend_utils import DETECTION_OUTPUTS, InferenceBackend
+
+def configure_tensorflow_threads(intra_op_threads=None, inter_op_threads=None) -> None:
+    '''
+    Sets the size of Tensorflow's intra-op thread pool (the threads that share the work of a single op, such as a convolution) and inter-op
+    thread pool (the threads that run independent ops in parallel). None leaves Tensorflow's default, which sizes both pools for the whole
+    machine. The sizes are set through environment variables that Tensorflow reads when its runtime starts, so this must be called before a
+    model is loaded; if Tensorflow is already imported its threading config is set directly as well.
+    '''
+    if intra_op_threads is not None:
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(intra_op_threads)
+        os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    if inter_op_threads is not None:
+        os.environ['TF_NUM_INTEROP_THREADS'] = str(inter_op_threads)
+
+    tf = sys.modules.get('tensorflow')
+    if tf is not None and (intra_op_threads is not None or inter_op_threads is not None):
+        try:
+            if intra_op_threads is not None:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+            if inter_op_threads is not None:
+                tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        except RuntimeError as e:
+            print(f"Tensorflow's thread pools were already created and can't be resized: {e}")
+
+def cpu_affinity_plan(n_workers, cpus=None) -> list:
+    '''
+    Splits the CPU cores this process may run on (or the given cpus) into n_workers contiguous groups of near-equal size, one per worker, so
+    workers don't compete for cores or migrate between them. When there are fewer cores than workers, workers share cores round-robin.
+    '''
+    cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+    if len(cpus) < n_workers:
+        return [[cpus[i % len(cpus)]] for i in range(n_workers)]
+    return [[int(cpu) for cpu in group] for group in np.array_split(cpus, n_workers)]
+
+def _worker_main(load_fn, shm_name, conn, intra_op_threads, inter_op_threads, cpus, chip_shape, warmup_batch_sizes) -> None:
+    '''
+    The main loop of an inference worker process: loads the model once, then runs each batch the API process writes into the worker's
+    shared memory buffer. Requests are the batch's shape (None to exit) and replies are ('ok', detections) or ('error', message).
+    '''
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    configure_tensorflow_threads(intra_op_threads, inter_op_threads)
+
+    try:
+        model = load_fn()
+        supported_batch_size = model.supported_batch_size
+        for batch_size in warmup_batch_sizes:
+            model(np.zeros((min(batch_size, supported_batch_size or batch_size),) + tuple(chip_shape), dtype=np.uint8))
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+
+    conn.send(('ready', os.getpid()))
+
+    try:
+        while True:
+            shape = conn.recv()
+            if shape is None:
+                break
+
+            try:
+                chips = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                step = supported_batch_size or len(chips)
+                outputs = [model(chips[i:i + step]) for i in range(0, len(chips), step)]
+                del chips
+                conn.send(('ok', {k: np.concatenate([np.asarray(o[k]) for o in outputs]) for k in DETECTION_OUTPUTS if k in outputs[0]}))
+            except Exception as e:
+                conn.send(('error', repr(e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        shm.close()
+
+class InferenceWorkerPool(InferenceBackend):
+    '''
+    Runs a model in n_workers separate processes that each load the model once, so inference can use all of a many-core machine without
+    the processes' thread pools oversubscribing it. The pool is called like any other backend: each call's batch is queued and taken by the
+    next free worker, so concurrent callers (such as a DynamicBatcher with one runner per worker) keep every worker busy. Chips are copied
+    into a shared memory buffer owned by the worker instead of being pickled, and only the small detection arrays are sent back.
+
+    Workers are started with the 'spawn' method, since Tensorflow is not safe to fork once it has been initialized.
+
+    -  INPUTS:
+      -  load_fn: a picklable function that loads and returns the model inside a worker, e.g. functools.partial(load_model, path, 'tflite').
+      -  n_workers: the number of worker processes.
+      -  chip_shape: the (HEIGHT, WIDTH, 3) shape of the chips that will be sent.
+      -  max_batch_size: the most chips handed to a worker at once (larger batches are split). Sets the size of each shared memory buffer.
+      -  intra_op_threads, inter_op_threads: each worker's Tensorflow thread pool sizes (see configure_tensorflow_threads()). When a worker is
+           pinned to cores and intra_op_threads is None, it defaults to the number of cores the worker is pinned to.
+      -  cpu_affinity: None to leave scheduling to the OS, 'auto' to pin each worker to its own share of the cores (see cpu_affinity_plan()),
+           or a list of core ids for each worker.
+      -  warmup_batch_sizes: the batch sizes each worker runs a dummy batch of before reporting ready.
+      -  start_timeout: the number of seconds to wait for each worker to load its model.
+    '''
+    name = 'worker_pool'
+    supported_batch_size = None
+
+    def __init__(self, load_fn, n_workers, chip_shape=(512, 512, 3), max_batch_size=16, intra_op_threads=None, inter_op_threads=None,
+                 cpu_affinity=None, warmup_batch_sizes=(), start_timeout=600):
+        if cpu_affinity == 'auto':
+            cpu_affinity = cpu_affinity_plan(n_workers)
+
+        context = multiprocessing.get_context('spawn')
+        self.chip_shape = tuple(chip_shape)
+        self.slot_bytes = int(np.prod(self.chip_shape)) * max_batch_size
+        self.max_batch_size = max_batch_size
+        self.tasks = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+        try:
+            for i in range(n_workers):
+                cpus = cpu_affinity[i] if cpu_affinity is not None else None
+                threads = len(cpus) if intra_op_threads is None and cpus is not None else intra_op_threads
+                shm = shared_memory.SharedMemory(create=True, size=self.slot_bytes)
+                conn, child_conn = context.Pipe()
+                process = context.Process(target=_worker_main, name=f'inference-worker-{i}', daemon=True,
+                                          args=(load_fn, shm.name, child_conn, threads, inter_op_threads, cpus,
+                                                self.chip_shape, list(warmup_batch_sizes)))
+                process.start()
+                self.workers.append({'process': process, 'conn': conn, 'shm': shm, 'cpus': cpus, 'pid': None, 'alive': False,
+                                     'dispatcher': None, 'batches': 0, 'chips': 0, 'busy_seconds': 0.0})
+
+            for i, worker in enumerate(self.workers):
+                if not worker['conn'].poll(start_timeout):
+                    raise RuntimeError(f"Inference worker {i} did not load the model within {start_timeout}s.")
+                status, detail = worker['conn'].recv()
+                if status != 'ready':
+                    raise RuntimeError(f"Inference worker {i} failed to load the model: {detail}")
+                worker['pid'], worker['alive'] = detail, True
+        except BaseException:
+            self.close()
+            raise
+
+        for i, worker in enumerate(self.workers):
+            worker['dispatcher'] = threading.Thread(target=self._dispatch, args=(worker,), name=f'inference-worker-{i}-dispatch', daemon=True)
+            worker['dispatcher'].start()
+        atexit.register(self.close)
+
+    def __call__(self, batch_tensor) -> dict:
+        batch_tensor = np.asarray(batch_tensor, dtype=np.uint8)
+        chips_per_task = min(self.max_batch_size, self.slot_bytes // max(batch_tensor[0].nbytes, 1)) if len(batch_tensor) else 1
+        if chips_per_task < 1:
+            raise ValueError(f"Chips of shape {batch_tensor.shape[1:]} don't fit in the workers' buffers (sized for {self.chip_shape}).")
+
+        futures = []
+        for start in range(0, len(batch_tensor), chips_per_task):
+            future = Future()
+            with self.lock:
+                if not any(w['alive'] for w in self.workers):
+                    raise RuntimeError("All inference workers have exited.")
+                self.tasks.put((batch_tensor[start:start + chips_per_task], future))
+            futures.append(future)
+
+        outputs = [f.result() for f in futures]
+        return {k: np.concatenate([o[k] for o in outputs]) for k in outputs[0]}
+
+    def _dispatch(self, worker) -> None:
+        '''
+        Feeds queued batches to one worker process, one at a time, for as long as the worker is alive.
+        '''
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            batch, future = task
+
+            started = time.perf_counter()
+            try:
+                chips = np.ndarray(batch.shape, dtype=np.uint8, buffer=worker['shm'].buf)
+                chips[:] = batch
+                del chips
+                worker['conn'].send(batch.shape)
+                status, result = worker['conn'].recv()
+            except (EOFError, OSError) as e:
+                future.set_exception(RuntimeError(f"Inference worker {worker['process'].name} exited: {e!r}"))
+                self._worker_exited(worker)
+                return
+
+            worker['batches'] += 1
+            worker['chips'] += len(batch)
+            worker['busy_seconds'] += time.perf_counter() - started
+            if status == 'ok':
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Inference worker {worker['process'].name} failed: {result}"))
+
+    def _worker_exited(self, worker) -> None:
+        with self.lock:
+            worker['alive'] = False
+            if any(w['alive'] for w in self.workers):
+                return
+
+            # No worker is left to take queued batches, so fail them rather than leaving their callers waiting forever.
+            while True:
+                try:
+                    task = self.tasks.get_nowait()
+                except queue.Empty:
+                    return
+                if task is not None:
+                    task[1].set_exception(RuntimeError("All inference workers have exited."))
+
+    def stats(self) -> list:
+        '''
+        Returns each worker's pid, pinned cores, and the number of batches and chips it has run and the seconds it has spent on them.
+        '''
+        return [{k: w[k] for k in ('pid', 'cpus', 'alive', 'batches', 'chips', 'busy_seconds')} for w in self.workers]
+
+    def close(self, timeout=60) -> None:
+        '''
+        Stops the worker processes and frees their shared memory. Batches already queued are finished first: each dispatcher thread is
+        stopped and joined (waiting up to timeout seconds) before its worker's pipe is used to ask the worker to exit, so the two never
+        use the pipe at once.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+
+        dispatchers = [w['dispatcher'] for w in self.workers if w['dispatcher'] is not None]
+        for _ in dispatchers:
+            self.tasks.put(None)
+        for dispatcher in dispatchers:
+            dispatcher.join(timeout=timeout)
+
+        for worker in self.workers:
+            # A dispatcher still waiting on its worker owns the pipe, so that worker is terminated instead of being asked to exit.
+            if worker['dispatcher'] is None or not worker['dispatcher'].is_alive():
+                try:
+                    worker['conn'].send(None)
+                except (OSError, ValueError):
+                    pass
+                worker['process'].join(timeout=10)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+            worker['conn'].close()
+            worker['shm'].close()
+            worker['shm'].unlink()
@@ -0,0 +1,73 @@
+import io
+import os
+import zipfile
+
+# Already-compressed image formats (and compressed .npz results) gain almost nothing from deflate, so they are stored as-is.
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tif', '.tiff', '.npz'}
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def zip_compress_type(filename) -> int:
+    '''
+    Returns the zipfile compression type for a file: ZIP_STORED for already-compressed images and ZIP_DEFLATED for everything else
+    (e.g. the JSON detection results).
+    '''
+    if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def write_zip(zip_path, files) -> None:
+    '''
+    Writes a list of (file path, name in archive) tuples to a zip file at zip_path, storing images uncompressed and deflating everything else.
+    '''
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for path, arcname in files:
+            zf.write(path, arcname, compress_type=zip_compress_type(arcname))
+
+class _ChunkWriter(io.RawIOBase):
+    '''
+    A write-only, unseekable file object that collects everything written to it until drained. zipfile falls back to writing data
+    descriptors after each entry when it can't seek, which is what lets the archive be streamed.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(files):
+    '''
+    A generator that builds a zip archive incrementally and yields its bytes as each entry is written. files may be any iterable of
+    (file path, name in archive) tuples, including one that blocks until the next file is ready, so the first entries reach the client
+    while later ones are still being produced. Images are stored uncompressed and everything else is deflated.
+    '''
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, 'w') as zf:
+        for path, arcname in files:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = zip_compress_type(arcname)
+            with open(path, 'rb') as src, zf.open(zinfo, 'w') as dest:
+                while True:
+                    block = src.read(STREAM_CHUNK_SIZE)
+                    if not block:
+                        break
+                    dest.write(block)
+                    data = writer.drain()
+                    if data:
+                        yield data
+            yield writer.drain()
+    yield writer.drain()
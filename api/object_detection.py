@@ -1,53 +1,701 @@
-import json
+import hmac
+import multiprocessing
 import os
 import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from typing import List
 
 import fastapi
-from fastapi import Depends, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import Depends, File, Header, HTTPException, UploadFile
+from fastapi.responses import (FileResponse, JSONResponse, Response,
+                               StreamingResponse)
 
 from data_models.user_submission import User_Submission
 
+import numpy as np
 from PIL import Image
 
-from api.api_utils.drawing_utils import plot_bboxes
-from api.api_utils.inference_utils import batch_inference, load_model
-from api.api_utils.preprocessing_utils import (calc_gsd, chip,
-                                               dont_resize_to_gsd,
-                                               ingest_image, reassemble_chips,
-                                               resize_to_gsd)
-from api.api_utils.server_utils import clean_temporary_files, security_check
+from api.api_utils.admission_utils import (ADMISSION_RESOURCES,
+                                           AdmissionRejected, InFlightBudget)
+from api.api_utils.batching_utils import DynamicBatcher
+from api.api_utils.cache_utils import DetectionCache, detection_cache_key
+from api.api_utils.drawing_utils import (category_index, plot_bboxes,
+                                         plot_bboxes_pyramid,
+                                         plot_bboxes_windowed,
+                                         tiff_plot_compression)
+from api.api_utils.inference_utils import (batch_inference, load_model,
+                                           threshold_detections)
+from api.api_utils.job_utils import (JOB_COMPLETE, JOB_QUEUED, JOB_RUNNING,
+                                     JobManager, JobQueueFull)
+from api.api_utils.metrics_utils import (PROMETHEUS_CONTENT_TYPE,
+                                         MetricsRegistry, span, timed_iter)
+from api.api_utils.output_utils import (detections_to_lists,
+                                        overlay_filename, results_filename,
+                                        write_overlay, write_results)
+from api.api_utils.pipeline_utils import Stage, StagedPipeline
+from api.api_utils.prefilter_utils import ChipPrefilter
+from api.api_utils.profiling_utils import RequestProfiler
+from api.api_utils.startup_utils import StartupLifecycle
+from api.api_utils.worker_pool_utils import (InferenceWorkerPool,
+                                             configure_tensorflow_threads)
+from api.api_utils.preprocessing_utils import (WindowedImage, calc_gsd,
+                                               check_resampled_size,
+                                               count_chips, image_size,
+                                               ingest_image, iter_chips,
+                                               iter_resampled_chips,
+                                               iter_windowed_chips,
+                                               prepare_resample_source,
+                                               reassemble_chips,
+                                               resampled_size,
+                                               scale_detections,
+                                               tiff_pixel_count, tile_offsets,
+                                               windowed_resample_source)
+from api.api_utils.server_utils import (UploadTooLarge, security_check,
+                                        spool_upload, sse_message)
+from api.api_utils.zip_utils import stream_zip, write_zip
 #from api.data_models.user_submission import User_Submission
 
 #HARDCODED API PARAMETERS
 TARGET_GSD_CM=2.0
 ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png", "image/tiff"]
 
-# SAVE FILE LOCATIONS
-CHIP_IMAGE_PATH="/app_data/chips"
-FINAL_OUTPUT_PATH="/app_data/final_outputs"
-FINAL_ZIP ="/app_data/api_outputs"
+# SAVE FILE LOCATIONS. Each job gets its own chips/, final_outputs/ and api_outputs.zip under JOBS_PATH/<job_id>/
+JOBS_PATH="/app_data/jobs"
+SPOOL_PATH="/app_data/spool"
 
-# MODELS
-LABEL_MAP_PBTXT = "/app/models/efficientdet-d0/md_labelmap_v6_20210810.pbtxt"
-PATH_TO_SAVED_MODEL="/app/models/efficientdet-d0/saved_model"
-model = load_model(PATH_TO_SAVED_MODEL)
+# TIFFs with at least this many pixels are processed window by window (see WindowedImage), with or without resampling, keeping memory flat.
+WINDOWED_MIN_PIXELS=50_000_000
+
+# UPLOAD LIMITS. Uploads are cut off with a 413 as they stream in once a file passes MAX_UPLOAD_FILE_BYTES or a request passes
+# MAX_REQUEST_BYTES (both enforced by RequestBodyLimitMiddleware while the form is received, see server.py). Each image's size is read from its header before it is decoded, and images over MAX_IMAGE_PIXELS are refused.
+MAX_UPLOAD_FILE_BYTES=4 * 1024**3
+MAX_REQUEST_BYTES=8 * 1024**3
+MAX_IMAGE_PIXELS=1_000_000_000
+
+# ADMISSION CONTROL. Caps the images, pixels and chips of all accepted but unfinished jobs (None for no limit). Requests that don't fit are
+# turned away with a 503 and a Retry-After header. Chips are counted at the uploaded resolution, an upper bound when resampling shrinks the image.
+MAX_INFLIGHT_IMAGES=64
+MAX_INFLIGHT_PIXELS=2_000_000_000
+MAX_INFLIGHT_CHIPS=20_000
+ADMISSION_RETRY_AFTER_SECONDS=10
+
+# JOB QUEUE
+MAX_CONCURRENT_JOBS=2
+MAX_PENDING_JOBS=16
+MAX_RETAINED_JOBS=50
+# The most progress events kept per job for /jobs/{job_id}/events. Older events are dropped once a job records more.
+MAX_EVENTS_PER_JOB=10_000
+
+# DETECTION CACHE. Unfiltered detections are cached by image content + resampling and chipping parameters + MODEL_VERSION, so resubmitting
+# an image with a different confidence threshold only re-filters and re-plots. Least-recently-used entries are evicted beyond DETECTION_CACHE_MAX_BYTES.
+DETECTION_CACHE=True
+DETECTION_CACHE_PATH="/app_data/detection_cache"
+DETECTION_CACHE_MAX_BYTES=2 * 1024**3
+
+# CHIPPING. Neighbouring chips share at least CHIP_OVERLAP pixels so objects on a seam are seen whole by one chip (None for the original
+# non-overlapping grid). Duplicate detections in the overlaps are merged with class-aware NMS at NMS_IOU_THRESHOLD.
+CHIP_SIZE=512
+CHIP_OVERLAP=64
+NMS_IOU_THRESHOLD=0.5
+
+# CHIP PREFILTER. Chips that are mostly edge padding, or near-uniform (open water, sand, sky), skip inference and are listed under
+# 'skipped_chips' in the results JSON. Set CHIP_PREFILTER=False to run every chip through the model.
+CHIP_PREFILTER=True
+PREFILTER_MAX_PADDING_FRACTION=0.95
+PREFILTER_MIN_STD=2.0
+# Optional histogram check: skip chips where one of PREFILTER_HISTOGRAM_BINS grayscale bins holds PREFILTER_MAX_HISTOGRAM_PEAK of the pixels.
+PREFILTER_HISTOGRAM_BINS=None
+PREFILTER_MAX_HISTOGRAM_PEAK=None
+
+# STAGED PIPELINE. Worker threads per stage, and the number of images allowed to wait in front of each stage.
+PIPELINE_STAGE_WORKERS = {'ingest': 2, 'resample': 2, 'chip': 1, 'infer': 1, 'serialize': 2}
+PIPELINE_QUEUE_SIZE=2
+# When > 0, the ingest and resample stages run together (see ingest_resample_stage()) in a shared pool of this many (spawned) processes instead
+# of on the stages' threads.
+PIPELINE_PROCESS_WORKERS=0
+
+# TILED PLOTS. With plot_format='tiles', each image plot is written as a Deep Zoom pyramid of PYRAMID_TILE_SIZE pixel JPEG tiles (at
+# PYRAMID_TILE_QUALITY) encoded on PYRAMID_ENCODE_WORKERS threads, plus a GeoJSON overlay of the boxes, instead of one full-size JPEG.
+PYRAMID_TILE_SIZE=256
+PYRAMID_TILE_QUALITY=85
+PYRAMID_ENCODE_WORKERS=4
+
+# PROFILING. Requests to /object-detection/?profile=true with an X-Profile-Token header matching PROFILING_TOKEN get a cProfile and Tensorflow
+# op trace of their batch_inference calls added to their results (see api/api_utils/profiling_utils.py). None turns profiling off.
+PROFILING_TOKEN=None
+
+# MODELS. Every model file lives under MODEL_DIR (scripts/bulk_detect.py --model-dir points these paths at another copy of the folder).
+MODEL_DIR="/app/models/efficientdet-d0"
+LABEL_MAP_PBTXT = f"{MODEL_DIR}/md_labelmap_v6_20210810.pbtxt"
+PATH_TO_SAVED_MODEL=f"{MODEL_DIR}/saved_model"
+# A re-export of the model with a dynamic batch dimension (see scripts/export_batched_model.py). Used in place of PATH_TO_SAVED_MODEL when present.
+PATH_TO_BATCHED_SAVED_MODEL=f"{MODEL_DIR}/saved_model_batched"
+INFERENCE_BATCH_SIZE=8
+# 'saved_model' runs the Tensorflow saved_model above. 'tflite' runs a CPU TFLite conversion of it (see scripts/convert_tflite_model.py and
+# benchmarks/backend_comparison_benchmark.py for picking a quantization) with TFLITE_NUM_THREADS interpreter threads.
+INFERENCE_BACKEND='saved_model'
+PATH_TO_TFLITE_MODEL=f"{MODEL_DIR}/model_float16.tflite"
+TFLITE_NUM_THREADS=4
+# Bump whenever the model weights change so cached detections from the old model are not reused.
+MODEL_VERSION="efficientdet-d0_md_labelmap_v6_20210810"
+# Merge chips from all in-flight jobs into shared batches of up to DYNAMIC_BATCH_MAX_SIZE chips, waiting at most DYNAMIC_BATCH_MAX_WAIT_MS for a batch to fill.
+DYNAMIC_BATCHING=True
+DYNAMIC_BATCH_MAX_SIZE=16
+DYNAMIC_BATCH_MAX_WAIT_MS=10
+# INFERENCE THREADS AND WORKERS. INFERENCE_INTRA_OP_THREADS and INFERENCE_INTER_OP_THREADS size Tensorflow's thread pools (None for its
+# defaults, which assume one process has the whole machine). With INFERENCE_WORKERS > 0 the model is loaded once in each of that many worker
+# processes instead of the API process, chips are handed to them through shared memory, and the dynamic batcher runs one batch per worker at a
+# time. INFERENCE_WORKER_CPU_AFFINITY='auto' pins each worker to its own share of the cores (its intra-op threads then default to that share);
+# None leaves placement to the OS. See benchmarks/worker_pool_benchmark.py for picking a worker count. TFLITE_NUM_THREADS applies per worker.
+INFERENCE_WORKERS=0
+INFERENCE_INTRA_OP_THREADS=None
+INFERENCE_INTER_OP_THREADS=None
+INFERENCE_WORKER_CPU_AFFINITY=None
+
+# Detections from a converted (and possibly quantized) TFLite model differ slightly, so they are cached separately.
+cache_model_version = MODEL_VERSION if INFERENCE_BACKEND == 'saved_model' else f"{MODEL_VERSION}:{os.path.basename(PATH_TO_TFLITE_MODEL)}"
+
+# The model is loaded and warmed up on a background thread once the server has started (see load_inference_model()), so the port is bound
+# straight away. /ready reports when it is done, and /object-detection/ turns requests away until then.
+model = None
+inference_model = None
+model_lifecycle = StartupLifecycle()
+
+# PIL's decompression bomb check follows the same limit (it warns above MAX_IMAGE_PIXELS and refuses images over twice it).
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
 
 # lookup table for hardcoded sensor parameters. Order is focal_length_mm, sensor_height_cm, sensor_width_cm
 SENSOR_DICT = {'skydio2':[3.7, 0.462196, 0.6166660],
                 'phantom4pro':[8.8, 0.88, 1.32]}
 
+chip_prefilter = ChipPrefilter(PREFILTER_MAX_PADDING_FRACTION, PREFILTER_MIN_STD, PREFILTER_HISTOGRAM_BINS, PREFILTER_MAX_HISTOGRAM_PEAK) if CHIP_PREFILTER else None
+
+# Opened by open_detection_cache() once the server is up, so importing this module (e.g. from scripts/bulk_detect.py) creates no folders.
+detection_cache = None
+
+# Started by start_process_pool() once the server is up.
+process_pool = None
+
+# Per-chip detection events are only kept while a job runs (and briefly after), since large orthomosaics produce thousands of them.
+job_manager = JobManager(JOBS_PATH, MAX_CONCURRENT_JOBS, MAX_PENDING_JOBS, MAX_RETAINED_JOBS, MAX_EVENTS_PER_JOB, transient_events=('chip_detections',))
+
+admission = InFlightBudget(MAX_INFLIGHT_IMAGES, MAX_INFLIGHT_PIXELS, MAX_INFLIGHT_CHIPS, ADMISSION_RETRY_AFTER_SECONDS)
+
+# METRICS, exported in the Prometheus text format at /metrics.
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram('mdapi_stage_seconds', "Time spent in each processing stage, per image (per request for security_check, per job for zip).")
+images_total = metrics.counter('mdapi_images_total', "Images processed.")
+chips_total = metrics.counter('mdapi_chips_total', "Image chips run through inference.")
+chips_skipped_total = metrics.counter('mdapi_chips_skipped_total', "Image chips skipped by the chip prefilter.")
+detections_total = metrics.counter('mdapi_detections_total', "Detections returned above the requested confidence threshold.")
+bytes_in_total = metrics.counter('mdapi_bytes_in_total', "Bytes of uploaded images received.")
+bytes_out_total = metrics.counter('mdapi_bytes_out_total', "Bytes of result zip files written.")
+requests_rejected_total = metrics.counter('mdapi_requests_rejected_total', "Object detection requests turned away, by reason.")
+for resource in ADMISSION_RESOURCES:
+  metrics.gauge(f'mdapi_inflight_{resource}', f"Admitted {resource} whose jobs have not finished.", partial(admission.current, resource))
+metrics.gauge('mdapi_jobs_queued', "Jobs waiting for a worker.", lambda: job_manager.count(JOB_QUEUED))
+metrics.gauge('mdapi_jobs_running', "Jobs being processed.", lambda: job_manager.count(JOB_RUNNING))
+metrics.gauge('mdapi_detection_cache_entries', "Entries in the detection cache.",
+              lambda: detection_cache.stats()['entries'] if detection_cache is not None else 0)
+metrics.gauge('mdapi_detection_cache_bytes', "Total size of the detection cache's entries.",
+              lambda: detection_cache.stats()['bytes'] if detection_cache is not None else 0)
+metrics.gauge('mdapi_inference_queue_depth', "Image chips waiting for the dynamic batcher.",
+              lambda: inference_model.pending.qsize() if isinstance(inference_model, DynamicBatcher) else 0)
+
 router = fastapi.APIRouter()
 
-@router.post('/object-detection/')
-async def object_detection(aerial_images: List[UploadFile] = File(...), sub: User_Submission = Depends(User_Submission.as_form)):
+def warmup_batch_sizes(supported_batch_size=None) -> list:
+    '''
+    Returns the batch sizes the model will be called with (single chips, INFERENCE_BATCH_SIZE, and DYNAMIC_BATCH_MAX_SIZE when dynamic
+    batching is on), capped at the largest batch the model accepts.
+    '''
+    sizes = {1, INFERENCE_BATCH_SIZE} | ({DYNAMIC_BATCH_MAX_SIZE} if DYNAMIC_BATCHING else set())
+    return sorted({size if supported_batch_size is None else min(size, supported_batch_size) for size in sizes})
+
+def inference_model_spec() -> tuple:
+    '''
+    Returns the (model path, backend options) that load_model() is called with for INFERENCE_BACKEND.
+    '''
+    if INFERENCE_BACKEND == 'tflite':
+      return PATH_TO_TFLITE_MODEL, {'num_threads': TFLITE_NUM_THREADS}
+    if os.path.exists(PATH_TO_BATCHED_SAVED_MODEL):
+      return PATH_TO_BATCHED_SAVED_MODEL, {}
+    return PATH_TO_SAVED_MODEL, {}
+
+def load_inference_model() -> None:
+    '''
+    Imports the inference backend, loads the model and runs a dummy CHIP_SIZE x CHIP_SIZE batch of each size from warmup_batch_sizes()
+    through it, so graph tracing is done before the first real request. Each phase is timed on model_lifecycle. With INFERENCE_WORKERS > 0
+    the loading and warmup happen in each worker process instead, timed together as one phase.
+    '''
+    global model, inference_model
+
+    model_path, backend_options = inference_model_spec()
+
+    if INFERENCE_WORKERS > 0:
+      with model_lifecycle.phase(f'start_{INFERENCE_WORKERS}_inference_workers'):
+        loaded_model = InferenceWorkerPool(partial(load_model, model_path, INFERENCE_BACKEND, **backend_options), INFERENCE_WORKERS,
+                                           (CHIP_SIZE, CHIP_SIZE, 3), max(INFERENCE_BATCH_SIZE, DYNAMIC_BATCH_MAX_SIZE),
+                                           INFERENCE_INTRA_OP_THREADS, INFERENCE_INTER_OP_THREADS, INFERENCE_WORKER_CPU_AFFINITY,
+                                           warmup_batch_sizes())
+    else:
+      configure_tensorflow_threads(INFERENCE_INTRA_OP_THREADS, INFERENCE_INTER_OP_THREADS)
+      if INFERENCE_BACKEND == 'saved_model':
+        with model_lifecycle.phase('import_tensorflow'):
+          import tensorflow  # noqa: F401 -- imported here only so its (slow) first import is timed as its own phase
+
+      with model_lifecycle.phase('load_model'):
+        loaded_model = load_model(model_path, INFERENCE_BACKEND, **backend_options)
+
+      for batch_size in warmup_batch_sizes(loaded_model.supported_batch_size):
+        with model_lifecycle.phase(f'warmup_batch_{batch_size}'):
+          loaded_model(np.zeros((batch_size, CHIP_SIZE, CHIP_SIZE, 3), dtype=np.uint8))
+
+    model = loaded_model
+    inference_model = DynamicBatcher(model, DYNAMIC_BATCH_MAX_SIZE, DYNAMIC_BATCH_MAX_WAIT_MS, max(INFERENCE_WORKERS, 1)) if DYNAMIC_BATCHING else model
+
+@router.on_event('startup')
+def start_model_loading() -> None:
+    model_lifecycle.start(load_inference_model)
+
+@router.on_event('startup')
+def open_detection_cache() -> None:
+    global detection_cache
+    if DETECTION_CACHE:
+      detection_cache = DetectionCache(DETECTION_CACHE_PATH, DETECTION_CACHE_MAX_BYTES)
+
+@router.on_event('startup')
+def start_process_pool() -> None:
+    '''
+    Starts the pipeline's process pool when PIPELINE_PROCESS_WORKERS > 0. Workers are spawned rather than forked, since forking a process
+    that is already running Tensorflow and the pipeline's threads can deadlock.
+    '''
+    global process_pool
+    if PIPELINE_PROCESS_WORKERS > 0:
+      process_pool = ProcessPoolExecutor(PIPELINE_PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+@router.on_event('startup')
+def check_plot_codecs() -> None:
+    '''
+    Logs at startup (rather than in the first large-TIFF job) when windowed image plots will fall back to zlib compression.
+    '''
+    tiff_plot_compression()
+
+@router.on_event('shutdown')
+def stop_process_pool() -> None:
+    if process_pool is not None:
+      process_pool.shutdown(wait=False)
+
+def cache_lookup_stage(item, sub, chip_image_path) -> dict:
+    '''
+    Pipeline stage: hashes one uploaded (filename, spooled image path) tuple and checks the detection cache. On a cache hit the image's
+    unfiltered detections and processed image are taken from the cache, and the ingest, resample, chip and infer stages pass it through.
+    '''
+    filename, img_path = item
+    base_img_name, base_img_ext = os.path.splitext(filename)
+    item = {'filename': filename, 'base_img_name': base_img_name, 'base_img_ext': base_img_ext, 'img_path': img_path, 'cache_key': None,
+            'timings': {}}
+
+    if detection_cache is not None:
+      with span(item['timings'], 'cache_lookup'):
+        item['cache_key'] = detection_cache_key(img_path, sub, TARGET_GSD_CM, cache_model_version, CHIP_SIZE, CHIP_OVERLAP, NMS_IOU_THRESHOLD,
+                                                chip_prefilter.config() if chip_prefilter is not None else None)
+        cached = detection_cache.get(item['cache_key'])
+        if cached is not None:
+          print(f"Found cached detections for {filename}, skipping inference.")
+          detections, cached_image_path = cached
+          # Copy the cached processed image into the job's workspace so a concurrent eviction can't remove it mid-job.
+          item['chip_base_img_path'] = os.path.join(chip_image_path, filename)
+          shutil.copyfile(cached_image_path, item['chip_base_img_path'])
+          item['results'] = {filename: detections}
+
+    return item
+
+def ingest_stage(item, sub) -> dict:
+    '''
+    Pipeline stage: decodes the spooled upload into a 3-band PIL image. Large TIFFs are not decoded here; they are flagged for windowed
+    processing, where chip_stage() and serialize_stage() read them from disk one window at a time (resampling them chip by chip when needed).
+    '''
+    if 'results' in item:
+      return item
+
+    with span(item['timings'], 'ingest_image'):
+      pixel_count = tiff_pixel_count(item['img_path'])
+      if pixel_count is not None and pixel_count >= WINDOWED_MIN_PIXELS:
+        print(f"{item['filename']} is a large TIFF ({pixel_count} pixels), using windowed processing.")
+        item['windowed'] = True
+        return item
+
+      # Images that will be resampled are left undecoded (and unconverted) so prepare_resample_source() can decode them at reduced size.
+      item['image'] = ingest_image(item['img_path'], convert_to_rgb=sub.skip_optional_resampling == True)
+    return item
+
+def resample_stage(item, sub) -> dict:
+    '''
+    Pipeline stage: works out whether (and to what size) the image needs resampling to the API's target GSD. Resampling itself is fused
+    with chipping (see iter_resampled_chips()), so no resampled copy of the image is made and nothing is written to disk here. The
+    image is decoded at the smallest resolution the resampling allows (see prepare_resample_source()). Windowed images are only sized
+    here, from their header; chip_stage() resamples them window by window.
+    '''
+    if 'results' in item:
+      return item
+
+    with span(item['timings'], 'resize_to_gsd'):
+      if item.get('windowed'):
+        original_size = image_size(item['img_path'])
+      else:
+        original_size = item['image'].size
+        # The spooled upload doubles as the image plot_bboxes() falls back to and the copy stored in the detection cache.
+        item['chip_base_img_path'] = item['img_path']
+
+      if sub.skip_optional_resampling == True:
+        print(f"User declined automatic resampling.")
+      else:
+        print(f"User opted in to automatic resampling.")
+        if sub.sensor_platform in SENSOR_DICT.keys():
+          sensor_focal_length, sensor_height, sensor_width = SENSOR_DICT[sub.sensor_platform]
+
+          width, height = original_size
+          est_gsd_height, est_gsd_width = calc_gsd(sub.flight_AGL, sensor_focal_length, height, width, sensor_height, sensor_width)
+
+          max_gsd = max(est_gsd_height, est_gsd_width)
+          print(f"Uploaded image's GSD was automatically computed to be {max_gsd} centimeters. Images are going to be resampled to the API's target GSD of {TARGET_GSD_CM} centimeters.")
+
+          item['output_size'] = resampled_size(width, height, max_gsd, TARGET_GSD_CM)
+          try:
+            if item.get('windowed'):
+              check_resampled_size(original_size, item['output_size'])
+            else:
+              item['resample_source'] = prepare_resample_source(item.pop('image'), item['output_size'])
+          except ValueError as e:
+            raise ValueError(f"{item['filename']}: {e}") from e
+          item['to_original_scale'] = (original_size[0] / item['output_size'][0], original_size[1] / item['output_size'][1])
+
+          # When the source wasn't decoded at reduced size it is the original image, and serialize_stage() can draw on it directly.
+          if 'resample_source' in item and item['resample_source'].shape[1::-1] == original_size:
+            item['image_array'] = item['resample_source']
+        else:
+          raise ValueError(f"{sub.sensor_platform} is not a supported value. Specify sensor model ('skydio2' or 'phantom4pro') for automatic resampling or value of 'NA' to skip automatic resampling.")
+
+    return item
+
+def ingest_resample_stage(item, sub) -> dict:
+    '''
+    Pipeline stage: ingest_stage() and resample_stage() in one call, used in their place when they run in the process pool. The image is
+    opened from its spooled path in the worker process, so only the reduced resample source (or, without resampling, the decoded image as
+    an array) is sent back to the API process. A lazily opened PIL image would instead be decoded at full resolution to be pickled.
+    '''
+    item = resample_stage(ingest_stage(item, sub), sub)
+    if 'image' in item:
+      item['image_array'] = np.asarray(item.pop('image'))
+    return item
+
+def chip_stage(item, opened_images=None) -> dict:
+    '''
+    Pipeline stage: converts the processed image to a numpy array and sets up the lazy iter_chips() generator over it. The array is kept on the
+    item so serialize_stage() can draw on it without re-reading the image from disk. Windowed images are opened with WindowedImage and chipped
+    band by band with iter_windowed_chips() instead, and images being resampled are chipped with iter_resampled_chips() (windowed images
+    from windows read off disk, see windowed_resample_source()). Opened WindowedImages are also appended to opened_images, so the job can
+    close them if it fails before serialize_stage() does.
+    '''
+    if 'results' in item:
+      return item
+
+    chip_args = (item['base_img_name'], item['base_img_ext'], CHIP_SIZE, CHIP_SIZE, CHIP_OVERLAP)
+
+    if item.get('windowed'):
+      item['windowed_image'] = WindowedImage(item['img_path'])
+      if opened_images is not None:
+        opened_images.append(item['windowed_image'])
+      if 'output_size' in item:
+        width, height = item['output_size']
+        item['chips'] = iter_resampled_chips(windowed_resample_source(item['windowed_image'], item['output_size']), item['output_size'], *chip_args)
+      else:
+        width, height = item['windowed_image'].size
+        item['chips'] = iter_windowed_chips(item['windowed_image'], *chip_args)
+    elif 'resample_source' in item:
+      width, height = item['output_size']
+      item['chips'] = iter_resampled_chips(item.pop('resample_source'), item['output_size'], *chip_args)
+    else:
+      if 'image_array' not in item:
+        item['image_array'] = np.asarray(item.pop('image'))
+      height, width = item['image_array'].shape[:2]
+      item['chips'] = iter_chips(item['image_array'], *chip_args)
+
+    item['chip_offsets'] = tile_offsets(height, width, *chip_args)
+    # Chips (and resampling, for resampled images) are produced lazily as inference pulls them, so their time is measured as they are drawn.
+    item['chips'] = timed_iter(item['chips'], item['timings'], 'chip')
+    return item
+
+def prefilter_stage(item) -> dict:
+    '''
+    Pipeline stage: wraps the image's lazy chip generator with the chip prefilter, so blank, padded and uniform chips are dropped before
+    they are batched for inference. Skipped chips are collected on the item and reported in the results JSON.
+    '''
+    if 'results' in item:
+      return item
+
+    item['skipped_chips'] = []
+    if chip_prefilter is not None:
+      item['chips'] = timed_iter(chip_prefilter.filter(item['chips'], item['skipped_chips']), item['timings'], 'chips_produced')
+    return item
+
+def chip_detection_events(item, batch_results, confidence_threshold) -> list:
+    '''
+    Returns the 'chip_detections' event data for each chip in a batch with detections above the confidence threshold. Bboxes are mapped to
+    [ymin, xmin, ymax, xmax] pixels in the uploaded image, but duplicates in chip overlaps are not merged until the image is reassembled.
+    '''
+    events = []
+    for chip_name, detections in batch_results.items():
+      detections = threshold_detections(detections, confidence_threshold)
+      if not len(detections['scores']):
+        continue
+
+      top, left = item['chip_offsets'][chip_name]
+      detections = dict(detections, bboxes=detections['bboxes'] + np.array([top, left, top, left], dtype=np.int32))
+      if 'to_original_scale' in item:
+        detections = scale_detections(detections, *item['to_original_scale'])
+      events.append(dict(detections_to_lists(detections), image=item['filename'], chip=chip_name))
+    return events
+
+def infer_item(item, model, on_batch=None, profiler=None) -> dict:
+    '''
+    Runs batch_inference() over a chipped item's chips with the given model and reassembles the chip detections into item['results'], unfiltered
+    and in the uploaded image's coordinates. The core of infer_stage(), also used to run the pipeline without the API (see scripts/bulk_detect.py).
+    '''
+    print("Beginning Inference...")
+    timings = item['timings']
+    with span(timings, 'batch_inference'), profiler.profile(item['filename']) if profiler is not None else nullcontext():
+      inference_results = batch_inference(item.pop('chips'), model, 0.0, INFERENCE_BATCH_SIZE, on_batch)
+
+    # Chipping and prefiltering happen inside batch_inference() as it pulls chips, so their time is moved out of its span.
+    chips_produced = timings.pop('chips_produced', timings.get('chip', 0.0))
+    timings['batch_inference'] -= chips_produced
+    if chip_prefilter is not None:
+      timings['chip_prefilter'] = chips_produced - timings.get('chip', 0.0)
+      chip_prefilter.record_inference(len(inference_results), timings['batch_inference'])
+    item['n_chips'] = len(inference_results)
+    print(f"Num of inference images: {len(inference_results)}, skipped chips: {len(item['skipped_chips'])}")
+
+    with span(timings, 'reassemble_chips'):
+      item['results'] = reassemble_chips(inference_results, item.pop('chip_offsets'), NMS_IOU_THRESHOLD, item['filename'], CHIP_SIZE, CHIP_SIZE)
+
+      # Detections on a resampled image are mapped back onto the original image, which is what gets plotted and cached.
+      if 'to_original_scale' in item:
+        item['results'] = {k: scale_detections(v, *item['to_original_scale']) for k, v in item['results'].items()}
+
+    item['results'][item['filename']]['skipped_chips'] = item.pop('skipped_chips')
+
+    return item
+
+def infer_stage(item, workspace, confidence_threshold, profiler=None) -> dict:
+    '''
+    Pipeline stage: runs batch_inference() over the image's chips and reassembles the chip detections into original image coordinates. Detections are
+    kept unfiltered (the confidence threshold is applied in serialize_stage) so they can be stored in the detection cache. Progress and each
+    chip's detections above the confidence threshold are recorded as job events after every batch, which is also where a cancelled job stops.
+    When the job is being profiled, batch_inference() runs under the job's RequestProfiler.
+    '''
+    if 'results' in item:
+      return item
+
+    job_id = workspace['job_id']
+    chips_total = len(item['chip_offsets'])
+    job_manager.raise_if_cancelled(job_id)
+    job_manager.add_event(job_id, 'image_started', {'image': item['filename'], 'chips_total': chips_total})
+
+    chips_inferred = 0
+    def on_batch(batch_results):
+      nonlocal chips_inferred
+      chips_inferred += len(batch_results)
+      for event in chip_detection_events(item, batch_results, confidence_threshold):
+        job_manager.add_event(job_id, 'chip_detections', event)
+      job_manager.add_event(job_id, 'progress', {'image': item['filename'], 'chips_done': chips_inferred + len(item['skipped_chips']),
+                                                 'chips_skipped': len(item['skipped_chips']), 'chips_total': chips_total})
+      job_manager.raise_if_cancelled(job_id)
+
+    infer_item(item, inference_model, on_batch, profiler)
+
+    # Windowed images are too large to keep a copy of in the cache.
+    if detection_cache is not None and not item.get('windowed'):
+      with span(item['timings'], 'cache_store'):
+        detection_cache.put(item['cache_key'], item['results'][item['filename']], item['chip_base_img_path'])
+
+    return item
+
+def write_image_outputs(item, output_dir, confidence_threshold, output_format='json', plot_format='image') -> tuple:
+    '''
+    Filters an inferred item's detections by the confidence threshold, draws them on the processed image and writes the plot and the results
+    file to output_dir. The core of serialize_stage(), also used to run the pipeline without the API (see scripts/bulk_detect.py).
+
+    OUTPUTS:
+      -  The thresholded results, and a list of the written files' paths relative to output_dir.
+    '''
+    timings = item['timings']
+    results = {k: threshold_detections(v, confidence_threshold) for k, v in item['results'].items()}
+    cat_index = category_index(LABEL_MAP_PBTXT)
+
+    outputs = []
+    image_sizes = {}
+    with span(timings, 'plot_bboxes'):
+      for k, v in results.items():
+        if item.get('windowed'):
+          image_sizes[k] = item['windowed_image'].size
+          image_source = item['windowed_image']
+        else:
+          image_source = item.pop('image_array', None)
+          if output_format == 'coco' or plot_format == 'tiles':
+            image_sizes[k] = image_source.shape[1::-1] if image_source is not None else Image.open(item['chip_base_img_path']).size
+
+        if plot_format == 'tiles':
+          base_name = os.path.splitext(k)[0]
+          outputs.extend(plot_bboxes_pyramid(base_name, output_dir, image_source if image_source is not None else item['chip_base_img_path'],
+                                             LABEL_MAP_PBTXT, v, confidence_threshold, PYRAMID_TILE_SIZE, PYRAMID_TILE_QUALITY, PYRAMID_ENCODE_WORKERS))
+          write_overlay(os.path.join(output_dir, overlay_filename(base_name)), v, cat_index, image_sizes[k])
+          outputs.append(overlay_filename(base_name))
+        elif item.get('windowed'):
+          plot_bboxes_windowed(k, output_dir, image_source, LABEL_MAP_PBTXT, v, confidence_threshold)
+          outputs.append(k)
+        else:
+          plot_bboxes(k, output_dir, item['chip_base_img_path'], LABEL_MAP_PBTXT, v, confidence_threshold, image_source)
+          outputs.append(k)
+
+    close_windowed_image(item)
+
+    results_name = results_filename(item['base_img_name'], output_format)
+    with span(timings, 'results_write'):
+      write_results(os.path.join(output_dir, results_name), results, output_format, image_sizes, cat_index)
+    outputs.append(results_name)
+    return results, outputs
+
+def close_windowed_image(item) -> None:
+    '''
+    Closes the item's WindowedImage, if it has one. Called once the image's outputs are written, and by callers cleaning up after a failure.
+    '''
+    windowed_image = item.pop('windowed_image', None)
+    if windowed_image is not None:
+      windowed_image.close()
+
+def serialize_stage(item, workspace, confidence_threshold, output_format='json', plot_format='image') -> dict:
+    '''
+    Pipeline stage: filters the detections by the user's confidence threshold, draws them on the processed image and writes the image's
+    results to the job's output folder in the requested output format (see output_utils.write_results()). With plot_format='tiles' the plot
+    is written as a Deep Zoom tile pyramid with a GeoJSON box overlay (see drawing_utils.plot_bboxes_pyramid()) instead of a single image.
+    The finished files are then recorded on the job so results streams can pick them up.
+    '''
+    results, outputs = write_image_outputs(item, workspace['output_dir'], confidence_threshold, output_format, plot_format)
+
+    job_manager.add_outputs(workspace['job_id'], outputs)
+    job_manager.add_event(workspace['job_id'], 'image_complete', {'image': item['filename'], 'cached': 'n_chips' not in item,
+                                                                  'detections': sum(len(v['scores']) for v in results.values()),
+                                                                  'outputs': outputs})
+
+    # The image's spans were collected on the item (possibly across pipeline processes) and are exported here, once it is finished.
+    timings = item['timings']
+    for stage, seconds in timings.items():
+      stage_seconds.observe(seconds, stage=stage)
+    job_manager.add_timings(workspace['job_id'], timings)
+    images_total.inc()
+    detections_total.inc(sum(len(v['scores']) for v in results.values()))
+    if 'n_chips' in item:
+      chips_total.inc(item['n_chips'])
+      chips_skipped_total.inc(len(item['results'][item['filename']]['skipped_chips']))
+
+    return item
+
+def run_object_detection(workspace, images, sub, spool_dir=None, admission_reservation=None, profile=False) -> None:
+    '''
+    Runs the full object detection pipeline (cache lookup, ingest, optional resampling, chipping, inference, reassembly, plotting) for one job. Each step runs
+    as a stage of a StagedPipeline, so consecutive images overlap (e.g. image N+1 is decoded while image N is in inference). All intermediate
+    and final files are written inside the job's own workspace, and the final outputs are zipped to workspace['zip_base'].zip (images stored,
+    JSON deflated).
+
+    INPUTS:
+      -  workspace: a dictionary of job folder paths, as created by JobManager.workspace().
+      -  images: a list of (filename, spooled image path) tuples.
+      -  sub: the User_Submission form values for the job.
+      -  spool_dir: the folder the uploads were spooled to. It is removed once the job is done.
+      -  admission_reservation: the job's share of the in-flight budget, released once the pipeline has finished.
+      -  profile: profile the job's batch_inference() calls and add the profile (under profile/) to the job's outputs.
+    '''
+    chip_image_path = workspace['chip_dir']
+    final_output_path = workspace['output_dir']
+    profiler = RequestProfiler(final_output_path) if profile else None
+    # Large TIFFs opened by chip_stage(). serialize_stage() closes each one, but items dropped by a failed or cancelled job never reach it.
+    opened_images = []
+
+    if process_pool is not None:
+      load_stages = [Stage('ingest_resample', partial(ingest_resample_stage, sub=sub), PIPELINE_STAGE_WORKERS['ingest'] + PIPELINE_STAGE_WORKERS['resample'], process_pool)]
+    else:
+      load_stages = [Stage('ingest', partial(ingest_stage, sub=sub), PIPELINE_STAGE_WORKERS['ingest']),
+                     Stage('resample', partial(resample_stage, sub=sub), PIPELINE_STAGE_WORKERS['resample'])]
+
+    pipeline = StagedPipeline([
+        Stage('cache_lookup', partial(cache_lookup_stage, sub=sub, chip_image_path=chip_image_path), 1),
+        *load_stages,
+        Stage('chip', partial(chip_stage, opened_images=opened_images), PIPELINE_STAGE_WORKERS['chip']),
+        Stage('prefilter', prefilter_stage, 1),
+        Stage('infer', partial(infer_stage, workspace=workspace, confidence_threshold=sub.confidence_threshold, profiler=profiler), PIPELINE_STAGE_WORKERS['infer']),
+        Stage('serialize', partial(serialize_stage, workspace=workspace, confidence_threshold=sub.confidence_threshold, output_format=sub.output_format, plot_format=sub.plot_format), PIPELINE_STAGE_WORKERS['serialize']),
+    ], PIPELINE_QUEUE_SIZE)
+    try:
+      job_manager.raise_if_cancelled(workspace['job_id'])
+      pipeline.run(images)
+    finally:
+      for windowed_image in opened_images:
+        windowed_image.close()
+      if spool_dir is not None:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+      if admission_reservation is not None:
+        admission.release(admission_reservation)
+
+    if profiler is not None:
+      job_manager.add_outputs(workspace['job_id'], profiler.write())
+
+    # Final outputs are kept in the workspace (until the job is evicted) so /jobs/{job_id}/results/stream can still read them.
+    outputs = job_manager.get(workspace['job_id'])['outputs']
+    zip_timings = {}
+    with span(zip_timings, 'zip'):
+      write_zip(workspace['zip_base'] + '.zip', [(os.path.join(final_output_path, f), f) for f in outputs])
+    stage_seconds.observe(zip_timings['zip'], stage='zip')
+    job_manager.add_timings(workspace['job_id'], zip_timings)
+    bytes_out_total.inc(os.path.getsize(workspace['zip_base'] + '.zip'))
+
+def rejected_request(status_code, reason, detail, retry_after=None) -> HTTPException:
+    '''
+    Counts a request turned away by the upload limits or admission control, and returns the HTTPException to raise for it.
+    '''
+    requests_rejected_total.inc(reason=reason)
+    return HTTPException(status_code=status_code, detail=detail, headers={'Retry-After': str(retry_after)} if retry_after is not None else None)
+
+def checked_image_size(filename, img_path) -> tuple:
+    '''
+    Reads a spooled upload's (width, height) from its header, refusing images over MAX_IMAGE_PIXELS (413) or that can't be read as an
+    image (400) before any pixels are decoded.
+    '''
+    try:
+      width, height = image_size(img_path)
+    except Image.DecompressionBombError:
+      raise rejected_request(413, 'image_pixels', f"{filename} has more than the {MAX_IMAGE_PIXELS} pixel limit per image.")
+    except Exception as e:
+      raise rejected_request(400, 'unreadable_image', f"{filename} could not be read as an image: {e}")
+
+    if MAX_IMAGE_PIXELS is not None and width * height > MAX_IMAGE_PIXELS:
+      raise rejected_request(413, 'image_pixels', f"{filename} has {width * height} pixels, more than the {MAX_IMAGE_PIXELS} pixel limit per image.")
+    return width, height
+
+@router.post('/object-detection/', status_code=202)
+async def object_detection(aerial_images: List[UploadFile] = File(...), sub: User_Submission = Depends(User_Submission.as_form),
+                           profile: bool = False, x_profile_token: str = Header(None)):
     '''
     This endpoint will accept non-georeferenced, 2 centimeter aerial imagery typically taken from airplane or Unmanned Aerial Systems (UAS).\n
     
     Optional image resampling to 2 centimeter resolution can be performed if desired. This requires the user to submit additional flight parameters.\n
     
-    The resulting zip file from this operation can be retrieved at the associated /object-detection-results/ GET endpoint.
+    Uploads are queued as a background job and this endpoint returns immediately with the job's id. Job progress can be checked at the
+    /jobs/{job_id} GET endpoint (or followed live at /jobs/{job_id}/events) and the resulting zip file retrieved at the /jobs/{job_id}/results GET endpoint.
 
     INPUTS: 
       -  aerial_images: a list of non-georeferenced aerial images of coastal zones on which marine debris object detection is to be performed
@@ -58,66 +706,260 @@ async def object_detection(aerial_images: List[UploadFile] = File(...), sub: Use
            This value is optional when skip_optional_resampling=True.
       - confidence threshold (optional): each prediction from the computer vision model has a confidence score attached. This threshold filters low confidence
            detections from being shown on the image plots. By default this value is set to 0.3 (30% confidence). Recommended values range from 0.2 to 0.5.
+      - output_format (optional): the format of each image's detection results. 'json' (default) for lists of bboxes, classes and scores, 'npz' for
+           compact columnar NumPy arrays, or 'coco' for COCO-style JSON.
+      - plot_format (optional): 'image' (default) for one annotated image per upload, or 'tiles' for a Deep Zoom tile pyramid (name.dzi and
+           name_files/) that a viewer such as OpenSeadragon can pan and zoom, plus a name_overlay.geojson layer of the boxes in pixel coordinates.
 
     OUTPUTS:
-      -  MESSAGE: "Successful Object Detection!"
-      -  a compressed file (.zip) which contains:
-           1. Image chips showing the location, classification, and confidence score for each predicted marine debris object in the input files.
-           2. A JSON file that contains lists of the bboxes, classes, and scores for each predicted marine debris object in each image chip.
+      -  job_id: the id of the queued object detection job.
+      -  status_url, events_url, results_url: the endpoints at which the job's status, progress events and results can be retrieved.
+      -  Once the job is complete, a compressed file (.zip) which contains:
+           1. Image chips (or tile pyramids) showing the location, classification, and confidence score for each predicted marine debris object in the input files.
+           2. A results file (in the requested output_format) that contains the bboxes, classes, and scores for each predicted marine debris object
+              in each image. Bboxes are [ymin, xmin, ymax, xmax] pixel coordinates in the uploaded image, even when it was resampled for inference
+              ([x, y, width, height] in COCO files).
+
+    Uploads over the API's size limits are refused with a 413 status. When the API already has as much work in flight as it can take, requests
+    are refused with a 503 status and a Retry-After header giving the number of seconds to wait before trying again.
+
+    Administrators can add ?profile=true, with the API's profiling token in an X-Profile-Token header, to have a profile of the job's
+    inference (profile/summary.txt, a .pstats file and any Tensorflow op trace) included in its results. Without the token this is refused with a 403 status.
     '''
-    clean_temporary_files(CHIP_IMAGE_PATH, FINAL_OUTPUT_PATH)
+    if profile and (PROFILING_TOKEN is None or x_profile_token is None or not hmac.compare_digest(x_profile_token, PROFILING_TOKEN)):
+      raise rejected_request(403, 'profiling_forbidden', "Profiling requires a valid X-Profile-Token header.")
+    if not model_lifecycle.ready:
+      raise rejected_request(503, 'not_ready', f"The model is not ready yet ({model_lifecycle.state}). See /ready.", 5)
 
     print(f"Received {len(aerial_images)} images.")
-    screened_images = security_check(aerial_images, ALLOWED_CONTENT_TYPES)
+    request_timings = {}
+    with span(request_timings, 'security_check'):
+      screened_images = security_check(aerial_images, ALLOWED_CONTENT_TYPES)
+    stage_seconds.observe(request_timings['security_check'], stage='security_check')
     print(f"Accepted {len(screened_images)} images.")
-    
-    for file in screened_images:
-        base_img_name, base_img_ext = os.path.splitext(file.filename)
-        chip_base_img_path = os.path.join(CHIP_IMAGE_PATH, file.filename)
 
-        img_content = await file.read()
+    # Uploads are spooled to disk in chunks rather than read into memory, so large orthomosaics never sit in RAM as encoded bytes. Each
+    # image's size is read from its header as soon as it is spooled, and the request's images, pixels and chips are admitted as a whole.
+    spool_dir = os.path.join(SPOOL_PATH, uuid.uuid4().hex)
+    images, pixels, chips = [], 0, 0
+    try:
+      for i, file in enumerate(screened_images):
+        # Only the file's own name is used (for the spooled copy, cached copy, plots and results), so names like ../x.jpg stay in the job's folders.
+        filename = os.path.basename(file.filename)
+        if filename in ('', '.', '..'):
+          raise rejected_request(400, 'invalid_filename', f"{file.filename!r} is not a valid file name.")
+        img_path = os.path.join(spool_dir, f"{i}_{filename}")
+        try:
+          bytes_in_total.inc(await spool_upload(file, img_path, max_bytes=MAX_UPLOAD_FILE_BYTES))
+        except UploadTooLarge as e:
+          raise rejected_request(413, 'file_bytes', str(e))
 
-        in_image = ingest_image(img_content)
+        width, height = checked_image_size(filename, img_path)
+        images.append((filename, img_path))
+        pixels += width * height
+        chips += count_chips(height, width, CHIP_SIZE, CHIP_SIZE, CHIP_OVERLAP)
 
-        if sub.skip_optional_resampling == True:
-          print(f"User declined automatic resampling.")
-          processed_image = dont_resize_to_gsd(in_image, chip_base_img_path)
-        else:
-          print(f"User opted in to automatic resampling.")
-          if sub.sensor_platform in SENSOR_DICT.keys():
-            sensor_focal_length, sensor_height, sensor_width = SENSOR_DICT[sub.sensor_platform]
-
-            est_gsd_height, est_gsd_width = calc_gsd(sub.flight_AGL, sensor_focal_length, in_image.height, in_image.width, sensor_height, sensor_width)
-
-            max_gsd = max(est_gsd_height, est_gsd_width)
-            print(f"Uploaded image's GSD was automatically computed to be {max_gsd} centimeters. Images are going to be resampled to the API's target GSD of {TARGET_GSD_CM} centimeters.")
-
-            processed_image = resize_to_gsd(in_image, max_gsd, chip_base_img_path, TARGET_GSD_CM)
-          else:
-            print(f"{sub.sensor_platform} is not a supported value. Specify sensor model ('skydio2' or 'phantom4pro') for automatic resampling or value of 'NA' to skip automatic resampling.")
-        
-        chip_dict = chip(processed_image, base_img_name, base_img_ext, CHIP_IMAGE_PATH)
-        
-        print("Beginning Inference...")
-        inference_results = batch_inference(chip_dict, model, sub.confidence_threshold)
-
-        reassembled_results = reassemble_chips(inference_results)
-        
-        for k, v in reassembled_results.items():
-          plot_bboxes(k, FINAL_OUTPUT_PATH, chip_base_img_path, LABEL_MAP_PBTXT, v, sub.confidence_threshold)
-
-        results_path = os.path.join(FINAL_OUTPUT_PATH, f'{base_img_name}_inference_results.json')
-        with open(results_path, 'w') as outfile:
-            json.dump(reassembled_results, outfile, indent=0)
-      
-    shutil.make_archive(FINAL_ZIP, 'zip', FINAL_OUTPUT_PATH)
-    clean_temporary_files(CHIP_IMAGE_PATH, FINAL_OUTPUT_PATH)
-    return("Successful Object Detection! Retrieve results at /object-detection-results/ endpoint.")
+      try:
+        reservation = admission.acquire(len(images), pixels, chips)
+      except AdmissionRejected as e:
+        if e.retry_after is None:
+          raise rejected_request(413, 'over_budget', f"The request is too large for the API to process. {e}")
+        raise rejected_request(503, 'busy', f"The API is busy, please try again later. {e}", e.retry_after)
+    except HTTPException:
+      shutil.rmtree(spool_dir, ignore_errors=True)
+      raise
+
+    try:
+      job_id = job_manager.submit(run_object_detection, images, sub, spool_dir=spool_dir, admission_reservation=reservation, profile=profile)
+    except JobQueueFull as e:
+      admission.release(reservation)
+      shutil.rmtree(spool_dir, ignore_errors=True)
+      raise rejected_request(503, 'job_queue_full', f"The API is busy, please try again later. {e}", ADMISSION_RETRY_AFTER_SECONDS)
+
+    return {'message': "Object detection job queued!", 'job_id': job_id,
+            'status_url': f"/jobs/{job_id}", 'events_url': f"/jobs/{job_id}/events", 'results_url': f"/jobs/{job_id}/results"}
+
+@router.get('/jobs/{job_id}')
+async def job_status(job_id: str):
+    '''
+    This GET function returns the status of an object detection job queued by the POST function /object-detection/.
+
+    INPUTS: 
+      -  job_id: the id returned by /object-detection/.
+
+    OUTPUTS:
+      - The job's status ('queued', 'running', 'complete', 'failed' or 'cancelled'), timestamps, and error message if the job failed.
+    '''
+    job = job_manager.get(job_id)
+    if job is None:
+      raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+
+    return job
+
+@router.get('/jobs/{job_id}/results')
+async def job_results(job_id: str):
+    '''
+    This GET function returns the zipped prediction results of a completed object detection job.
+
+    INPUTS: 
+      -  job_id: the id returned by /object-detection/.
+
+    OUTPUTS:
+      - The job's zip file containing API object detection predictions.
+    '''
+    job = job_manager.get(job_id)
+    if job is None:
+      raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    if job['status'] != JOB_COMPLETE:
+      raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}, results are not available.")
+
+    return FileResponse(job_manager.results_path(job_id), media_type='application/octet-stream', filename="api_outputs.zip")
+
+@router.get('/jobs/{job_id}/results/stream')
+def job_results_stream(job_id: str):
+    '''
+    This GET function streams an object detection job's results as a zip file while the job is still running. Each image's plot and JSON
+    results are added to the zip as soon as they are finished, so the download starts before the whole job is done. The stream ends when
+    the job completes (or fails, in which case the zip contains only the images that finished).
+
+    INPUTS: 
+      -  job_id: the id returned by /object-detection/.
+
+    OUTPUTS:
+      - A streamed zip file containing API object detection predictions.
+    '''
+    if job_manager.get(job_id) is None:
+      raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+
+    return StreamingResponse(stream_zip(job_manager.iter_outputs(job_id)), media_type='application/zip',
+                             headers={'Content-Disposition': 'attachment; filename="api_outputs.zip"'})
+
+@router.get('/jobs/{job_id}/events')
+def job_events(job_id: str, last_event_id: str = Header(None)):
+    '''
+    This GET function streams an object detection job's progress as Server-Sent Events (text/event-stream), so clients can show progress
+    and render detections while the job runs instead of polling. Each event's data is JSON:
+      -  image_started: {image, chips_total} when inference on an image begins.
+      -  progress: {image, chips_done, chips_skipped, chips_total} after each inference batch (skipped chips count as done).
+      -  chip_detections: {image, chip, bboxes, scores, classes} for each chip with detections above the job's confidence threshold. Bboxes
+           are [ymin, xmin, ymax, xmax] pixels in the uploaded image; duplicates in chip overlaps are only merged in the image's results file.
+      -  image_complete: {image, cached, detections, outputs} once an image's results have been written.
+      -  end: {status, error} once the job is finished, after which the stream closes.
+    Events carry ids, so a reconnecting client (e.g. a browser EventSource) resumes after the last event it received.
+
+    INPUTS: 
+      -  job_id: the id returned by /object-detection/.
+
+    OUTPUTS:
+      - A stream of Server-Sent Events.
+    '''
+    if job_manager.get(job_id) is None:
+      raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+
+    start = int(last_event_id) + 1 if last_event_id is not None and last_event_id.isdigit() else 0
+
+    def event_stream():
+      for event in job_manager.iter_events(job_id, start):
+        yield sse_message(None, None) if event is None else sse_message(event[1], event[2], event[0])
+
+      job = job_manager.get(job_id)
+      if job is not None:
+        yield sse_message('end', {'status': job['status'], 'error': job['error']})
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@router.delete('/jobs/{job_id}')
+async def cancel_job(job_id: str):
+    '''
+    This DELETE function cancels a queued or running object detection job, e.g. once a client watching /jobs/{job_id}/events has seen
+    enough. A running job stops after its current inference batch and is then reported as 'cancelled'.
+
+    INPUTS: 
+      -  job_id: the id returned by /object-detection/.
+
+    OUTPUTS:
+      - A message confirming the cancellation was requested.
+    '''
+    job = job_manager.get(job_id)
+    if job is None:
+      raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    if not job_manager.cancel(job_id):
+      raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']} and can't be cancelled.")
+
+    return {'message': f"Cancellation of job {job_id} requested."}
+
+@router.get('/inference-batcher-stats')
+async def inference_batcher_stats():
+    '''
+    This GET function reports the state of the dynamic batcher that merges image chips from all in-flight jobs into shared model batches.
+
+    INPUTS: 
+      -  NONE
+
+    OUTPUTS:
+      - The batcher's settings, current queue depth, and histograms of batch sizes and chip queue wait times (in milliseconds).
+    '''
+    if not isinstance(inference_model, DynamicBatcher):
+      raise HTTPException(status_code=404, detail="Dynamic batching is disabled.")
+
+    return inference_model.stats()
+
+@router.get('/ready')
+async def ready():
+    '''
+    This GET function reports whether the model has been loaded and warmed up, and how long each startup phase took. Unlike /test-api/,
+    which only shows the server is up, it returns a 503 status until the app can serve object detection requests, so it can be used as a
+    load balancer or orchestrator readiness check.
+
+    INPUTS: 
+      -  NONE
+
+    OUTPUTS:
+      - The startup status ('loading', 'ready' or 'failed'), any startup error, and the duration of each startup phase in seconds.
+    '''
+    status = model_lifecycle.status()
+    if not model_lifecycle.ready:
+      return JSONResponse(status_code=503, content=status)
+    return status
+
+@router.get('/metrics')
+def prometheus_metrics():
+    '''
+    This GET function exports the API's metrics in the Prometheus text format: histograms of the time spent in each processing stage
+    (security_check, cache_lookup, ingest_image, resize_to_gsd, chip, chip_prefilter, batch_inference, reassemble_chips, cache_store,
+    plot_bboxes, results_write and zip), counters of images, chips, skipped chips, detections and bytes in and out, the current job and
+    inference queue depths, and the detection cache's size.
+
+    INPUTS: 
+      -  NONE
+
+    OUTPUTS:
+      - The metrics, as Prometheus text.
+    '''
+    return Response(metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+@router.get('/chip-prefilter-stats')
+async def chip_prefilter_stats():
+    '''
+    This GET function reports how many image chips the chip prefilter has kept out of inference since the server started.
+
+    INPUTS: 
+      -  NONE
+
+    OUTPUTS:
+      - The prefilter's thresholds, counts of chips seen, skipped (by reason) and inferred, and an estimate of the inference time saved
+        (skipped chips multiplied by the mean inference time per chip).
+    '''
+    if chip_prefilter is None:
+      raise HTTPException(status_code=404, detail="The chip prefilter is disabled.")
+
+    return chip_prefilter.stats()
 
 @router.get('/object-detection-results/')
 async def receive_results():
     '''
-    This GET function returns the zipped prediction results generated by the POST function /object-detection/.
+    This GET function returns the zipped prediction results of the most recently completed /object-detection/ job. Prefer
+    /jobs/{job_id}/results, which returns the results of a specific job.
 
     INPUTS: 
       -  NONE
@@ -125,6 +967,10 @@ async def receive_results():
     OUTPUTS:
       - Latest written zip file containing API object detection predictions.
     '''
-    response = FileResponse(FINAL_ZIP+str('.zip'), media_type='application/octet-stream',filename="api_outputs.zip")
+    job = job_manager.latest_complete()
+    if job is None:
+      raise HTTPException(status_code=404, detail="No completed object detection jobs.")
+
+    response = FileResponse(job_manager.results_path(job['job_id']), media_type='application/octet-stream',filename="api_outputs.zip")
 
     return response
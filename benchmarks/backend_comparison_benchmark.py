@@ -0,0 +1,149 @@
+'''
+Compares inference backends on CPU for accuracy (against a reference backend) and latency, and reports the fastest candidate whose
+detections stay within tolerance of the reference.
+
+    python3 benchmarks/backend_comparison_benchmark.py \
+      --reference saved_model:/app/models/efficientdet-d0/saved_model \
+      --candidates tflite:/app/models/efficientdet-d0/model_float32.tflite tflite:/app/models/efficientdet-d0/model_float16.tflite \
+                   tflite:/app/models/efficientdet-d0/model_int8.tflite \
+      --threads 1 4 --images '/data/sample_chips/*.jpg' --output backend_comparison.json
+
+Each model is given as backend:path. tflite candidates are run once per --threads value. Accuracy is measured as the recall and precision of
+each candidate's detections against the reference's (same class, IoU >= --iou, both above --score-threshold).
+'''
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+# Hide any GPUs so the benchmark measures CPU latency.
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from api.api_utils.inference_utils import batch_inference, load_model
+from api.api_utils.preprocessing_utils import iter_chips
+
+def load_chips(pattern, n_chips, seed=0) -> dict:
+  '''
+  Chips the images matching pattern with iter_chips() (up to n_chips chips), or generates random chips when no pattern is given.
+  '''
+  if pattern is None:
+    rng = np.random.default_rng(seed)
+    return {f"bench_{i}_0.jpg": rng.integers(0, 256, (512, 512, 3), dtype=np.uint8) for i in range(n_chips)}
+
+  chips = {}
+  for path in sorted(glob.glob(pattern)):
+    base_img_name, base_img_ext = os.path.splitext(os.path.basename(path))
+    for name, chip_array in iter_chips(Image.open(path).convert('RGB'), base_img_name, base_img_ext):
+      chips[name] = np.ascontiguousarray(chip_array)
+      if len(chips) == n_chips:
+        return chips
+  return chips
+
+def iou_matrix(a, b) -> np.ndarray:
+  a, b = np.asarray(a, dtype=np.float64).reshape(-1, 4), np.asarray(b, dtype=np.float64).reshape(-1, 4)
+  inter_h = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+  inter_w = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+  inter = inter_h * inter_w
+  area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+  area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+  return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+def compare(reference, candidate, iou_threshold) -> tuple:
+  '''
+  Greedily matches candidate detections to reference detections of the same class and returns (matched, n_reference, n_candidate).
+  '''
+  matched = n_reference = n_candidate = 0
+  for name, ref in reference.items():
+    cand = candidate[name]
+    n_reference += len(ref['scores'])
+    n_candidate += len(cand['scores'])
+    if len(ref['scores']) == 0 or len(cand['scores']) == 0:
+      continue
+
+    iou = iou_matrix(ref['bboxes'], cand['bboxes'])
+    iou[np.asarray(ref['classes'])[:, None] != np.asarray(cand['classes'])[None, :]] = 0
+    for i in np.argsort(ref['scores'])[::-1]:
+      j = int(np.argmax(iou[i]))
+      if iou[i, j] >= iou_threshold:
+        matched += 1
+        iou[:, j] = 0
+  return matched, n_reference, n_candidate
+
+def time_backend(model, chips, repeats) -> list:
+  '''
+  Runs every chip through the model one at a time (as a single request would) and returns the per-chip latencies in ms.
+  '''
+  batch_inference(dict(list(chips.items())[:1]), model, 0.0)  # warm up
+  latencies = []
+  for _ in range(repeats):
+    for name, chip_array in chips.items():
+      start = time.perf_counter()
+      batch_inference({name: chip_array}, model, 0.0)
+      latencies.append((time.perf_counter() - start) * 1000)
+  return latencies
+
+def parse_model(spec) -> tuple:
+  backend, _, path = spec.partition(':')
+  return backend, path
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--reference', default="saved_model:/app/models/efficientdet-d0/saved_model")
+  parser.add_argument('--candidates', nargs='+', required=True)
+  parser.add_argument('--threads', type=int, nargs='+', default=[os.cpu_count()])
+  parser.add_argument('--images', default=None, help="Glob of sample images to chip. Random chips are used when omitted.")
+  parser.add_argument('--n-chips', type=int, default=32)
+  parser.add_argument('--repeats', type=int, default=2)
+  parser.add_argument('--score-threshold', type=float, default=0.3)
+  parser.add_argument('--iou', type=float, default=0.5)
+  parser.add_argument('--min-recall', type=float, default=0.95, help="Candidates must find at least this fraction of the reference detections.")
+  parser.add_argument('--min-precision', type=float, default=0.95)
+  parser.add_argument('--output', default=None, help="Write the results as JSON to this file.")
+  args = parser.parse_args()
+
+  chips = load_chips(args.images, args.n_chips)
+  print(f"Comparing backends on {len(chips)} chips")
+
+  runs = [(args.reference, None)]
+  for spec in args.candidates:
+    backend, _ = parse_model(spec)
+    runs += [(spec, threads) for threads in args.threads] if backend == 'tflite' else [(spec, None)]
+
+  reference = None
+  results = []
+  for spec, threads in runs:
+    backend, path = parse_model(spec)
+    model = load_model(path, backend, num_threads=threads) if threads is not None else load_model(path, backend)
+    detections = batch_inference(chips, model, args.score_threshold)
+    latencies = time_backend(model, chips, args.repeats)
+
+    if reference is None:
+      reference = detections
+    matched, n_reference, n_candidate = compare(reference, detections, args.iou)
+    recall = matched / n_reference if n_reference else 1.0
+    precision = matched / n_candidate if n_candidate else 1.0
+
+    results.append({'model': spec, 'backend': backend, 'threads': threads,
+                    'mean_ms': float(np.mean(latencies)), 'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+                    'detections': n_candidate, 'recall': recall, 'precision': precision,
+                    'within_tolerance': recall >= args.min_recall and precision >= args.min_precision})
+
+  print(f"{'model':<60} {'threads':>7} {'mean ms':>8} {'p95 ms':>8} {'recall':>7} {'precision':>9} {'ok':>3}")
+  for r in results:
+    print(f"{r['model']:<60} {str(r['threads'] or '-'):>7} {r['mean_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['recall']:>7.3f} {r['precision']:>9.3f} {'yes' if r['within_tolerance'] else 'no':>3}")
+
+  best = min((r for r in results if r['within_tolerance']), key=lambda r: r['mean_ms'], default=None)
+  if best is None:
+    print(f"No backend within tolerance (recall >= {args.min_recall}, precision >= {args.min_precision}).")
+  else:
+    print(f"Fastest within tolerance: {best['model']} (threads={best['threads']}, {best['mean_ms']:.1f} ms/chip)")
+
+  if args.output:
+    with open(args.output, 'w') as outfile:
+      json.dump({'chips': len(chips), 'reference': args.reference, 'results': results, 'fastest_within_tolerance': best}, outfile, indent=2)
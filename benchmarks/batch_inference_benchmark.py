@@ -0,0 +1,59 @@
+'''
+Compares batch_inference() throughput (image chips per second) across batch sizes on CPU.
+
+    python3 benchmarks/batch_inference_benchmark.py --model /app/models/efficientdet-d0/saved_model_batched --batch-sizes 1 4 8 16
+'''
+import argparse
+import os
+import sys
+import time
+
+# Hide any GPUs so the benchmark measures CPU throughput.
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from api.api_utils.inference_utils import batch_inference, load_model
+
+def make_chips(n_chips, height=512, width=512, seed=0) -> dict:
+  '''
+  Generates a dictionary of random uint8 image chips shaped like the chips yielded by iter_chips().
+  '''
+  rng = np.random.default_rng(seed)
+  return {f"bench_{i}_0.jpg": rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for i in range(n_chips)}
+
+def run(model, chips, batch_size, repeats) -> float:
+  '''
+  Runs batch_inference() over chips `repeats` times and returns the best observed chips/sec.
+  '''
+  best = 0.0
+  for _ in range(repeats):
+    start = time.perf_counter()
+    batch_inference(chips, model, 0.3, batch_size)
+    elapsed = time.perf_counter() - start
+    best = max(best, len(chips) / elapsed)
+  return best
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--model', default="/app/models/efficientdet-d0/saved_model_batched")
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+  parser.add_argument('--n-chips', type=int, default=64)
+  parser.add_argument('--repeats', type=int, default=3)
+  args = parser.parse_args()
+
+  model = load_model(args.model)
+  supported = model.supported_batch_size
+  print(f"Model max batch size: {'dynamic' if supported is None else supported}")
+
+  chips = make_chips(args.n_chips)
+
+  # Warm up so graph tracing is not counted against the first batch size.
+  batch_inference(dict(list(chips.items())[:max(args.batch_sizes)]), model, 0.3, max(args.batch_sizes))
+
+  print(f"{'batch_size':>10} {'chips/sec':>10}")
+  for batch_size in args.batch_sizes:
+    effective = batch_size if supported is None else min(batch_size, supported)
+    chips_per_sec = run(model, chips, batch_size, args.repeats)
+    print(f"{effective:>10} {chips_per_sec:>10.2f}")
@@ -0,0 +1,60 @@
+'''
+Measures plot_bboxes()/draw_detections() throughput at different detection counts.
+
+    python3 benchmarks/drawing_benchmark.py --counts 10 1000 5000 --size 4000 3000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from api.api_utils.drawing_utils import category_index, draw_detections, plot_bboxes
+
+LABEL_MAP_PBTXT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models/efficientdet-d0/md_labelmap_v6_20210810.pbtxt")
+
+def make_detections(n_detections, height, width, seed=0) -> dict:
+  '''
+  Generates a detection dictionary (as produced by reassemble_chips()) of random boxes, classes and scores.
+  '''
+  rng = np.random.default_rng(seed)
+  ymin = rng.integers(0, height - 64, n_detections)
+  xmin = rng.integers(0, width - 64, n_detections)
+  box_h, box_w = rng.integers(8, 64, n_detections), rng.integers(8, 64, n_detections)
+  return {'bboxes': np.stack([ymin, xmin, ymin + box_h, xmin + box_w], axis=1).tolist(),
+          'classes': rng.integers(1, 11, n_detections).tolist(),
+          'scores': rng.uniform(0.3, 1.0, n_detections).tolist()}
+
+def time_it(fn, repeats) -> float:
+  '''
+  Returns the best wall-clock time (seconds) of fn() over `repeats` runs.
+  '''
+  best = float('inf')
+  for _ in range(repeats):
+    start = time.perf_counter()
+    fn()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--counts', type=int, nargs='+', default=[10, 1000, 5000])
+  parser.add_argument('--size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+  parser.add_argument('--repeats', type=int, default=5)
+  args = parser.parse_args()
+
+  width, height = args.size
+  image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+  cat_index = category_index(LABEL_MAP_PBTXT)
+  out_dir = tempfile.mkdtemp()
+
+  print(f"{'detections':>10} {'draw ms':>10} {'boxes/sec':>12} {'plot+write ms':>14}")
+  for n in args.counts:
+    detections = make_detections(n, height, width)
+    draw_s = time_it(lambda: draw_detections(image.copy(), detections['bboxes'], detections['classes'], detections['scores'], cat_index, 0.3), args.repeats)
+    plot_s = time_it(lambda: plot_bboxes('bench.jpg', out_dir, None, LABEL_MAP_PBTXT, detections, 0.3, image), args.repeats)
+    print(f"{n:>10} {draw_s * 1000:>10.2f} {n / draw_s:>12.0f} {plot_s * 1000:>14.2f}")
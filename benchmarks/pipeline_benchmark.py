@@ -0,0 +1,331 @@
+'''
+Benchmarks each stage of the detection pipeline (preprocessing_utils, inference_utils, drawing_utils) and the end-to-end
+/object-detection/ endpoint on synthetic aerial images, using a stub model (see stub_model.py) so it runs offline without model weights.
+Results are written as JSON so runs can be compared across commits.
+
+End-to-end runs submit every size and format as uploaded ('original'), resampled to the API's 2cm GSD ('resampled') and resubmitted
+so it is served from the detection cache ('cache_hit'), then submit one large TIFF that the API processes window by window, with and
+without resampling.
+
+    python3 benchmarks/pipeline_benchmark.py --sizes 1024x768 4000x3000 --formats jpeg png tiff --output benchmark_results.json
+    python3 benchmarks/pipeline_benchmark.py --suites end_to_end --stub-latency-ms 5 --stub-latency-ms-per-chip 40 --n-images 4
+    python3 benchmarks/pipeline_benchmark.py --suites end_to_end --e2e-modes resampled --large-tiff-size 10000x8000 --large-tiff-tiled
+'''
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import cv2
+import numpy as np
+import tifffile
+from PIL import Image
+
+from api.api_utils.drawing_utils import category_index, draw_detections, plot_bboxes
+from api.api_utils.inference_utils import batch_inference, threshold_detections
+from api.api_utils.job_utils import JOB_COMPLETE, JOB_FINISHED
+from api.api_utils.prefilter_utils import ChipPrefilter
+from api.api_utils.preprocessing_utils import (ingest_image, iter_chips, iter_resampled_chips, prepare_resample_source,
+                                               reassemble_chips, resampled_size, scale_detections, tile_offsets)
+from stub_model import StubModel
+
+LABEL_MAP_PBTXT = os.path.join(REPO_DIR, "models/efficientdet-d0/md_labelmap_v6_20210810.pbtxt")
+
+# format name -> (file extension, PIL format, upload content type)
+FORMATS = {'jpeg': ('.jpg', 'JPEG', 'image/jpeg'),
+           'png': ('.png', 'PNG', 'image/png'),
+           'tiff': ('.tif', 'TIFF', 'image/tiff')}
+
+def synthetic_aerial_image(width, height, seed=0) -> np.ndarray:
+  '''
+  Generates an RGB image that loosely resembles a coastal aerial photo: smooth sand and water regions with sensor noise and a scattering of
+  small, brightly colored "debris" objects. The texture matters: it sets how well the image compresses and how many chips the prefilter skips.
+  '''
+  rng = np.random.default_rng(seed)
+  terrain = cv2.resize(rng.random((max(height // 256, 2), max(width // 256, 2))).astype(np.float32), (width, height), interpolation=cv2.INTER_CUBIC)
+  sand, water = np.array([194, 178, 128], np.float32), np.array([40, 90, 140], np.float32)
+  image = np.where(terrain[..., None] > 0.5, sand, water) + rng.normal(0, 6, (height, width, 3)).astype(np.float32)
+  image = np.clip(image, 0, 255).astype(np.uint8)
+
+  for _ in range(max(width * height // 200_000, 1)):
+    top, left = rng.integers(0, height - 20), rng.integers(0, width - 20)
+    image[top:top + rng.integers(5, 20), left:left + rng.integers(5, 20)] = rng.integers(0, 256, 3)
+  return image
+
+def write_large_tiff(path, width, height, tiled=False) -> None:
+  '''
+  Writes a synthetic width x height RGB TIFF too large to generate in memory at once, by repeating a 2048 x 2048 synthetic image. It is
+  written uncompressed and contiguous (which WindowedImage memory-maps), or with tiled=True as 512 x 512 zlib-compressed tiles (read through
+  zarr), the usual layout of exported orthomosaics.
+  '''
+  pattern = synthetic_aerial_image(2048, 2048, seed=1)
+
+  if tiled:
+    def iter_tiles():
+      for top in range(0, height, 512):
+        for left in range(0, width, 512):
+          yield pattern[top % 2048:top % 2048 + 512, left % 2048:left % 2048 + 512]
+
+    tifffile.imwrite(path, iter_tiles(), shape=(height, width, 3), dtype=np.uint8, tile=(512, 512), photometric='rgb', compression='zlib')
+    return
+
+  image = tifffile.memmap(path, shape=(height, width, 3), dtype=np.uint8, photometric='rgb')
+  for top in range(0, height, 2048):
+    rows = min(2048, height - top)
+    image[top:top + rows] = np.tile(pattern[:rows], (1, -(-width // 2048), 1))[:, :width]
+  image.flush()
+  del image
+
+def encode_image(image_array, fmt) -> bytes:
+  buf = io.BytesIO()
+  Image.fromarray(image_array).save(buf, FORMATS[fmt][1])
+  return buf.getvalue()
+
+def time_call(fn, repeats) -> dict:
+  '''
+  Calls fn() `repeats` times and returns timing statistics in seconds, along with the last return value.
+  '''
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    value = fn()
+    times.append(time.perf_counter() - start)
+  return {'mean_s': float(np.mean(times)), 'min_s': float(np.min(times)), 'max_s': float(np.max(times)), 'repeats': repeats}, value
+
+def bench_stages(image_bytes, fmt, model, args, output_dir) -> list:
+  '''
+  Times each pipeline stage in isolation on one encoded image, in the order the API runs them.
+  '''
+  ext = FORMATS[fmt][0]
+  results = []
+
+  def record(stage, fn, **extra):
+    stats, value = time_call(fn, args.repeats)
+    results.append({'suite': 'stages', 'format': fmt, 'stage': stage, **extra, **stats})
+    return value
+
+  image = record('ingest_image', lambda: ingest_image(image_bytes).convert('RGB'))
+  image_array = np.asarray(image)
+  height, width = image_array.shape[:2]
+
+  output_size = resampled_size(width, height, args.resample_gsd_cm, 2.0)
+  source = record('prepare_resample_source', lambda: prepare_resample_source(ingest_image(image_bytes, convert_to_rgb=False), output_size))
+  record('iter_resampled_chips', lambda: sum(1 for _ in iter_resampled_chips(source, output_size, 'bench', ext, overlap=args.overlap)))
+
+  offsets = record('tile_offsets', lambda: tile_offsets(height, width, 'bench', ext, overlap=args.overlap))
+  chips = record('iter_chips', lambda: [(k, np.ascontiguousarray(v)) for k, v in iter_chips(image_array, 'bench', ext, overlap=args.overlap)],
+                 n_chips=len(offsets))
+
+  prefilter = ChipPrefilter()
+  record('chip_prefilter', lambda: [prefilter.skip_reason(v) for _, v in chips], n_chips=len(chips))
+
+  inference_results = record('batch_inference', lambda: batch_inference(chips, model, 0.0, args.batch_size), n_chips=len(chips))
+  merged = record('reassemble_chips', lambda: reassemble_chips(inference_results, offsets, 0.5, f"bench{ext}"),
+                  n_detections=sum(len(v['scores']) for v in inference_results.values()))
+  detections = merged[f"bench{ext}"]
+  record('scale_detections', lambda: scale_detections(detections, 1.5, 1.5))
+  detections = record('threshold_detections', lambda: threshold_detections(detections, args.confidence_threshold))
+
+  cat_index = category_index(LABEL_MAP_PBTXT)
+  canvas = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+  record('draw_detections', lambda: draw_detections(canvas.copy(), detections['bboxes'], detections['classes'], detections['scores'], cat_index,
+                                                    args.confidence_threshold), n_detections=len(detections['scores']))
+  record('plot_bboxes', lambda: plot_bboxes(f"bench{ext}", output_dir, None, LABEL_MAP_PBTXT, detections, args.confidence_threshold, image_array))
+
+  for r in results:
+    r.update(width=width, height=height)
+  return results
+
+def api_client(model, args, work_dir):
+  '''
+  Returns an in-process TestClient for the API's object detection router, with the API's model swapped for the stub and its job, spool and
+  cache folders moved into work_dir. Use it as a context manager so the API's startup hook runs.
+  '''
+  from fastapi import FastAPI
+  from fastapi.testclient import TestClient
+
+  from api import object_detection as od
+  from api.api_utils.batching_utils import DynamicBatcher
+  from api.api_utils.job_utils import JobManager
+
+  def load_stub_model():
+    od.model = model
+    od.inference_model = DynamicBatcher(model, od.DYNAMIC_BATCH_MAX_SIZE, od.DYNAMIC_BATCH_MAX_WAIT_MS) if od.DYNAMIC_BATCHING else model
+
+  od.load_inference_model = load_stub_model
+  od.job_manager = JobManager(os.path.join(work_dir, 'jobs'), od.MAX_CONCURRENT_JOBS, od.MAX_PENDING_JOBS, od.MAX_RETAINED_JOBS)
+  od.SPOOL_PATH = os.path.join(work_dir, 'spool')
+  od.LABEL_MAP_PBTXT = LABEL_MAP_PBTXT
+  # The cache is opened by the router's startup hook, when the test client starts.
+  od.DETECTION_CACHE = args.cache
+  od.DETECTION_CACHE_PATH = os.path.join(work_dir, 'detection_cache')
+
+  app = FastAPI()
+  app.include_router(od.router)
+  return TestClient(app)
+
+def submission_form(mode, width, height, args) -> dict:
+  '''
+  Returns the /object-detection/ form fields for an end-to-end mode. Resampled submissions give the flight_AGL at which a phantom4pro
+  photo of width x height pixels has a GSD of args.resample_gsd_cm, so the API resamples it to its 2cm target.
+  '''
+  form = {'skip_optional_resampling': 'true', 'confidence_threshold': str(args.confidence_threshold)}
+  if mode == 'resampled':
+    from api.object_detection import SENSOR_DICT
+
+    focal_length_mm, sensor_height_cm, sensor_width_cm = SENSOR_DICT['phantom4pro']
+    flight_agl = args.resample_gsd_cm * focal_length_mm / (1000 * max(sensor_height_cm / height, sensor_width_cm / width))
+    form.update(skip_optional_resampling='false', sensor_platform='phantom4pro', flight_AGL=str(flight_agl))
+  return form
+
+@contextmanager
+def detection_cache(work_dir):
+  '''
+  Opens a detection cache for the API while the block runs, unless --cache already left the API's own cache on.
+  '''
+  from api import object_detection as od
+  from api.api_utils.cache_utils import DetectionCache
+
+  previous = od.detection_cache
+  if previous is None:
+    od.detection_cache = DetectionCache(os.path.join(work_dir, 'cache_hit_cache'), od.DETECTION_CACHE_MAX_BYTES)
+  try:
+    yield
+  finally:
+    od.detection_cache = previous
+
+def run_job(client, uploads, form) -> tuple:
+  '''
+  Submits the uploads to the /object-detection/ endpoint, waits for the job and downloads its results. Returns the finished job and the
+  size of its results.
+  '''
+  response = client.post('/object-detection/', files=[('aerial_images', upload) for upload in uploads], data=form)
+  response.raise_for_status()
+  job_id = response.json()['job_id']
+
+  while True:
+    job = client.get(f'/jobs/{job_id}').json()
+    if job['status'] in JOB_FINISHED:
+      break
+    time.sleep(0.01)
+  if job['status'] != JOB_COMPLETE:
+    raise RuntimeError(f"Benchmark job {job['status']}: {job['error']}")
+
+  return job, len(client.get(f'/jobs/{job_id}/results').content)
+
+def bench_end_to_end(client, uploads, form, args, mode, work_dir) -> list:
+  '''
+  Submits the uploads with the given form fields `repeats` times, timing each job from upload to downloaded results. In 'cache_hit' mode
+  the uploads are submitted once beforehand, untimed, so every timed job is served from the detection cache.
+  '''
+  with detection_cache(work_dir) if mode == 'cache_hit' else nullcontext():
+    if mode == 'cache_hit':
+      run_job(client, uploads, form)
+
+    results = []
+    for repeat in range(args.repeats):
+      start = time.perf_counter()
+      job, result_bytes = run_job(client, uploads, form)
+      elapsed = time.perf_counter() - start
+      results.append({'suite': 'end_to_end', 'mode': mode, 'repeat': repeat, 'n_images': len(uploads), 'seconds': elapsed,
+                      'images_per_s': len(uploads) / elapsed, 'result_bytes': result_bytes, 'stage_seconds': job['timings']})
+  return results
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def parse_size(size) -> tuple:
+  width, height = size.lower().split('x')
+  return int(width), int(height)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--suites', nargs='+', choices=['stages', 'end_to_end'], default=['stages', 'end_to_end'])
+  parser.add_argument('--sizes', nargs='+', default=['1024x768', '2048x1536', '4000x3000'], help="WIDTHxHEIGHT of the synthetic images.")
+  parser.add_argument('--formats', nargs='+', choices=sorted(FORMATS), default=sorted(FORMATS))
+  parser.add_argument('--repeats', type=int, default=3)
+  parser.add_argument('--n-images', type=int, default=2, help="Images per end-to-end request (one request per size and format).")
+  parser.add_argument('--batch-size', type=int, default=8)
+  parser.add_argument('--overlap', type=int, default=64)
+  parser.add_argument('--confidence-threshold', type=float, default=0.3)
+  parser.add_argument('--resample-gsd-cm', type=float, default=1.5, help="Estimated GSD used when benchmarking resampling to 2cm.")
+  parser.add_argument('--stub-latency-ms', type=float, default=0.0, help="Fixed latency of each stub model call.")
+  parser.add_argument('--stub-latency-ms-per-chip', type=float, default=0.0, help="Extra stub model latency per chip in a batch.")
+  parser.add_argument('--stub-detections', type=int, default=100, help="Detections returned by the stub model per chip.")
+  parser.add_argument('--cache', action='store_true', help="Leave the API's detection cache on for all end-to-end runs, not just 'cache_hit'.")
+  parser.add_argument('--e2e-modes', nargs='+', choices=['original', 'resampled', 'cache_hit'], default=['original', 'resampled', 'cache_hit'],
+                      help="How end-to-end uploads are submitted: as uploaded, resampled to 2cm, or resubmitted to hit the detection cache.")
+  parser.add_argument('--large-tiff-size', default='7200x7200',
+                      help="WIDTHxHEIGHT of the TIFF submitted once per end-to-end mode (but 'cache_hit'), large enough for windowed processing. 'none' to skip.")
+  parser.add_argument('--large-tiff-tiled', action='store_true', help="Write the large TIFF as zlib-compressed tiles instead of uncompressed strips.")
+  parser.add_argument('--output', default='benchmark_results.json')
+  args = parser.parse_args()
+
+  model = StubModel(args.stub_latency_ms, args.stub_latency_ms_per_chip, args.stub_detections)
+  results = []
+
+  with tempfile.TemporaryDirectory() as work_dir:
+    if 'end_to_end' in args.suites:
+      client = api_client(model, args, work_dir)
+      client.__enter__()
+      while client.get('/ready').status_code != 200:
+        time.sleep(0.01)
+
+    for size in args.sizes:
+      width, height = parse_size(size)
+      image_array = synthetic_aerial_image(width, height)
+      for fmt in args.formats:
+        image_bytes = encode_image(image_array, fmt)
+        print(f"{fmt} {width}x{height} ({len(image_bytes) / 1e6:.1f} MB)")
+
+        if 'stages' in args.suites:
+          for r in bench_stages(image_bytes, fmt, model, args, work_dir):
+            print(f"  {r['stage']:<24} {r['mean_s'] * 1000:>10.1f} ms")
+            results.append(r)
+
+        if 'end_to_end' in args.suites:
+          ext, _, content_type = FORMATS[fmt]
+          uploads = [(f"bench_{i}{ext}", image_bytes, content_type) for i in range(args.n_images)]
+          for mode in args.e2e_modes:
+            for r in bench_end_to_end(client, uploads, submission_form(mode, width, height, args), args, mode, work_dir):
+              r.update(format=fmt, width=width, height=height, upload_bytes=len(image_bytes) * args.n_images)
+              print(f"  {'end_to_end ' + mode:<24} {r['seconds'] * 1000:>10.1f} ms ({r['images_per_s']:.2f} images/s)")
+              results.append(r)
+
+    if 'end_to_end' in args.suites and args.large_tiff_size.lower() != 'none':
+      width, height = parse_size(args.large_tiff_size)
+      tiff_path = os.path.join(work_dir, 'large.tif')
+      write_large_tiff(tiff_path, width, height, args.large_tiff_tiled)
+      with open(tiff_path, 'rb') as infile:
+        image_bytes = infile.read()
+      os.remove(tiff_path)
+      layout = 'tiled' if args.large_tiff_tiled else 'contiguous'
+      print(f"large {layout} tiff {width}x{height} ({len(image_bytes) / 1e6:.1f} MB)")
+
+      for mode in [m for m in args.e2e_modes if m != 'cache_hit']:
+        # Large TIFFs are processed window by window, and their detections are never cached.
+        for r in bench_end_to_end(client, [("bench_large.tif", image_bytes, 'image/tiff')], submission_form(mode, width, height, args), args, mode, work_dir):
+          r.update(format=f'large_tiff_{layout}', width=width, height=height, upload_bytes=len(image_bytes))
+          print(f"  {'end_to_end ' + mode:<24} {r['seconds'] * 1000:>10.1f} ms ({r['images_per_s']:.2f} images/s)")
+          results.append(r)
+
+    if 'end_to_end' in args.suites:
+      client.__exit__(None, None, None)
+
+  meta = {'git_commit': git_commit(), 'timestamp': time.time(), 'python': platform.python_version(), 'platform': platform.platform(),
+          'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'opencv': cv2.__version__, 'args': vars(args)}
+  with open(args.output, 'w') as outfile:
+    json.dump({'meta': meta, 'results': results}, outfile, indent=2)
+  print(f"Wrote {len(results)} results to {args.output}")
@@ -0,0 +1,55 @@
+'''
+A stand-in for the EfficientDet-D0 model that needs no weights, GPU or Tensorflow, for benchmarking the rest of the pipeline.
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from api.api_utils.backend_utils import InferenceBackend
+
+class StubModel(InferenceBackend):
+  '''
+  An inference backend that returns n_detections random (but deterministic) detections per chip after sleeping to imitate the model's
+  latency. It is called exactly like a real backend, so it can be passed to batch_inference(), DynamicBatcher or the API.
+
+  -  INPUTS:
+    -  latency_ms: the fixed cost of one model call, in milliseconds.
+    -  latency_ms_per_chip: the additional cost of each chip in the batch, in milliseconds.
+    -  n_detections: the number of detections returned per chip (the TFODAPI exporter returns 100, most with low scores).
+    -  n_classes: detections are spread over class IDs 1..n_classes.
+    -  supported_batch_size: the largest batch accepted per call (None for any), imitating the stock or batched saved_model exports.
+    -  cpu_ms_per_chip: CPU time burned per chip (in a busy loop that holds the GIL), imitating a CPU-bound model that doesn't scale across
+         threads in one process. Unlike the latency options, this work competes for cores.
+  '''
+  name = 'stub'
+
+  def __init__(self, latency_ms=0.0, latency_ms_per_chip=0.0, n_detections=100, n_classes=9, supported_batch_size=None, seed=0,
+               cpu_ms_per_chip=0.0):
+    self.latency_ms = latency_ms
+    self.latency_ms_per_chip = latency_ms_per_chip
+    self.n_detections = n_detections
+    self.n_classes = n_classes
+    self.supported_batch_size = supported_batch_size
+    self.cpu_ms_per_chip = cpu_ms_per_chip
+
+    rng = np.random.default_rng(seed)
+    ymin, xmin = rng.random((2, n_detections)) * 0.9
+    height, width = rng.random((2, n_detections)) * 0.1 + 0.01
+    self.boxes = np.stack([ymin, xmin, np.minimum(ymin + height, 1.0), np.minimum(xmin + width, 1.0)], axis=1).astype(np.float32)
+    self.scores = np.sort(rng.random(n_detections).astype(np.float32))[::-1]
+    self.classes = rng.integers(1, n_classes + 1, n_detections).astype(np.float32)
+
+  def __call__(self, batch_tensor) -> dict:
+    n = len(batch_tensor)
+    time.sleep((self.latency_ms + self.latency_ms_per_chip * n) / 1000)
+    deadline = time.thread_time() + self.cpu_ms_per_chip * n / 1000
+    while time.thread_time() < deadline:
+      pass
+    return {'detection_boxes': np.broadcast_to(self.boxes, (n,) + self.boxes.shape),
+            'detection_scores': np.broadcast_to(self.scores, (n,) + self.scores.shape),
+            'detection_classes': np.broadcast_to(self.classes, (n,) + self.classes.shape),
+            'num_detections': np.full(n, self.n_detections, dtype=np.float32)}
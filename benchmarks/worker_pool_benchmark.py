@@ -0,0 +1,117 @@
+'''
+Measures how inference throughput scales with the number of InferenceWorkerPool worker processes, compared with calling the model from
+threads in a single process. Use it to pick INFERENCE_WORKERS, INFERENCE_INTRA_OP_THREADS and INFERENCE_WORKER_CPU_AFFINITY for a node.
+
+    python3 benchmarks/worker_pool_benchmark.py --model tflite:/app/models/efficientdet-d0/model_float16.tflite --workers 1 2 4 8 \
+      --intra-op-threads 2 --pin --output worker_pool_benchmark.json
+    python3 benchmarks/worker_pool_benchmark.py --workers 1 2 4 --stub-cpu-ms-per-chip 20
+
+The model is given as backend:path, or 'stub' (the default) for the stub model in stub_model.py, whose --stub-cpu-ms-per-chip imitates a
+CPU-bound model and whose zero-cost default isolates the pool's own overhead (copying chips to shared memory and returning detections).
+Each run keeps every worker busy by calling the pool from one thread per worker.
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Hide any GPUs so the benchmark measures CPU throughput.
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from api.api_utils.inference_utils import load_model
+from api.api_utils.worker_pool_utils import InferenceWorkerPool, configure_tensorflow_threads
+from stub_model import StubModel
+
+def model_loader(spec, args):
+  '''
+  Returns a picklable function that loads the model named by spec ('stub' or backend:path), for use in this process or in a worker.
+  '''
+  if spec == 'stub':
+    return partial(StubModel, args.stub_latency_ms, args.stub_latency_ms_per_chip, args.stub_detections, cpu_ms_per_chip=args.stub_cpu_ms_per_chip)
+
+  backend, path = spec.split(':', 1)
+  options = {'num_threads': args.tflite_threads} if backend == 'tflite' and args.tflite_threads else {}
+  return partial(load_model, path, backend, **options)
+
+def run(model, batches, callers, repeats) -> dict:
+  '''
+  Runs every batch through the model from `callers` threads, repeats times, and returns the best run's wall time and throughput.
+  '''
+  n_chips = sum(len(b) for b in batches)
+  seconds = []
+  with ThreadPoolExecutor(callers) as executor:
+    for _ in range(repeats):
+      start = time.perf_counter()
+      list(executor.map(model, batches))
+      seconds.append(time.perf_counter() - start)
+  return {'seconds': min(seconds), 'chips_per_s': n_chips / min(seconds), 'all_seconds': seconds}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--model', default='stub', help="'stub', or backend:path (e.g. tflite:/app/models/efficientdet-d0/model_float16.tflite).")
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+  parser.add_argument('--n-chips', type=int, default=256)
+  parser.add_argument('--batch-size', type=int, default=8)
+  parser.add_argument('--chip-size', type=int, default=512)
+  parser.add_argument('--repeats', type=int, default=3)
+  parser.add_argument('--intra-op-threads', type=int, default=None, help="Tensorflow intra-op threads per worker (default: TF's, or the pinned cores with --pin).")
+  parser.add_argument('--inter-op-threads', type=int, default=None)
+  parser.add_argument('--tflite-threads', type=int, default=None, help="TFLite interpreter threads per worker.")
+  parser.add_argument('--pin', action='store_true', help="Pin each worker to its own share of the cores (cpu_affinity='auto').")
+  parser.add_argument('--skip-in-process', action='store_true', help="Skip the single-process baseline.")
+  parser.add_argument('--stub-latency-ms', type=float, default=0.0)
+  parser.add_argument('--stub-latency-ms-per-chip', type=float, default=0.0)
+  parser.add_argument('--stub-cpu-ms-per-chip', type=float, default=0.0)
+  parser.add_argument('--stub-detections', type=int, default=100)
+  parser.add_argument('--output', default=None, help="Optional path of a JSON file to write the results to.")
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  chips = rng.integers(0, 256, (args.n_chips, args.chip_size, args.chip_size, 3), dtype=np.uint8)
+  batches = [chips[i:i + args.batch_size] for i in range(0, args.n_chips, args.batch_size)]
+  load_fn = model_loader(args.model, args)
+  print(f"{args.model}: {args.n_chips} chips of {args.chip_size}x{args.chip_size} in batches of {args.batch_size}, {os.cpu_count()} CPUs")
+
+  results = []
+  if not args.skip_in_process:
+    configure_tensorflow_threads(args.intra_op_threads, args.inter_op_threads)
+    model = load_fn()
+    model(batches[0])
+    for callers in sorted(set(args.workers)):
+      r = dict(run(model, batches, callers, args.repeats), mode='in_process', workers=0, callers=callers)
+      print(f"  {f'in-process, {callers} threads':<28} {r['chips_per_s']:>8.1f} chips/s")
+      results.append(r)
+    del model
+
+  baseline = None
+  for n_workers in args.workers:
+    start = time.perf_counter()
+    pool = InferenceWorkerPool(load_fn, n_workers, (args.chip_size, args.chip_size, 3), args.batch_size, args.intra_op_threads,
+                               args.inter_op_threads, 'auto' if args.pin else None, [args.batch_size])
+    startup_seconds = time.perf_counter() - start
+    try:
+      r = run(pool, batches, n_workers, args.repeats)
+      worker_stats = pool.stats()
+    finally:
+      pool.close()
+
+    baseline = baseline or r['chips_per_s'] / n_workers
+    r.update(mode='worker_pool', workers=n_workers, callers=n_workers, pinned=args.pin, startup_seconds=startup_seconds,
+             speedup=r['chips_per_s'] / baseline, scaling_efficiency=r['chips_per_s'] / (baseline * n_workers), worker_stats=worker_stats)
+    print(f"  {f'{n_workers} workers' + (' (pinned)' if args.pin else ''):<28} {r['chips_per_s']:>8.1f} chips/s  "
+          f"speedup {r['speedup']:.2f}x  efficiency {r['scaling_efficiency']:.0%}  startup {startup_seconds:.1f}s")
+    results.append(r)
+
+  if args.output:
+    meta = {'timestamp': time.time(), 'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'args': vars(args)}
+    with open(args.output, 'w') as outfile:
+      json.dump({'meta': meta, 'results': results}, outfile, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
@@ -36,6 +36,10 @@ class User_Submission(BaseModel):
     flight_AGL: Optional[float] = Field(None, ge=3.0, le=121.92)
     sensor_platform: Optional[str] = None
     confidence_threshold: Optional[float] = Field(0.3, ge=0.0, le=1.0)
+    # 'json' (the original results format), 'npz' (columnar NumPy arrays) or 'coco' (COCO-style JSON). See api/api_utils/output_utils.py.
+    output_format: Optional[str] = Field('json', regex='^(json|npz|coco)$')
+    # 'image' (one annotated image per upload) or 'tiles' (a Deep Zoom tile pyramid plus a GeoJSON box overlay). See api/api_utils/pyramid_utils.py.
+    plot_format: Optional[str] = Field('image', regex='^(image|tiles)$')
     
     @validator('flight_AGL', 'sensor_platform')
     def validate_resampling_settings(cls, v, values):
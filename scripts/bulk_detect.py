@@ -0,0 +1,200 @@
+'''
+Runs the object detection pipeline over a local folder (or manifest) of images without going through the API, for bulk workloads such as
+whole survey flights. Each worker process loads the model once and runs the API's own stages (ingest, optional resampling to the target
+GSD, chipping, prefiltering, batch inference, reassembly, plotting and results writing, with the settings in api/object_detection.py) on one
+image at a time. Outputs are written under --output-dir, mirroring the input folder's layout.
+
+    python3 scripts/bulk_detect.py /data/flight_0412 --output-dir /data/flight_0412_detections --workers 4
+    python3 scripts/bulk_detect.py --manifest frames.txt --output-dir out --sensor-platform skydio2 --flight-agl 40 --output-format npz
+
+Finished images are appended to a checkpoint manifest (--output-dir/checkpoint.jsonl by default) as they complete, so a run that is stopped
+or crashes can be restarted with the same command and skips the images that are already done. Images that failed are retried. Throughput
+(images/s and chips/s) is printed as the run progresses and at the end, and can be saved with --summary.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+# Set in each worker process by init_worker().
+worker = {}
+
+def find_images(input_dir, exclude_dir=None) -> list:
+  '''
+  Returns (key, path) for every image under input_dir (except under exclude_dir), where key is the image's path relative to input_dir.
+  '''
+  images = []
+  for root, dirs, files in os.walk(input_dir):
+    dirs[:] = sorted(d for d in dirs if exclude_dir is None or os.path.realpath(os.path.join(root, d)) != os.path.realpath(exclude_dir))
+    for f in sorted(files):
+      if f.lower().endswith(IMAGE_EXTENSIONS):
+        path = os.path.join(root, f)
+        images.append((os.path.relpath(path, input_dir), path))
+  return images
+
+def read_manifest(manifest_path) -> list:
+  '''
+  Returns (key, path) for every image listed in a manifest file, one path per line (blank lines and lines starting with # are ignored).
+  Relative paths are relative to the manifest's folder, and are used as the image's key.
+  '''
+  base_dir = os.path.dirname(os.path.abspath(manifest_path))
+  images = []
+  with open(manifest_path) as infile:
+    for line in infile:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        images.append((line, line if os.path.isabs(line) else os.path.join(base_dir, line)))
+  return images
+
+def read_checkpoint(checkpoint_path) -> dict:
+  '''
+  Returns the last record of each image in a checkpoint manifest. A partly written last line (from a crash mid-write) is ignored.
+  '''
+  records = {}
+  if os.path.exists(checkpoint_path):
+    with open(checkpoint_path) as infile:
+      for line in infile:
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError:
+          continue
+        records[record['image']] = record
+  return records
+
+def init_worker(sub, threads, verbose, model_dir) -> None:
+  '''
+  Loads the model once in each worker process, with the model's thread pools sized to the worker's share of the machine. The API's model
+  and label map paths are pointed at model_dir, so the CLI also runs outside the container.
+  '''
+  from api import object_detection as od
+  from api.api_utils.inference_utils import load_model
+  from api.api_utils.worker_pool_utils import configure_tensorflow_threads
+
+  if not verbose:
+    sys.stdout = open(os.devnull, 'w')
+
+  for name in ('LABEL_MAP_PBTXT', 'PATH_TO_SAVED_MODEL', 'PATH_TO_BATCHED_SAVED_MODEL', 'PATH_TO_TFLITE_MODEL'):
+    setattr(od, name, os.path.join(model_dir, os.path.relpath(getattr(od, name), od.MODEL_DIR)))
+
+  configure_tensorflow_threads(threads)
+  model_path, backend_options = od.inference_model_spec()
+  if 'num_threads' in backend_options:
+    backend_options['num_threads'] = threads
+
+  # The detection cache is only opened by the API's startup hook: bulk runs are of new images, and the cache is not shared between processes.
+  worker.update(od=od, model=load_model(model_path, od.INFERENCE_BACKEND, **backend_options), sub=sub)
+
+def detect_image(key, path, output_dir) -> dict:
+  '''
+  Runs one image through the pipeline's stages in a worker process and returns its checkpoint record.
+  '''
+  od, sub = worker['od'], worker['sub']
+  started = time.perf_counter()
+  image_output_dir = os.path.join(output_dir, os.path.dirname(key).lstrip(os.sep))
+  os.makedirs(image_output_dir, exist_ok=True)
+
+  item = od.cache_lookup_stage((os.path.basename(path), path), sub, image_output_dir)
+  try:
+    for stage in (od.ingest_stage, od.resample_stage):
+      item = stage(item, sub)
+    item = od.prefilter_stage(od.chip_stage(item))
+    od.infer_item(item, worker['model'])
+    results, outputs = od.write_image_outputs(item, image_output_dir, sub.confidence_threshold, sub.output_format, sub.plot_format)
+  finally:
+    od.close_windowed_image(item)
+
+  return {'image': key, 'status': 'done', 'chips': item['n_chips'], 'skipped_chips': len(results[item['filename']]['skipped_chips']),
+          'detections': sum(len(v['scores']) for v in results.values()), 'seconds': time.perf_counter() - started,
+          'outputs': [os.path.join(os.path.dirname(key).lstrip(os.sep), f) for f in outputs], 'timings': item['timings']}
+
+def throughput(done, chips, seconds) -> str:
+  return f"{done / seconds:.2f} images/s, {chips / seconds:.1f} chips/s"
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('input_dir', nargs='?', default=None, help="A folder of images (searched recursively).")
+  parser.add_argument('--manifest', default=None, help="A text file listing one image path per line, instead of input_dir.")
+  parser.add_argument('--output-dir', required=True)
+  parser.add_argument('--checkpoint', default=None, help="The checkpoint manifest (default: <output-dir>/checkpoint.jsonl).")
+  parser.add_argument('--workers', type=int, default=max(os.cpu_count() // 4, 1), help="Worker processes, each with its own copy of the model.")
+  parser.add_argument('--model-dir', default=os.path.join(REPO_DIR, 'models', 'efficientdet-d0'),
+                      help="The folder holding the model and label map (default: this checkout's models/efficientdet-d0).")
+  parser.add_argument('--threads-per-worker', type=int, default=None, help="Each worker's Tensorflow intra-op (or TFLite) threads (default: cores / workers).")
+  parser.add_argument('--sensor-platform', default=None, help="Resample to the API's target GSD using this platform ('skydio2' or 'phantom4pro').")
+  parser.add_argument('--flight-agl', type=float, default=None, help="The flight's height above ground level in meters, needed with --sensor-platform.")
+  parser.add_argument('--confidence-threshold', type=float, default=0.3)
+  parser.add_argument('--output-format', choices=['json', 'npz', 'coco'], default='json')
+  parser.add_argument('--plot-format', choices=['image', 'tiles'], default='image')
+  parser.add_argument('--report-every', type=float, default=10.0, help="Seconds between progress reports.")
+  parser.add_argument('--summary', default=None, help="Optional path of a JSON file to write the run's throughput summary to.")
+  parser.add_argument('--verbose', action='store_true', help="Show the pipeline's per-image log lines.")
+  args = parser.parse_args()
+
+  if (args.input_dir is None) == (args.manifest is None):
+    parser.error("Give either input_dir or --manifest.")
+  if args.input_dir is not None and os.path.realpath(args.input_dir) == os.path.realpath(args.output_dir):
+    parser.error("--output-dir must not be input_dir, or the plots would overwrite the images.")
+
+  from data_models.user_submission import User_Submission
+  sub = User_Submission(skip_optional_resampling=args.sensor_platform is None, flight_AGL=args.flight_agl, sensor_platform=args.sensor_platform,
+                        confidence_threshold=args.confidence_threshold, output_format=args.output_format, plot_format=args.plot_format)
+
+  images = find_images(args.input_dir, args.output_dir) if args.input_dir is not None else read_manifest(args.manifest)
+  os.makedirs(args.output_dir, exist_ok=True)
+  checkpoint_path = args.checkpoint or os.path.join(args.output_dir, 'checkpoint.jsonl')
+  finished = {k for k, r in read_checkpoint(checkpoint_path).items() if r['status'] == 'done'}
+  todo = [(k, p) for k, p in images if k not in finished]
+  print(f"{len(images)} images, {len(images) - len(todo)} already done (see {checkpoint_path}), {len(todo)} to process with {args.workers} workers.")
+
+  threads = args.threads_per_worker or max(os.cpu_count() // args.workers, 1)
+  done, failed, chips, skipped_chips, detections = 0, 0, 0, 0, 0
+  # Throughput includes the workers' model loading, which a run over thousands of images amortizes.
+  start = last_report = time.perf_counter()
+
+  # Workers are spawned rather than forked, since Tensorflow is not safe to fork.
+  with open(checkpoint_path, 'a') as checkpoint, \
+       ProcessPoolExecutor(args.workers, multiprocessing.get_context('spawn'), init_worker, (sub, threads, args.verbose, args.model_dir)) as executor:
+    futures = {executor.submit(detect_image, k, p, args.output_dir): k for k, p in todo}
+    try:
+      for future in as_completed(futures):
+        try:
+          record = future.result()
+          done += 1
+          chips += record['chips']
+          skipped_chips += record['skipped_chips']
+          detections += record['detections']
+        except Exception as e:
+          record = {'image': futures[future], 'status': 'failed', 'error': repr(e)}
+          failed += 1
+          print(f"{futures[future]} failed: {e!r}")
+
+        checkpoint.write(json.dumps(record) + '\n')
+        checkpoint.flush()
+
+        now = time.perf_counter()
+        if now - last_report >= args.report_every:
+          last_report = now
+          print(f"{done + failed}/{len(todo)} images ({failed} failed), {throughput(done, chips, now - start)}")
+    except KeyboardInterrupt:
+      print("Interrupted, stopping the workers. Rerun the same command to resume.")
+      executor.shutdown(wait=False, cancel_futures=True)
+      raise
+
+  seconds = time.perf_counter() - start
+  print(f"Done: {done} images ({failed} failed), {chips} chips inferred ({skipped_chips} skipped), {detections} detections in {seconds:.1f}s: "
+        f"{throughput(done, chips, seconds)}")
+
+  if args.summary:
+    with open(args.summary, 'w') as outfile:
+      json.dump({'images': len(images), 'already_done': len(images) - len(todo), 'done': done, 'failed': failed, 'chips': chips,
+                 'skipped_chips': skipped_chips, 'detections': detections, 'seconds': seconds,
+                 'images_per_s': done / seconds, 'chips_per_s': chips / seconds, 'workers': args.workers, 'threads_per_worker': threads}, outfile, indent=2)
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,42 @@
+import argparse
+import glob
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, '/app')
+
+from api.api_utils.backend_utils import TFLITE_QUANTIZATIONS, convert_to_tflite
+
+MODEL_DIR = "/app/models/efficientdet-d0"
+
+def load_representative_chips(pattern, n_chips, height=512, width=512) -> list:
+  '''
+  Loads up to n_chips images matching pattern and center-crops (or pads) each to a height x width chip for int8 calibration.
+  '''
+  chips = []
+  for path in sorted(glob.glob(pattern))[:n_chips]:
+    image_array = np.asarray(Image.open(path).convert('RGB'))
+    chip_array = np.zeros((height, width, 3), dtype=np.uint8)
+    top, left = max((image_array.shape[0] - height) // 2, 0), max((image_array.shape[1] - width) // 2, 0)
+    crop = image_array[top:top + height, left:left + width]
+    chip_array[:crop.shape[0], :crop.shape[1]] = crop
+    chips.append(chip_array)
+  return chips
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Convert the EfficientDet-D0 saved_model to a TFLite model for the 'tflite' inference backend.")
+  parser.add_argument('--saved-model-dir', default=f"{MODEL_DIR}/saved_model")
+  parser.add_argument('--quantization', choices=[q for q in TFLITE_QUANTIZATIONS if q], default=None,
+                      help="float16 halves the model size; int8 also quantizes activations (calibrated with --representative-images).")
+  parser.add_argument('--representative-images', default=None, help="Glob of sample images used to calibrate int8 quantization.")
+  parser.add_argument('--n-representative', type=int, default=64)
+  parser.add_argument('--output', default=None, help="Defaults to <model dir>/model_<quantization>.tflite")
+  args = parser.parse_args()
+
+  output = args.output or f"{MODEL_DIR}/model_{args.quantization or 'float32'}.tflite"
+  chips = load_representative_chips(args.representative_images, args.n_representative) if args.representative_images else None
+
+  convert_to_tflite(args.saved_model_dir, output, args.quantization, chips)
+  print(f"Wrote TFLite model to {output}")
@@ -0,0 +1,20 @@
+import argparse
+import sys
+
+# TFODAPI lives outside of the app's PYTHONPATH in the Docker image (see api/api_utils/drawing_utils.py).
+sys.path.insert(0, '/tensorflow/models/research')
+sys.path.insert(0, '/app')
+
+from api.api_utils.inference_utils import export_batched_model
+
+MODEL_DIR = "/app/models/efficientdet-d0"
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Re-export a TFODAPI checkpoint as a saved_model that accepts batches of image chips.")
+  parser.add_argument('--pipeline-config', default=f"{MODEL_DIR}/pipeline.config")
+  parser.add_argument('--checkpoint-dir', default=f"{MODEL_DIR}/checkpoint")
+  parser.add_argument('--output-dir', default=f"{MODEL_DIR}/saved_model_batched")
+  args = parser.parse_args()
+
+  export_batched_model(args.pipeline_config, args.checkpoint_dir, args.output_dir)
+  print(f"Exported batched saved_model to {args.output_dir}")
@@ -1,23 +1,19 @@
 import uvicorn
 from fastapi import FastAPI
 
-from api.api_utils.server_utils import create_temp_folders
-from api.api_utils.inference_utils import load_model
-
-from views import home
-from api import object_detection
+from api.api_utils.server_utils import (RequestBodyLimitMiddleware,
+                                        create_temp_folders)
 
 # SAVE FILE LOCATIONS
-CHIP_IMAGE_PATH="/app_data/chips"
-FINAL_OUTPUT_PATH="/app_data/final_outputs"
-FINAL_ZIP ="/app_data/api_outputs"
+JOBS_PATH="/app_data/jobs"
+SPOOL_PATH="/app_data/spool"
 
 description='''
 The Machine Learning of Marine Debris API (ML/MD API) will automatically find large marine debris objects in high-resolution aerial imagery!
 
 Head over to the **/object-detection/** endpoint to start detecting debris with the API.
 
-Retrieve results at the **/object-detection-results/** endpoint after a successful **/object-detection/**.
+Each **/object-detection/** upload is queued as a job. Check its progress at **/jobs/{job_id}** and retrieve results at **/jobs/{job_id}/results**.
 '''
 
 api = FastAPI(
@@ -37,24 +33,38 @@ api = FastAPI(
 
 def configure():
   '''
-  A simple function that configures the API on startup. Currently just configures routing, but built to handle more in the future.
+  A simple function that configures the API on startup: creates the API's data folders, then configures routing and middleware.
   '''
+  create_temp_folders(JOBS_PATH, SPOOL_PATH)
   configure_routing()
+  configure_middleware()
 
 def configure_routing():
   '''
-  Configures the API's routers
+  Configures the API's routers. The routers' modules are imported here rather than at the top of this module, since they set up the
+  API's job manager, caches and metrics when imported.
   '''
+  from views import home
+  from api import object_detection
+
   #api.mount('/static', StaticFiles(directory='static'), name='static')
   api.include_router(home.router)
   api.include_router(object_detection.router)
 
+def configure_middleware():
+  '''
+  Configures the API's middleware. Uploads to /object-detection/ are cut off as they stream in once they pass the request or per-file size limit.
+  '''
+  from api import object_detection
 
-create_temp_folders(CHIP_IMAGE_PATH, FINAL_OUTPUT_PATH)
+  api.add_middleware(RequestBodyLimitMiddleware, max_bytes=object_detection.MAX_REQUEST_BYTES, path_prefix='/object-detection/',
+                     max_part_bytes=object_detection.MAX_UPLOAD_FILE_BYTES)
 
 
 if __name__ == "__main__":
   configure()
   uvicorn.run(api, port='5000', host='0.0.0.0')
-else:
+elif __name__ != '__mp_main__':
+  # Imported by an ASGI server (e.g. uvicorn server:api). Processes spawned by the inference worker pool re-import this module as
+  # __mp_main__, and must not configure (and import) the whole API again.
   configure()
\ No newline at end of file
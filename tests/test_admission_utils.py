@@ -0,0 +1,32 @@
+import pytest
+
+from api.api_utils.admission_utils import AdmissionRejected, InFlightBudget
+
+
+def test_reservations_are_released():
+    budget = InFlightBudget(max_images=4, max_pixels=1000, max_chips=None, retry_after=7)
+    first = budget.acquire(2, 600, 50)
+    assert (budget.current('images'), budget.current('pixels'), budget.current('chips')) == (2, 600, 50)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        budget.acquire(1, 500, 1)
+    assert rejected.value.retry_after == 7
+    # A rejected request reserves nothing.
+    assert budget.current('images') == 2
+
+    budget.release(first)
+    second = budget.acquire(1, 500, 1)
+    assert (budget.current('images'), budget.current('pixels')) == (1, 500)
+    budget.release(second)
+    assert budget.current('pixels') == 0
+
+def test_requests_larger_than_the_whole_budget_are_never_retried():
+    budget = InFlightBudget(max_images=4, max_pixels=1000)
+    with pytest.raises(AdmissionRejected) as rejected:
+        budget.acquire(5, 10, 1)
+    assert rejected.value.retry_after is None
+
+def test_unlimited_resources_are_only_counted():
+    budget = InFlightBudget()
+    budget.acquire(1_000, 10**12, 10**6)
+    assert budget.current('chips') == 10**6
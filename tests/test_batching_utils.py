@@ -0,0 +1,74 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from api.api_utils.batching_utils import DynamicBatcher
+
+
+class RecordingModel:
+    '''
+    A stand-in model whose detections identify the chip they came from (its fill value), and which records the size of every batch.
+    '''
+    def __init__(self, supported_batch_size=None, error=None):
+        self.supported_batch_size = supported_batch_size
+        self.error = error
+        self.batch_sizes = []
+
+    def __call__(self, batch_tensor):
+        self.batch_sizes.append(len(batch_tensor))
+        if self.error is not None:
+            raise self.error
+        values = batch_tensor[:, 0, 0, 0].astype(np.float32)
+        return {'detection_scores': values[:, np.newaxis], 'num_detections': np.ones(len(batch_tensor), dtype=np.float32)}
+
+def chips(values):
+    return np.stack([np.full((4, 4, 3), v, dtype=np.uint8) for v in values])
+
+def test_results_go_back_to_the_request_that_submitted_each_chip():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch_size=8, max_wait_ms=50)
+    results = {}
+
+    def request(values):
+        results[values[0]] = batcher(chips(values))
+
+    threads = [threading.Thread(target=request, args=(list(range(start, start + 3)),)) for start in (10, 20, 30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for start, detections in results.items():
+        np.testing.assert_array_equal(detections['detection_scores'][:, 0], [start, start + 1, start + 2])
+    assert sum(model.batch_sizes) == 9
+    # Chips from the concurrent requests were merged into shared batches.
+    assert len(model.batch_sizes) < 3
+
+def test_a_partial_batch_runs_once_max_wait_ms_has_passed():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch_size=16, max_wait_ms=20)
+
+    started = time.perf_counter()
+    detections = batcher(chips([7]))
+    assert time.perf_counter() - started < 1.0
+    assert detections['detection_scores'][0, 0] == 7
+    assert model.batch_sizes == [1]
+    assert batcher.stats()['batch_size_histogram'] == {1: 1}
+
+def test_batches_are_capped_at_the_models_supported_batch_size():
+    model = RecordingModel(supported_batch_size=2)
+    batcher = DynamicBatcher(model, max_batch_size=16, max_wait_ms=20)
+
+    batcher(chips([1, 2, 3, 4, 5]))
+    assert batcher.max_batch_size == 2
+    assert max(model.batch_sizes) <= 2 and sum(model.batch_sizes) == 5
+
+def test_a_failed_batch_fails_every_chip_in_it():
+    batcher = DynamicBatcher(RecordingModel(error=RuntimeError("model failed")), max_batch_size=4, max_wait_ms=20)
+
+    futures = [batcher.submit(chip_array) for chip_array in chips([1, 2, 3])]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="model failed"):
+            future.result(timeout=5)
@@ -0,0 +1,76 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+
+from api.api_utils.cache_utils import DetectionCache, detection_cache_key
+from api.api_utils.inference_utils import threshold_detections
+
+
+def detections(scores):
+    n = len(scores)
+    return {'bboxes': np.arange(n * 4, dtype=np.int32).reshape(n, 4), 'scores': np.array(scores, dtype=np.float32),
+            'classes': np.ones(n, dtype=np.uint8), 'skipped_chips': []}
+
+def image_file(tmp_path, name, size=1000):
+    path = tmp_path / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+def submission(**fields):
+    return SimpleNamespace(**dict({'skip_optional_resampling': True, 'flight_AGL': 0.0, 'sensor_platform': 'NA', 'confidence_threshold': 0.3}, **fields))
+
+def test_cache_key_ignores_the_confidence_threshold_but_not_chipping(tmp_path):
+    path = image_file(tmp_path, 'a.jpg')
+    key = detection_cache_key(path, submission(), 2.0, 'v1', 512, 64)
+
+    assert detection_cache_key(path, submission(confidence_threshold=0.8), 2.0, 'v1', 512, 64) == key
+    assert detection_cache_key(path, submission(), 2.0, 'v1', 640, 64) != key
+    assert detection_cache_key(path, submission(sensor_platform='skydio2', skip_optional_resampling=False), 2.0, 'v1', 512, 64) != key
+    assert detection_cache_key(path, submission(), 2.0, 'v2', 512, 64) != key
+
+def test_a_cache_hit_can_be_rethresholded(tmp_path):
+    cache = DetectionCache(str(tmp_path / 'cache'))
+    cache.put('key', detections([0.9, 0.5, 0.1]), image_file(tmp_path, 'a.jpg'))
+
+    cached, image_path = cache.get('key')
+    np.testing.assert_array_equal(cached['scores'], np.array([0.9, 0.5, 0.1], dtype=np.float32))
+    assert os.path.exists(image_path)
+
+    for threshold, expected in ((0.3, [0.9, 0.5]), (0.7, [0.9])):
+        rethresholded = threshold_detections(cached, threshold)
+        np.testing.assert_array_equal(rethresholded['scores'], np.array(expected, dtype=np.float32))
+        assert len(rethresholded['bboxes']) == len(expected)
+    assert cache.get('missing') is None
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    image_path = image_file(tmp_path, 'a.jpg', size=10_000)
+    cache = DetectionCache(str(tmp_path / 'cache'), max_bytes=25_000)
+    cache.put('first', detections([0.5]), image_path)
+    cache.put('second', detections([0.5]), image_path)
+    # Reading the first entry makes the second the least recently used.
+    assert cache.get('first') is not None
+    cache.put('third', detections([0.5]), image_path)
+
+    assert cache.get('second') is None
+    assert not os.path.exists(tmp_path / 'cache' / 'second')
+    assert cache.get('first') is not None and cache.get('third') is not None
+    assert cache.stats()['entries'] == 2 and cache.stats()['bytes'] <= 25_000
+
+def test_entries_larger_than_the_cache_are_not_stored(tmp_path):
+    cache = DetectionCache(str(tmp_path / 'cache'), max_bytes=1000)
+    cache.put('key', detections([0.5]), image_file(tmp_path, 'a.jpg', size=5000))
+
+    assert cache.get('key') is None
+    assert os.listdir(tmp_path / 'cache') == []
+
+def test_reopening_the_cache_keeps_entries_and_sweeps_staging_folders(tmp_path):
+    cache = DetectionCache(str(tmp_path / 'cache'))
+    cache.put('key', detections([0.5]), image_file(tmp_path, 'a.jpg'))
+    # Left behind by a put() that was interrupted before its rename.
+    os.makedirs(tmp_path / 'cache' / '.tmp-interrupted')
+
+    reopened = DetectionCache(str(tmp_path / 'cache'))
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['key']
+    assert reopened.get('key') is not None
+    assert reopened.stats()['entries'] == 1
@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+import tifffile
+
+from api.api_utils.drawing_utils import (plot_bboxes_windowed,
+                                         tiff_plot_compression)
+from api.api_utils.preprocessing_utils import WindowedImage
+
+LABEL_MAP_PBTXT = os.path.join(os.path.dirname(__file__), '..', 'models', 'efficientdet-d0', 'md_labelmap_v6_20210810.pbtxt')
+
+def test_plot_bboxes_windowed_writes_a_tiled_tiff(tmp_path):
+    image = np.full((700, 1100, 3), 40, dtype=np.uint8)
+    tifffile.imwrite(str(tmp_path / 'ortho.tif'), image, photometric='rgb')
+    detections = {'bboxes': np.array([[100, 100, 300, 400], [600, 900, 690, 1090]], dtype=np.int32),
+                  'scores': np.array([0.9, 0.1], dtype=np.float32), 'classes': np.array([1, 2], dtype=np.uint8)}
+
+    windowed_image = WindowedImage(str(tmp_path / 'ortho.tif'))
+    os.makedirs(tmp_path / 'out')
+    plot_bboxes_windowed('ortho.tif', str(tmp_path / 'out'), windowed_image, LABEL_MAP_PBTXT, detections, 0.5, tile_size=256)
+    windowed_image.close()
+
+    with tifffile.TiffFile(str(tmp_path / 'out' / 'ortho.tif')) as tif:
+        page = tif.pages[0]
+        assert page.is_tiled and (page.tilelength, page.tilewidth) == (256, 256)
+        plot = page.asarray()
+
+    assert plot.shape == image.shape
+    assert (plot[100:300, 100:400] != 40).any()
+    if tiff_plot_compression() == 'zlib':
+        # Lossless, so the box below the threshold can be checked for not being drawn.
+        assert (plot[600:690, 900:1090] == 40).all()
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from api.api_utils.job_utils import (JOB_CANCELLED, JOB_COMPLETE, JOB_FAILED,
+                                     JobManager, JobQueueFull)
+
+
+def wait_for(job_manager, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job_manager.get(job_id)['status'] not in (JOB_COMPLETE, JOB_FAILED, JOB_CANCELLED):
+        assert time.monotonic() < deadline, f"job {job_id} did not finish"
+        time.sleep(0.01)
+    return job_manager.get(job_id)
+
+def test_jobs_run_in_their_own_workspace(tmp_path):
+    job_manager = JobManager(str(tmp_path))
+
+    def job(workspace):
+        with open(f"{workspace['output_dir']}/out.txt", 'w') as outfile:
+            outfile.write(workspace['job_id'])
+        job_manager.add_outputs(workspace['job_id'], ['out.txt'])
+
+    job_ids = [job_manager.submit(job) for _ in range(3)]
+    for job_id in job_ids:
+        assert wait_for(job_manager, job_id)['status'] == JOB_COMPLETE
+        assert [filename for _, filename in job_manager.iter_outputs(job_id)] == ['out.txt']
+        assert (tmp_path / job_id / 'final_outputs' / 'out.txt').read_text() == job_id
+
+def test_failed_jobs_record_their_error(tmp_path):
+    job_manager = JobManager(str(tmp_path))
+
+    def job(workspace):
+        raise ValueError("bad image")
+
+    job = wait_for(job_manager, job_manager.submit(job))
+    assert job['status'] == JOB_FAILED and job['error'] == "bad image"
+
+def test_the_event_buffer_keeps_the_newest_events(tmp_path):
+    job_manager = JobManager(str(tmp_path), max_events_per_job=5)
+
+    def job(workspace):
+        for i in range(12):
+            job_manager.add_event(workspace['job_id'], 'progress', {'i': i})
+
+    job_id = job_manager.submit(job)
+    wait_for(job_manager, job_id)
+    events = list(job_manager.iter_events(job_id, poll_interval=0.01))
+    # Event ids stay stable as older events are dropped.
+    assert [(event_id, data['i']) for event_id, _, data in events] == [(i, i) for i in range(7, 12)]
+    assert [event_id for event_id, _, _ in job_manager.iter_events(job_id, start=10, poll_interval=0.01)] == [10, 11]
+
+def test_transient_events_are_dropped_from_finished_jobs(tmp_path):
+    job_manager = JobManager(str(tmp_path), transient_events=('chip_detections',), transient_event_seconds=0)
+
+    def job(workspace):
+        job_manager.add_event(workspace['job_id'], 'chip_detections', {'chip': 'a'})
+        job_manager.add_event(workspace['job_id'], 'image_complete', {'image': 'a.jpg'})
+
+    first = job_manager.submit(job)
+    wait_for(job_manager, first)
+    # Transient events are pruned whenever a job finishes, including those of jobs that finished earlier.
+    wait_for(job_manager, job_manager.submit(job))
+    time.sleep(0.01)
+    wait_for(job_manager, job_manager.submit(job))
+
+    assert [event for _, event, _ in job_manager.iter_events(first, poll_interval=0.01)] == ['image_complete']
+
+def test_cancelled_jobs_stop_at_the_next_checkpoint(tmp_path):
+    job_manager = JobManager(str(tmp_path))
+    started = threading.Event()
+    checkpoints = []
+
+    def job(workspace):
+        started.set()
+        for i in range(500):
+            checkpoints.append(i)
+            job_manager.raise_if_cancelled(workspace['job_id'])
+            time.sleep(0.01)
+
+    job_id = job_manager.submit(job)
+    started.wait(5)
+    assert job_manager.cancel(job_id)
+    job = wait_for(job_manager, job_id)
+
+    assert job['status'] == JOB_CANCELLED and len(checkpoints) < 500
+    assert not job_manager.cancel(job_id)
+    assert not job_manager.cancel('unknown')
+
+def test_the_queue_is_bounded(tmp_path):
+    job_manager = JobManager(str(tmp_path), max_workers=1, max_pending_jobs=2)
+    release = threading.Event()
+    job_ids = [job_manager.submit(lambda workspace: release.wait(5)) for _ in range(2)]
+
+    with pytest.raises(JobQueueFull):
+        job_manager.submit(lambda workspace: None)
+    release.set()
+    for job_id in job_ids:
+        wait_for(job_manager, job_id)
+
+def test_old_finished_jobs_are_evicted_with_their_workspace(tmp_path):
+    job_manager = JobManager(str(tmp_path), max_workers=1, max_retained_jobs=2)
+    job_ids = [job_manager.submit(lambda workspace: None) for _ in range(4)]
+    for job_id in job_ids[-2:]:
+        wait_for(job_manager, job_id)
+    time.sleep(0.05)
+
+    assert job_manager.get(job_ids[0]) is None and not (tmp_path / job_ids[0]).exists()
+    assert job_manager.get(job_ids[-1])['status'] == JOB_COMPLETE
@@ -0,0 +1,186 @@
+import numpy as np
+import pytest
+
+import tifffile
+from PIL import Image
+
+from api.api_utils.preprocessing_utils import (WindowedImage, count_chips,
+                                               iter_chips,
+                                               iter_resampled_chips,
+                                               iter_windowed_chips,
+                                               nms_suppressed,
+                                               prepare_resample_source,
+                                               reassemble_chips, tile_offsets)
+
+
+def random_boxes(rng, n, n_classes=3, extent=1000, max_size=120):
+    ymin, xmin = rng.uniform(0, extent, (2, n))
+    height, width = rng.uniform(5, max_size, (2, n))
+    bboxes = np.stack([ymin, xmin, ymin + height, xmin + width], axis=1).astype(np.int32)
+    return bboxes, rng.random(n).astype(np.float32), rng.integers(1, n_classes + 1, n).astype(np.uint8)
+
+def iou(a, b):
+    inter = max(min(a[2], b[2]) - max(a[0], b[0]), 0) * max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / max(union, 1e-6)
+
+def brute_force_nms(bboxes, scores, classes, candidates, iou_threshold, greedy):
+    '''
+    Pairwise class-aware NMS over the candidate boxes. With greedy=True only boxes that are kept can suppress others (classic NMS);
+    otherwise every higher scoring box can (Fast NMS, which nms_suppressed() implements).
+    '''
+    order = sorted(np.flatnonzero(candidates), key=lambda i: -scores[i])
+    suppressed = np.zeros(len(scores), dtype=bool)
+    for rank, i in enumerate(order):
+        for j in order[:rank]:
+            if (greedy and suppressed[j]) or classes[i] != classes[j]:
+                continue
+            if iou(bboxes[i].astype(np.float64), bboxes[j].astype(np.float64)) > iou_threshold:
+                suppressed[i] = True
+                break
+    return suppressed
+
+def reference_chips(image, base_img_name, base_img_ext, desired_height=512, desired_width=512) -> dict:
+    '''
+    The API's original chipper: crops a PIL image into a non-overlapping grid of chips, padding edge chips with black.
+    '''
+    chip_dict = {}
+    for i in range(0, image.height, desired_height):
+        for j in range(0, image.width, desired_width):
+            chip_dict[f"{base_img_name}_{i}_{j}{base_img_ext}"] = np.array(image.crop((j, i, j + desired_width, i + desired_height)))
+    return chip_dict
+
+def smooth_image(height, width, seed=0) -> Image.Image:
+    # A smooth image, so resampling errors are not dominated by aliasing of pixel noise.
+    noise = np.random.default_rng(seed).integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    return Image.fromarray(noise).resize((width, height), Image.BICUBIC)
+
+@pytest.mark.parametrize('height, width', [(512, 512), (300, 200), (1000, 1500)])
+def test_iter_chips_matches_the_original_chipper(height, width):
+    image = smooth_image(height, width)
+    chips = list(iter_chips(image, 'img', '.jpg', 512, 512))
+    expected = reference_chips(image, 'img', '.jpg', 512, 512)
+
+    assert [name for name, _ in chips] == list(expected)
+    for name, chip_array in chips:
+        np.testing.assert_array_equal(chip_array, expected[name])
+
+@pytest.mark.parametrize('output_size', [(1300, 900), (650, 450), (2000, 1400)])
+def test_resampled_chips_match_resizing_then_chipping(output_size):
+    image = smooth_image(1000, 1500)
+    chips = list(iter_resampled_chips(prepare_resample_source(image, output_size), output_size, 'img', '.jpg', 512, 512))
+    # The API's original resampling: a whole-image PIL resize (bicubic), chipped afterwards.
+    expected = reference_chips(image.resize(output_size, Image.BICUBIC), 'img', '.jpg', 512, 512)
+
+    assert [name for name, _ in chips] == list(expected)
+    for name, chip_array in chips:
+        assert np.abs(chip_array.astype(np.int16) - expected[name]).mean() < 1.0
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 512])
+def test_nms_matches_brute_force_fast_nms(chunk_size):
+    rng = np.random.default_rng(chunk_size)
+    bboxes, scores, classes = random_boxes(rng, 300)
+    candidates = rng.random(300) < 0.8
+
+    expected = brute_force_nms(bboxes, scores, classes, candidates, 0.5, greedy=False)
+    np.testing.assert_array_equal(nms_suppressed(bboxes, scores, classes, candidates, 0.5, chunk_size), expected)
+
+def test_nms_suppresses_at_least_what_greedy_nms_does():
+    rng = np.random.default_rng(1)
+    bboxes, scores, classes = random_boxes(rng, 400, n_classes=2, extent=400)
+    candidates = np.ones(400, dtype=bool)
+
+    suppressed = nms_suppressed(bboxes, scores, classes, candidates, 0.3, chunk_size=50)
+    greedy = brute_force_nms(bboxes, scores, classes, candidates, 0.3, greedy=True)
+    assert suppressed[greedy].all()
+
+def test_nms_matches_greedy_nms_on_separated_clusters():
+    # Each cluster is a few jittered copies of one box, far from the others, so there are no suppression chains and Fast NMS is exact.
+    rng = np.random.default_rng(2)
+    centers = np.stack(np.meshgrid(np.arange(10) * 300, np.arange(10) * 300), axis=-1).reshape(-1, 2)
+    bboxes = np.concatenate([np.tile(np.r_[c, c + 100], (4, 1)) + rng.integers(-5, 6, (4, 4)) for c in centers]).astype(np.int32)
+    scores = rng.random(len(bboxes)).astype(np.float32)
+    classes = rng.integers(1, 3, len(bboxes)).astype(np.uint8)
+    candidates = np.ones(len(bboxes), dtype=bool)
+
+    expected = brute_force_nms(bboxes, scores, classes, candidates, 0.5, greedy=True)
+    np.testing.assert_array_equal(nms_suppressed(bboxes, scores, classes, candidates, 0.5, chunk_size=16), expected)
+
+def test_nms_only_compares_candidates_of_the_same_class():
+    bboxes = np.array([[0, 0, 100, 100]] * 4, dtype=np.int32)
+    scores = np.array([0.9, 0.8, 0.7, 0.6], dtype=np.float32)
+    classes = np.array([1, 2, 1, 1], dtype=np.uint8)
+    candidates = np.array([True, True, True, False])
+
+    np.testing.assert_array_equal(nms_suppressed(bboxes, scores, classes, candidates), [False, False, True, False])
+
+@pytest.mark.parametrize('height, width', [(512, 512), (300, 200), (1000, 1500), (4097, 2049)])
+@pytest.mark.parametrize('overlap', [None, 0, 64, 200])
+def test_tile_offsets_cover_the_image(height, width, overlap):
+    offsets = tile_offsets(height, width, 'img', '.jpg', 512, 512, overlap)
+    assert len(offsets) == count_chips(height, width, 512, 512, overlap)
+
+    tops = np.unique([top for top, _ in offsets.values()])
+    lefts = np.unique([left for _, left in offsets.values()])
+    assert len(offsets) == len(tops) * len(lefts)
+
+    covered = np.zeros((height, width), dtype=bool)
+    for top, left in offsets.values():
+        covered[top:top + 512, left:left + 512] = True
+    assert covered.all()
+
+    if overlap is None:
+        assert list(tops) == list(range(0, height, 512)) and list(lefts) == list(range(0, width, 512))
+    else:
+        for positions, length in ((tops, height), (lefts, width)):
+            assert positions[0] == 0
+            if length >= 512:
+                assert positions[-1] + 512 == length
+            assert (np.diff(positions) <= 512 - overlap).all()
+
+def test_tile_offsets_names_chips_by_offset():
+    offsets = tile_offsets(1000, 1000, 'img', '.jpg', 512, 512, 64)
+    assert all(name == f"img_{top}_{left}.jpg" for name, (top, left) in offsets.items())
+
+def test_reassemble_chips_merges_seam_duplicates():
+    offsets = tile_offsets(512, 960, 'img', '.jpg', 512, 512, 64)
+    (left_chip, _), (right_chip, (_, right_left)) = offsets.items()
+    # The same object, in the overlap of both chips, plus one object away from the seam in the left chip.
+    seam_box = np.array([200, 470, 260, 500])
+    results = {left_chip: {'bboxes': np.array([seam_box, [10, 10, 50, 50]]), 'scores': np.array([0.9, 0.8], dtype=np.float32),
+                           'classes': np.array([1, 1], dtype=np.uint8)},
+               right_chip: {'bboxes': np.array([seam_box - [0, right_left, 0, right_left]]), 'scores': np.array([0.7], dtype=np.float32),
+                            'classes': np.array([1], dtype=np.uint8)}}
+
+    merged = reassemble_chips(results, offsets, 0.5, 'img.jpg')['img.jpg']
+    np.testing.assert_array_equal(merged['scores'], np.array([0.9, 0.8], dtype=np.float32))
+    np.testing.assert_array_equal(merged['bboxes'], [seam_box, [10, 10, 50, 50]])
+
+@pytest.fixture
+def tiff_image(tmp_path):
+    image = np.random.default_rng(3).integers(0, 256, (1100, 1300, 3), dtype=np.uint8)
+    path = str(tmp_path / 'ortho.tif')
+    tifffile.imwrite(path, image, photometric='rgb')
+    return path, image
+
+def test_windowed_image_reads_windows(tiff_image):
+    path, image = tiff_image
+    windowed_image = WindowedImage(path)
+    assert windowed_image.size == (1300, 1100)
+    np.testing.assert_array_equal(windowed_image.read_window(100, 612, 700, 1300), image[100:612, 700:1300])
+
+    windowed_image.close()
+    windowed_image.close()
+    assert windowed_image.data is None
+
+@pytest.mark.parametrize('overlap', [None, 64])
+def test_windowed_chips_match_in_memory_chips(tiff_image, overlap):
+    path, image = tiff_image
+    windowed_image = WindowedImage(path)
+    windowed_chips = list(iter_windowed_chips(windowed_image, 'ortho', '.tif', 512, 512, overlap))
+    chips = list(iter_chips(image, 'ortho', '.tif', 512, 512, overlap))
+    windowed_image.close()
+
+    assert [name for name, _ in windowed_chips] == [name for name, _ in chips]
+    for (_, windowed_chip), (_, chip) in zip(windowed_chips, chips):
+        np.testing.assert_array_equal(windowed_chip, chip)
@@ -0,0 +1,47 @@
+import math
+import os
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+import pytest
+
+from api.api_utils.pyramid_utils import (DZI_NAMESPACE, pyramid_max_level,
+                                         write_tile_pyramid)
+
+
+def test_pyramid_max_level():
+    assert [pyramid_max_level(w, h) for w, h in ((1, 1), (2, 1), (256, 100), (257, 100), (100, 1025))] == [0, 1, 8, 9, 11]
+
+@pytest.mark.parametrize('width, height', [(1000, 700), (256, 256), (257, 3), (1, 1)])
+def test_every_level_is_tiled_at_its_deep_zoom_size(tmp_path, width, height):
+    image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    outputs = write_tile_pyramid(str(tmp_path), 'plot', width, height, lambda top, bottom: image[top:bottom], tile_size=256, workers=2)
+
+    max_level = pyramid_max_level(width, height)
+    assert outputs[0] == 'plot.dzi'
+    assert sorted(os.listdir(tmp_path / 'plot_files'), key=int) == [str(level) for level in range(max_level + 1)]
+
+    n_tiles = 0
+    for level in range(max_level + 1):
+        level_width, level_height = math.ceil(width / 2**(max_level - level)), math.ceil(height / 2**(max_level - level))
+        n_cols, n_rows = math.ceil(level_width / 256), math.ceil(level_height / 256)
+        assert sorted(os.listdir(tmp_path / 'plot_files' / str(level))) == sorted(f"{c}_{r}.jpg" for c in range(n_cols) for r in range(n_rows))
+
+        # Edge tiles are cropped to the level's size rather than padded.
+        last_tile = cv2.imread(str(tmp_path / 'plot_files' / str(level) / f"{n_cols - 1}_{n_rows - 1}.jpg"))
+        assert last_tile.shape[:2] == (level_height - (n_rows - 1) * 256, level_width - (n_cols - 1) * 256)
+        n_tiles += n_cols * n_rows
+
+    assert len(outputs) == n_tiles + 1 and all(os.path.exists(tmp_path / name) for name in outputs)
+
+    size = ET.parse(tmp_path / 'plot.dzi').getroot().find(f'{{{DZI_NAMESPACE}}}Size')
+    assert (int(size.get('Width')), int(size.get('Height'))) == (width, height)
+
+def test_the_full_resolution_level_matches_the_image(tmp_path):
+    image = np.zeros((600, 600, 3), dtype=np.uint8)
+    image[:, 300:] = 200
+    write_tile_pyramid(str(tmp_path), 'plot', 600, 600, lambda top, bottom: image[top:bottom], tile_size=256, quality=95)
+
+    tile = cv2.imread(str(tmp_path / 'plot_files' / str(pyramid_max_level(600, 600)) / '1_0.jpg'))
+    assert np.abs(tile.astype(np.int16) - image[:256, 256:512]).mean() < 3
@@ -0,0 +1,111 @@
+import asyncio
+import json
+from typing import List
+
+import pytest
+from fastapi import FastAPI, File, UploadFile
+
+from api.api_utils.server_utils import (MultipartPartCounter,
+                                        RequestBodyLimitMiddleware,
+                                        multipart_boundary, sse_message)
+
+BOUNDARY = b'testboundary'
+
+def multipart_body(files) -> bytes:
+    body = b''
+    for name, data in files:
+        body += (b'--' + BOUNDARY + b'\r\nContent-Disposition: form-data; name="files"; filename="' + name.encode() + b'"\r\n'
+                 b'Content-Type: image/jpeg\r\n\r\n' + data + b'\r\n')
+    return body + b'--' + BOUNDARY + b'--\r\n'
+
+def feed_in_chunks(counter, body, chunk_size) -> list:
+    return [counter.feed(body[i:i + chunk_size]) for i in range(0, len(body), chunk_size)]
+
+def test_multipart_boundary():
+    assert multipart_boundary(b'multipart/form-data; boundary=abc123') == b'abc123'
+    assert multipart_boundary(b'multipart/form-data; charset=utf-8; BOUNDARY="abc 123"') == b'abc 123'
+    assert multipart_boundary(b'application/json') is None
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 17, 1000, 100_000])
+def test_part_counter_measures_each_part(chunk_size):
+    body = multipart_body([('a.jpg', b'x' * 3000), ('b.jpg', b'y' * 500)])
+    largest = max(feed_in_chunks(MultipartPartCounter(BOUNDARY), body, chunk_size))
+    # The largest part is the first file plus its part headers, however the body is split (including through a delimiter).
+    assert 3000 <= largest < 3200
+
+def test_part_counter_resets_between_parts():
+    counter = MultipartPartCounter(BOUNDARY)
+    sizes = feed_in_chunks(counter, multipart_body([('a.jpg', b'x' * 100)] * 50), 64)
+    assert max(sizes) < 300
+
+def run_asgi(app, headers, chunks):
+    '''
+    Sends one POST request with the given headers and body chunks to an ASGI app, returning (status, JSON body).
+    '''
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    received = []
+    sent = []
+
+    async def receive():
+        if messages:
+            received.append(messages[0])
+            return messages.pop(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST', 'scheme': 'http', 'path': '/upload/',
+             'raw_path': b'/upload/', 'root_path': '', 'query_string': b'', 'headers': headers, 'client': ('test', 1), 'server': ('test', 80)}
+    asyncio.run(app(scope, receive, send))
+    status = next(m['status'] for m in sent if m['type'] == 'http.response.start')
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return status, json.loads(body), len(received)
+
+@pytest.fixture
+def limited_app():
+    app = FastAPI()
+
+    @app.post('/upload/')
+    async def upload(files: List[UploadFile] = File(...)):
+        return {'sizes': [len(await f.read()) for f in files]}
+
+    return RequestBodyLimitMiddleware(app, max_bytes=10_000, path_prefix='/upload/', max_part_bytes=2_000)
+
+def request_headers(body, content_length=None):
+    return [(b'content-type', b'multipart/form-data; boundary=' + BOUNDARY),
+            (b'content-length', content_length if content_length is not None else str(len(body)).encode())]
+
+def chunked(body, chunk_size=500):
+    return [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+def test_requests_within_the_limits_pass_through(limited_app):
+    body = multipart_body([('a.jpg', b'x' * 1500), ('b.jpg', b'y' * 1500)])
+    status, response, _ = run_asgi(limited_app, request_headers(body), chunked(body))
+    assert status == 200 and response == {'sizes': [1500, 1500]}
+
+def test_declared_oversized_bodies_are_refused_before_reading(limited_app):
+    body = multipart_body([('a.jpg', b'x' * 1500)] * 8)
+    status, _, n_received = run_asgi(limited_app, request_headers(body), chunked(body))
+    assert status == 413 and n_received == 0
+
+def test_undeclared_oversized_bodies_are_cut_off(limited_app):
+    body = multipart_body([('a.jpg', b'x' * 1500)] * 8)
+    headers = [(b'content-type', b'multipart/form-data; boundary=' + BOUNDARY)]
+    status, _, n_received = run_asgi(limited_app, headers, chunked(body))
+    assert status == 413 and n_received < len(chunked(body))
+
+def test_oversized_files_are_cut_off_while_received(limited_app):
+    body = multipart_body([('a.jpg', b'x' * 100), ('b.jpg', b'y' * 5000)])
+    status, response, n_received = run_asgi(limited_app, request_headers(body), chunked(body))
+    assert status == 413 and 'per file' in response['detail']
+    assert n_received < len(chunked(body))
+
+def test_malformed_content_length_is_a_bad_request(limited_app):
+    body = multipart_body([('a.jpg', b'x' * 100)])
+    status, _, n_received = run_asgi(limited_app, request_headers(body, b'12abc'), chunked(body))
+    assert status == 400 and n_received == 0
+
+def test_sse_message():
+    assert sse_message('progress', {'chips_done': 3}, 7) == 'id: 7\nevent: progress\ndata: {"chips_done":3}\n\n'
+    assert sse_message(None, None) == ': keepalive\n\n'
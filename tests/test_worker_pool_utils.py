@@ -0,0 +1,51 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from api.api_utils.backend_utils import InferenceBackend
+from api.api_utils.worker_pool_utils import (InferenceWorkerPool,
+                                             cpu_affinity_plan)
+
+
+class ChipSumModel(InferenceBackend):
+    '''
+    A stand-in model (loaded inside the spawned workers) whose detections identify the chip they came from: each chip's pixel sum.
+    '''
+    name = 'chip_sum'
+
+    def __init__(self, supported_batch_size=None, fail=False):
+        if fail:
+            raise ValueError("no weights")
+        self.supported_batch_size = supported_batch_size
+
+    def __call__(self, batch_tensor) -> dict:
+        if self.supported_batch_size is not None:
+            assert len(batch_tensor) <= self.supported_batch_size
+        sums = batch_tensor.reshape(len(batch_tensor), -1).sum(axis=1, dtype=np.float64)
+        return {'detection_scores': sums[:, np.newaxis], 'num_detections': np.ones(len(batch_tensor), dtype=np.float32)}
+
+def test_chips_round_trip_through_shared_memory():
+    pool = InferenceWorkerPool(partial(ChipSumModel, supported_batch_size=2), 2, chip_shape=(8, 8, 3), max_batch_size=4, start_timeout=60)
+    try:
+        chips = np.random.default_rng(0).integers(0, 256, (11, 8, 8, 3), dtype=np.uint8)
+        detections = pool(chips)
+
+        # Batches larger than the workers' buffers are split across tasks, and tasks larger than the model's batch size are split again.
+        np.testing.assert_array_equal(detections['detection_scores'][:, 0], chips.reshape(11, -1).sum(axis=1))
+        assert detections['num_detections'].shape == (11,)
+        stats = pool.stats()
+        assert sum(w['chips'] for w in stats) == 11 and all(w['alive'] for w in stats)
+    finally:
+        pool.close()
+
+    assert all(not w['process'].is_alive() for w in pool.workers)
+
+def test_a_worker_that_fails_to_load_raises():
+    with pytest.raises(RuntimeError, match="failed to load the model"):
+        InferenceWorkerPool(partial(ChipSumModel, fail=True), 1, chip_shape=(8, 8, 3), max_batch_size=4, start_timeout=60)
+
+def test_cpu_affinity_plan_splits_cores():
+    assert cpu_affinity_plan(2, cpus=range(8)) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert cpu_affinity_plan(3, cpus=range(4)) == [[0, 1], [2], [3]]
+    assert cpu_affinity_plan(3, cpus=[0]) == [[0], [0], [0]]
@@ -0,0 +1,49 @@
+import io
+import os
+import zipfile
+
+from api.api_utils.zip_utils import stream_zip, write_zip
+
+
+def output_files(tmp_path):
+    files = {'plot.jpg': os.urandom(3 * 1024 * 1024), 'plot.json': b'{"bboxes": []}' * 1000, 'results.npz': os.urandom(1000)}
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+    return files
+
+def check_layout(archive, files):
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(files)
+        for name, data in files.items():
+            assert zf.read(name) == data
+        compress_types = {info.filename: info.compress_type for info in zf.infolist()}
+
+    # Images and .npz results are stored as-is, JSON is deflated.
+    assert compress_types == {'plot.jpg': zipfile.ZIP_STORED, 'plot.json': zipfile.ZIP_DEFLATED, 'results.npz': zipfile.ZIP_STORED}
+
+def test_write_zip_stores_images_and_deflates_json(tmp_path):
+    files = output_files(tmp_path)
+    write_zip(str(tmp_path / 'out.zip'), [(str(tmp_path / name), name) for name in files])
+    check_layout((tmp_path / 'out.zip').read_bytes(), files)
+
+def test_stream_zip_matches_write_zip_layout(tmp_path):
+    files = output_files(tmp_path)
+    check_layout(b''.join(stream_zip((str(tmp_path / name), name) for name in files)), files)
+
+def test_stream_zip_yields_each_entry_before_the_next_file_is_requested(tmp_path):
+    files = output_files(tmp_path)
+    requested = []
+
+    def slow_files():
+        for name in files:
+            requested.append(name)
+            yield str(tmp_path / name), name
+
+    stream = stream_zip(slow_files())
+    received = 0
+    # The 3 MB image is written in 1 MB blocks, so bytes arrive while only the first file has been requested.
+    while received < 3 * 1024 * 1024:
+        received += len(next(stream))
+        assert requested == ['plot.jpg']
+    assert sum(len(chunk) for chunk in stream) > 0